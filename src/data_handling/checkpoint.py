@@ -0,0 +1,80 @@
+import os
+import json
+
+
+class Checkpoint:
+    """Commit point of a streamed JSONL output, written atomically
+
+    The checkpoint records how many bytes of the output were durably written
+    and by which input. Anything after that offset may be a torn write and is
+    dropped on resume; the ids before it are skipped.
+
+    Args:
+        - path (str): checkpoint file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def save(self, input_path, output_bytes, rows):
+        """Write then rename, so a crash leaves either the old or the new checkpoint"""
+        state = {'input': input_path, 'output_bytes': output_bytes, 'rows': rows}
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def restore(self, input_path, output_path):
+        """Truncate `output_path` to its last committed record and return the ids it holds
+
+        Without a checkpoint the output is trimmed after its last complete line.
+
+        Args:
+            - input_path (str): input of the run being resumed
+            - output_path (str): JSONL output of the run being resumed
+
+        Returns:
+            - done_ids (set): ids of the records already scored
+        """
+        done_ids = set()
+        if not os.path.exists(output_path):
+            return done_ids
+
+        # Step 1: Find the committed end of the output
+        state = self.load()
+        if state is not None:
+            if state['input'] != input_path:
+                raise ValueError(f"Checkpoint {self.path} belongs to {state['input']}, not {input_path}")
+            end = state['output_bytes']
+        else:
+            end = os.path.getsize(output_path)
+
+        # Step 2: Collect ids up to there, stopping at a torn line
+        committed = 0
+        with open(output_path, 'rb') as f:
+            for line in f:
+                if committed + len(line) > end or not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                done_ids.add(record.get('id'))
+                committed += len(line)
+
+        # Step 3: Drop everything after the last committed record
+        with open(output_path, 'r+b') as f:
+            f.truncate(committed)
+        return done_ids
@@ -0,0 +1,276 @@
+import os
+import json
+import numpy as np
+
+from src.data_handling.conversation_store import to_json
+
+COLUMNAR_SUFFIX = '.columns'
+META_FILE = 'meta.json'
+ID_OFFSETS_FILE = 'id_offsets.npy'
+ID_BYTES_FILE = 'id_bytes.npy'
+TEXTS_FILE = 'texts.jsonl'
+COLUMN_DTYPE = np.dtype('<f8')
+SCORE_FIELDS = ('scores', 'score')
+# Record fields stored as UTF-8 string columns like the ids, instead of in texts.jsonl
+STRING_FIELDS = ('duplicate_cluster_id',)
+
+
+def flatten_scores(record):
+    """
+    Flatten the scores of a scored record into column name -> value.
+
+    Args:
+        - record (dict): scored record, with its `scores` dict and final `score`
+
+    Returns:
+        - values (dict): eg: {'responses_similarity': 0.8, 'responses_rouge.rouge1': 0.5, ..., 'score': 0.7},
+            without 'score' for records scored on a subset of metrics
+    """
+    values = {}
+    for field, value in record['scores'].items():
+        if isinstance(value, dict):
+            for key, nested in value.items():
+                values[f'{field}.{key}'] = nested
+        else:
+            values[field] = value
+    if 'score' in record:
+        values['score'] = record['score']
+    return values
+
+
+def unflatten_scores(values):
+    """Inverse of `flatten_scores`, returns (scores, score), score is None when it was not written"""
+    scores = {}
+    for name, value in values.items():
+        if name == 'score':
+            continue
+        field, _, key = name.partition('.')
+        if key:
+            scores.setdefault(field, {})[key] = value
+        else:
+            scores[field] = value
+    return scores, values.get('score')
+
+
+class _NpyAppender:
+    """Append to a 1-D `.npy` file whose header is rewritten with the final length on close
+
+    NumPy pads array headers so the length can grow without moving the data,
+    which lets the file be written in one pass.
+    """
+
+    def __init__(self, path, dtype):
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self.f = open(path, 'wb')
+        self.header_size = self._write_header()
+
+    def _write_header(self):
+        self.f.seek(0)
+        np.lib.format.write_array_header_1_0(
+            self.f, {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': (self.length,)}
+        )
+        return self.f.tell()
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        self.f.write(values.tobytes())
+        self.length += len(values)
+
+    def close(self):
+        end = self.f.tell()
+        if self._write_header() != self.header_size:
+            raise ValueError(f'{self.f.name}: header grew past its padding')
+        self.f.seek(end)
+        self.f.close()
+
+
+class _StringAppender:
+    """Append strings as a `<name>_offsets.npy` (int64, rows + 1) and `<name>_bytes.npy` (uint8) pair"""
+
+    def __init__(self, path, name):
+        self.size = 0
+        self.offsets = _NpyAppender(os.path.join(path, f'{name}_offsets.npy'), np.int64)
+        self.offsets.append([0])
+        self.blob = _NpyAppender(os.path.join(path, f'{name}_bytes.npy'), np.uint8)
+
+    def append(self, values):
+        encoded = [str(value).encode('utf-8') for value in values]
+        self.offsets.append(self.size + np.cumsum([len(value) for value in encoded]))
+        self.size += sum(len(value) for value in encoded)
+        self.blob.append(np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    def close(self):
+        self.offsets.close()
+        self.blob.close()
+
+
+def _read_strings(path, name):
+    offsets = np.load(os.path.join(path, f'{name}_offsets.npy'), mmap_mode='r')
+    blob = np.load(os.path.join(path, f'{name}_bytes.npy'), mmap_mode='r').tobytes()
+    return [blob[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+class ColumnarWriter:
+    """Write scored records as a directory of typed, memory-mappable columns
+
+    Layout of `<name>.columns/`:
+        - one float64 `.npy` per score, eg: `responses_bleu.npy`, `responses_rouge.rouge1.npy`, `score.npy`
+        - `id_offsets.npy` (int64, rows + 1) and `id_bytes.npy` (uint8), the UTF-8 ids back to back
+        - `duplicate_cluster_id_offsets.npy` and `duplicate_cluster_id_bytes.npy`, laid out the
+          same, when the records were deduplicated
+        - `texts.jsonl`, optional: every other field of the record (conversations and
+          responses), one line per row in the same order
+        - `meta.json`: row count and column names, written last so a directory
+          without it is an unfinished write
+
+    Args:
+        - path (str): output directory, created if needed
+        - texts (bool): also write the conversation and response texts
+    """
+
+    def __init__(self, path, texts=True):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, META_FILE)):
+            os.remove(os.path.join(path, META_FILE))
+        self.columns = None
+        self.string_columns = None
+        self.count = 0
+        self.ids = _StringAppender(path, 'id')
+        self.texts = open(os.path.join(path, TEXTS_FILE), 'w') if texts else None
+        if not texts and os.path.exists(os.path.join(path, TEXTS_FILE)):
+            os.remove(os.path.join(path, TEXTS_FILE))
+
+    def write(self, records):
+        records = list(records)
+        if not records:
+            return
+        rows = [flatten_scores(record) for record in records]
+
+        # Step 1: The first record fixes the columns
+        if self.columns is None:
+            self.columns = {
+                name: _NpyAppender(os.path.join(self.path, f'{name}.npy'), COLUMN_DTYPE) for name in rows[0]
+            }
+            self.string_columns = {
+                name: _StringAppender(self.path, name) for name in STRING_FIELDS if name in records[0]
+            }
+
+        # Step 2: One array append per column
+        for name, column in self.columns.items():
+            column.append(np.fromiter((row[name] for row in rows), dtype=COLUMN_DTYPE, count=len(rows)))
+
+        # Step 3: Ids and string fields as one byte blob plus end offsets each
+        self.ids.append([record.get('id', '') for record in records])
+        for name, column in self.string_columns.items():
+            column.append([record[name] for record in records])
+
+        # Step 4: Texts, kept out of the columns
+        if self.texts is not None:
+            for record in records:
+                texts = {
+                    key: value for key, value in record.items() if key not in SCORE_FIELDS and key not in self.string_columns
+                }
+                self.texts.write(json.dumps(texts, default=to_json))
+                self.texts.write('\n')
+        self.count += len(records)
+
+    def close(self):
+        for appender in (*(self.columns or {}).values(), *(self.string_columns or {}).values(), self.ids):
+            appender.close()
+        if self.texts is not None:
+            self.texts.close()
+        meta = {
+            'rows': self.count, 'columns': list(self.columns or ()), 'string_columns': list(self.string_columns or ()),
+            'texts': self.texts is not None,
+        }
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=4)
+
+
+class ColumnarScores:
+    """Read a directory written by `ColumnarWriter`
+
+    Columns are memory-mapped, so loading one is instant and copies nothing
+    whatever the row count; pages are only read as the array is touched.
+
+    Args:
+        - path (str): `.columns` directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        meta_path = os.path.join(path, META_FILE)
+        if not os.path.exists(meta_path):
+            raise ValueError(f'{path} is not a finished columnar dataset, {META_FILE} is missing')
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        self.rows = meta['rows']
+        self.columns = meta['columns']
+        self.string_columns = meta.get('string_columns', [])
+        self.has_texts = meta['texts']
+
+    def __len__(self):
+        return self.rows
+
+    def column(self, name):
+        """
+        Memory-mapped values of one score column.
+
+        Args:
+            - name (str): column name, eg: 'score' or 'responses_rouge.rougeL'
+
+        Returns:
+            - values (np.memmap): read-only float64 array of `rows` values
+        """
+        if name not in self.columns:
+            raise KeyError(f'no column {name!r}, available: {self.columns}')
+        return np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode='r')
+
+    def ids(self):
+        """Every id, decoded into a list of str"""
+        return _read_strings(self.path, 'id')
+
+    def strings(self, name):
+        """
+        Every value of a string column, eg: 'duplicate_cluster_id'.
+
+        Returns:
+            - values (list(str)): `rows` values
+        """
+        if name not in self.string_columns:
+            raise KeyError(f'no string column {name!r}, available: {self.string_columns}')
+        return _read_strings(self.path, name)
+
+    def id(self, row):
+        offsets = np.load(os.path.join(self.path, ID_OFFSETS_FILE), mmap_mode='r')
+        blob = np.load(os.path.join(self.path, ID_BYTES_FILE), mmap_mode='r')
+        return blob[offsets[row]:offsets[row + 1]].tobytes().decode('utf-8')
+
+    def records(self, chunk_size=65536):
+        """
+        Rebuild the scored records, with their texts when they were written.
+
+        Yields:
+            - record (dict): in the key order `score_builder.py` writes
+        """
+        texts = open(os.path.join(self.path, TEXTS_FILE), 'r') if self.has_texts else None
+        try:
+            ids = self.ids()
+            strings = {name: self.strings(name) for name in self.string_columns}
+            for start in range(0, self.rows, chunk_size):
+                end = min(start + chunk_size, self.rows)
+                columns = {name: self.column(name)[start:end].tolist() for name in self.columns}
+                for offset in range(end - start):
+                    record = json.loads(texts.readline()) if texts is not None else {'id': ids[start + offset]}
+                    for name, values in strings.items():
+                        record[name] = values[start + offset]
+                    scores, score = unflatten_scores({name: values[offset] for name, values in columns.items()})
+                    record['scores'] = scores
+                    if score is not None:
+                        record['score'] = score
+                    yield record
+        finally:
+            if texts is not None:
+                texts.close()
@@ -0,0 +1,200 @@
+import numpy as np
+
+# Fields of a structured record that hold conversations
+CONVERSATION_FIELDS = ('prev_context_conversation', 'source_conversation')
+# Roles written by structure_builder.py, any other role gets the next free code
+ROLES = ('customer', 'agent', 'human', 'ai')
+
+
+class ConversationStore:
+    """
+    Many conversations packed into one text buffer and a few integer arrays.
+
+    Structured records hold every message as its own single-key dict, which
+    costs a dict, a key and a str object per message. Here the messages of all
+    conversations live back to back in one UTF-8 buffer, each prefixed with a
+    space as `build_conversation_text` joins them, so the transcript of a
+    conversation is a single slice of the buffer. Per message only a byte offset
+    and a one-byte interned role code are kept.
+
+    The buffer is bytes rather than str: one emoji would otherwise widen every
+    character of a str buffer to four bytes.
+
+    Conversations are appended while building, `freeze` then packs them and
+    `conversation(i)` hands out lightweight views.
+
+    Args:
+        - roles (tuple(str)): roles with a fixed code, in code order
+    """
+
+    def __init__(self, roles=ROLES):
+        self.roles = list(roles)
+        self.role_codes = {role: code for code, role in enumerate(self.roles)}
+        self.data = None
+        # Building state, dropped by `freeze`
+        self._pieces = []
+        self._message_starts = []
+        self._message_roles = []
+        self._conversation_starts = []
+        self._length = 0
+
+    def __len__(self):
+        return len(self.conversation_offsets) - 1 if self.data is not None else len(self._conversation_starts)
+
+    def append(self, conversation):
+        """
+        Add a structured conversation.
+
+        Args:
+            - conversation (list(dict)): messages as single-key dicts, eg: {'customer': '...'}
+
+        Returns:
+            - index (int): position of the conversation in the store
+        """
+        self._conversation_starts.append(len(self._message_starts))
+        for message in conversation:
+            (role, content), = message.items()
+            code = self.role_codes.get(role)
+            if code is None:
+                code = self.role_codes[role] = len(self.roles)
+                self.roles.append(role)
+            piece = f' {content}'.encode('utf-8')
+            self._message_starts.append(self._length)
+            self._message_roles.append(code)
+            self._pieces.append(piece)
+            self._length += len(piece)
+        return len(self._conversation_starts) - 1
+
+    def freeze(self):
+        """Pack everything appended so far, after which the store is read-only"""
+        if len(self.roles) > 256:
+            raise ValueError(f'{len(self.roles)} roles do not fit one-byte role codes')
+        self.data = b''.join(self._pieces)
+        self.message_offsets = np.array(self._message_starts + [self._length], dtype=np.int64)
+        self.message_roles = np.array(self._message_roles, dtype=np.uint8)
+        self.conversation_offsets = np.array(
+            self._conversation_starts + [len(self._message_starts)], dtype=np.int64
+        )
+        self._pieces = self._message_starts = self._message_roles = self._conversation_starts = None
+        return self
+
+    def conversation(self, index):
+        return Conversation(self, index)
+
+    def transcript_view(self, index):
+        """Zero-copy UTF-8 view of the joined text of a conversation"""
+        first, last = self.conversation_offsets[index], self.conversation_offsets[index + 1]
+        return memoryview(self.data)[self.message_offsets[first]:self.message_offsets[last]]
+
+    def transcript(self, index):
+        """Joined text of a conversation, as `build_conversation_text` builds it, decoded from one slice"""
+        return str(self.transcript_view(index), 'utf-8')
+
+    def messages(self, index):
+        """Message texts of a conversation"""
+        first, last = self.conversation_offsets[index], self.conversation_offsets[index + 1]
+        offsets = self.message_offsets[first:last + 1].tolist()
+        data = memoryview(self.data)
+        return [str(data[start + 1:end], 'utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def message_roles_of(self, index):
+        """Role names of the messages of a conversation"""
+        first, last = self.conversation_offsets[index], self.conversation_offsets[index + 1]
+        return [self.roles[code] for code in self.message_roles[first:last].tolist()]
+
+    def nbytes(self):
+        """Approximate memory held by the packed store"""
+        arrays = self.message_offsets.nbytes + self.message_roles.nbytes + self.conversation_offsets.nbytes
+        return len(self.data) + arrays
+
+
+class Conversation:
+    """
+    Read-only view of one conversation of a `ConversationStore`.
+
+    Iterating it yields the original single-key message dicts, so code written
+    for structured records keeps working, while `text()`, `view()` and
+    `messages()` read straight from the store.
+    """
+
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __len__(self):
+        return int(self.store.conversation_offsets[self.index + 1] - self.store.conversation_offsets[self.index])
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __eq__(self, other):
+        if isinstance(other, Conversation):
+            other = other.to_list()
+        return self.to_list() == other
+
+    def __reduce__(self):
+        # Ship only this conversation to other processes, as its structured form, not the whole store
+        return list, (self.to_list(),)
+
+    def __repr__(self):
+        return f'Conversation({self.to_list()!r})'
+
+    def text(self):
+        return self.store.transcript(self.index)
+
+    def view(self):
+        return self.store.transcript_view(self.index)
+
+    def messages(self):
+        return self.store.messages(self.index)
+
+    def roles(self):
+        return self.store.message_roles_of(self.index)
+
+    def to_list(self):
+        """Back to the structured form, eg: for writing out"""
+        return [{role: content} for role, content in zip(self.roles(), self.messages())]
+
+
+def to_json(value):
+    """`json` fallback writing `Conversation` views in their structured form"""
+    if isinstance(value, Conversation):
+        return value.to_list()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def compact_records(records, fields=CONVERSATION_FIELDS):
+    """
+    Move the conversations of records into one `ConversationStore` per field.
+
+    Records are consumed one at a time and their conversation lists are dropped
+    as soon as they are packed, so a whole corpus can be loaded compactly
+    straight from `iter_records`.
+
+    Args:
+        - records (iterable(dict)): structured records
+        - fields (tuple(str)): record fields holding conversations
+
+    Returns:
+        - records (list(dict)): the same records, in order, with every conversation
+            replaced by a `Conversation` view
+    """
+    # Step 1: Pack every conversation, keeping its position in place of the list
+    stores = {field: ConversationStore() for field in fields}
+    compacted = []
+    for record in records:
+        for field, store in stores.items():
+            if field in record and not isinstance(record[field], Conversation):
+                record[field] = store.append(record[field])
+        compacted.append(record)
+
+    # Step 2: Swap the positions for views of the packed stores
+    for store in stores.values():
+        store.freeze()
+    for record in compacted:
+        for field, store in stores.items():
+            if isinstance(record.get(field), int):
+                record[field] = store.conversation(record[field])
+    return compacted
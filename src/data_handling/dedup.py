@@ -0,0 +1,283 @@
+import re
+import zlib
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from functools import lru_cache
+import numpy as np
+
+from src.evaluations.batch_scoring import build_texts
+
+DEDUP_MODES = ('exact', 'near')
+# Texts a scored tuple is made of, each one has to be a near-duplicate on its own
+TUPLE_FIELDS = ('prev', 'source', 'ai', 'human')
+WORD_RE = re.compile(r'\w+')
+SHINGLE_WORDS = 3
+# Odd multipliers mixing the word hashes of a shingle, one per position
+SHINGLE_MULTIPLIERS = tuple(np.uint64(multiplier) for multiplier in (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D))
+HASH_MASK = np.uint64(0xFFFFFFFF)
+HASH_PRIME = 4294967311  # smallest prime above 2 ** 32
+MIN_DETECTION = 0.99
+# Representatives kept in the index, a few KB each with their signature and scores
+MAX_CLUSTERS = 100000
+
+
+def exact_key(texts):
+    """Digest of the raw texts of a tuple, equal only for byte-identical tuples"""
+    return hashlib.sha1('\0'.join(texts[field] for field in TUPLE_FIELDS).encode('utf-8')).digest()
+
+
+@lru_cache(maxsize=1 << 20)
+def word_hash(word):
+    return zlib.crc32(word.encode('utf-8'))
+
+
+def shingle_hashes(text):
+    """
+    32-bit hashes of the lower-cased word 3-grams of a text.
+
+    Words are hashed once each (memoized, support replies reuse a small
+    vocabulary) and every 3-gram hash is mixed from its word hashes in NumPy.
+
+    Args:
+        - text (str)
+
+    Returns:
+        - hashes (np.ndarray): unique uint64 shingle hashes, at least one even for an empty text
+    """
+    words = WORD_RE.findall(text.lower())
+    hashes = np.array(list(map(word_hash, words)), dtype=np.uint64)
+    if len(words) < SHINGLE_WORDS:
+        return np.array([zlib.crc32(' '.join(words).encode('utf-8'))], dtype=np.uint64)
+    shingles = np.zeros(len(words) - SHINGLE_WORDS + 1, dtype=np.uint64)
+    for offset, multiplier in enumerate(SHINGLE_MULTIPLIERS):
+        shingles ^= (hashes[offset:len(hashes) - SHINGLE_WORDS + 1 + offset] * multiplier) & HASH_MASK
+    return np.unique(shingles)
+
+
+def lsh_params(threshold, num_perm, fields=len(TUPLE_FIELDS)):
+    """
+    Rows per band for the LSH index, as many as still find duplicates at `threshold`.
+
+    A band holds `rows` signature values of every field, so two tuples whose
+    fields all have Jaccard similarity s share a band with probability
+    s ** (rows * fields). More rows mean fewer candidates to verify.
+
+    Returns:
+        - bands (int)
+        - rows (int)
+    """
+    best = 1
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** (rows * fields)) ** bands >= MIN_DETECTION:
+            best = rows
+    return num_perm // best, best
+
+
+class Deduplicator:
+    """
+    Clusters exact and near-duplicate (context, source, ai_response, human_response) tuples.
+
+    Records are assigned in arrival order: the first record of a cluster is its
+    representative and is the only one scored, later members reuse its scores.
+    'exact' mode only groups tuples whose four texts are byte-identical. 'near'
+    mode also groups tuples whose every text has an estimated Jaccard similarity
+    of word 3-grams of at least `threshold` with the representative, found with
+    MinHash signatures and an LSH index over representatives.
+
+    Clusters are numbered internally, so records sharing an id never share a
+    cluster by accident. Each cluster is written out under the id of its
+    representative, which is kept in memory along with its signature and scores.
+
+    Memory stays flat on streams of any length: only the `max_clusters` most
+    recently matched representatives are indexed. Older ones are dropped from
+    the index, and their id and scores as soon as no assigned record still waits
+    for them, so a later duplicate of a dropped cluster opens a new cluster and is
+    scored again. `assign` and `fan_out` may be called from different threads.
+
+    Args:
+        - mode (str): 'exact' or 'near'
+        - threshold (float): minimum per-text Jaccard similarity of near-duplicates
+        - num_perm (int): MinHash permutations per text
+        - seed (int): seed of the permutations
+        - max_clusters (int): representatives kept in the index
+    """
+
+    def __init__(self, mode='near', threshold=0.9, num_perm=64, seed=0, max_clusters=MAX_CLUSTERS):
+        if mode not in DEDUP_MODES:
+            raise ValueError(f'mode must be one of {DEDUP_MODES}, got {mode!r}')
+        self.mode = mode
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        rng = np.random.RandomState(seed)
+        self.perm_a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.perm_b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.max_clusters = max_clusters
+        self.lock = threading.Lock()
+        # Indexed clusters, least recently matched first, with the exact keys pointing to them
+        self.window = OrderedDict()
+        self.exact_clusters = {}
+        self.buckets = {}
+        self.signatures = {}
+        self.cluster_ids = {}
+        self.results = {}
+        # Assigned records of every cluster not fanned out yet
+        self.pending = Counter()
+        self.next_cluster = 0
+        self.records = 0
+        self.duplicates = 0
+        self.evicted = 0
+
+    def signature(self, texts):
+        """MinHash signature of every text of a tuple, shape (fields, num_perm)"""
+        signature = np.empty((len(TUPLE_FIELDS), self.num_perm), dtype=np.uint64)
+        for row, field in enumerate(TUPLE_FIELDS):
+            hashes = shingle_hashes(texts[field])
+            # a * x + b stays below 2 ** 64 for 32-bit a, b and x
+            permuted = (self.perm_a[:, None] * hashes[None, :] + self.perm_b[:, None]) % HASH_PRIME
+            signature[row] = permuted.min(axis=1)
+        return signature
+
+    def band_keys(self, signature):
+        for band in range(self.bands):
+            rows = signature[:, band * self.rows:(band + 1) * self.rows]
+            yield band, rows.tobytes()
+
+    def match(self, signature):
+        """Cluster of the first indexed representative every text of which is similar enough, if any"""
+        seen = set()
+        for key in self.band_keys(signature):
+            for candidate in self.buckets.get(key, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                similarity = (self.signatures[candidate] == signature).mean(axis=1)
+                if similarity.min() >= self.threshold:
+                    return candidate
+        return None
+
+    def add(self, signature, cluster):
+        self.signatures[cluster] = signature
+        for key in self.band_keys(signature):
+            self.buckets.setdefault(key, []).append(cluster)
+
+    def evict(self):
+        """Drop the least recently matched cluster from the index, and its results once fanned out"""
+        cluster, keys = self.window.popitem(last=False)
+        for key in keys:
+            del self.exact_clusters[key]
+        signature = self.signatures.pop(cluster, None)
+        if signature is not None:
+            for key in self.band_keys(signature):
+                bucket = self.buckets[key]
+                bucket.remove(cluster)
+                if not bucket:
+                    del self.buckets[key]
+        if not self.pending[cluster]:
+            self.release(cluster)
+        self.evicted += 1
+
+    def release(self, cluster):
+        del self.pending[cluster]
+        self.cluster_ids.pop(cluster, None)
+        self.results.pop(cluster, None)
+
+    def assign(self, records):
+        """
+        Put every record in a cluster.
+
+        Args:
+            - records (list(dict)): structured records
+
+        Returns:
+            - clusters (list(int)): cluster number of every record
+            - representatives (list(int)): positions of the records that opened a new cluster
+        """
+        clusters, representatives = [], []
+        for position, record in enumerate(records):
+            texts = build_texts(record)
+            key = exact_key(texts)
+            # The index is only changed here, the lock guards what `fan_out` shares
+            cluster = self.exact_clusters.get(key)
+            signature = None
+            if cluster is None and self.mode == 'near':
+                signature = self.signature(texts)
+                cluster = self.match(signature)
+            with self.lock:
+                if cluster is None:
+                    cluster = self.next_cluster
+                    self.next_cluster += 1
+                    self.cluster_ids[cluster] = str(record.get('id', self.records + position))
+                    self.window[cluster] = []
+                    representatives.append(position)
+                    if signature is not None:
+                        self.add(signature, cluster)
+                else:
+                    self.window.move_to_end(cluster)
+                if key not in self.exact_clusters:
+                    self.exact_clusters[key] = cluster
+                    self.window[cluster].append(key)
+                self.pending[cluster] += 1
+                while len(self.window) > self.max_clusters:
+                    self.evict()
+            clusters.append(cluster)
+        self.records += len(records)
+        self.duplicates += len(records) - len(representatives)
+        return clusters, representatives
+
+    def score(self, records, score):
+        """
+        Score the representatives among `records` and fan their results out to the duplicates.
+
+        Every record gets a 'duplicate_cluster_id'.
+
+        Args:
+            - records (list(dict)): structured records
+            - score (callable): scores a list of records, eg: `ScoringEngine.score`
+
+        Returns:
+            - results (list(tuple)): (scores, score) per record, in input order
+        """
+        clusters, representatives = self.assign(records)
+        scored = score([records[position] for position in representatives]) if representatives else []
+        return self.fan_out(records, clusters, representatives, scored)
+
+    def fan_out(self, records, clusters, representatives, scored):
+        """
+        Remember the results of newly scored representatives and hand every record its cluster's.
+
+        Split from `score` for callers that score the representatives themselves, as
+        `ScoringPipeline` does: records must be fanned out in the order they were assigned.
+
+        Args:
+            - records (list(dict)): records passed to `assign`
+            - clusters (list(int)), representatives (list(int)): as returned by `assign`
+            - scored (list(tuple)): (scores, score) of every representative
+
+        Returns:
+            - results (list(tuple)): (scores, score) per record, in input order
+        """
+        results = []
+        with self.lock:
+            for position, result in zip(representatives, scored):
+                self.results[clusters[position]] = result
+            for record, cluster in zip(records, clusters):
+                record['duplicate_cluster_id'] = self.cluster_ids[cluster]
+                results.append(self.results[cluster])
+                self.pending[cluster] -= 1
+                if not self.pending[cluster] and cluster not in self.window:
+                    self.release(cluster)
+        return results
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'threshold': self.threshold if self.mode == 'near' else None,
+            'records': self.records,
+            'clusters': self.records - self.duplicates,
+            'duplicates': self.duplicates,
+            'duplicate_rate': self.duplicates / self.records if self.records else None,
+            'evicted_clusters': self.evicted,
+        }
@@ -0,0 +1,166 @@
+import os
+import re
+import json
+import random
+
+from src.data_handling.columnar_store import COLUMNAR_SUFFIX, ColumnarScores, ColumnarWriter
+from src.data_handling.conversation_store import compact_records, to_json
+
+READ_BLOCK_SIZE = 1 << 20  # 1 MB
+SEPARATOR_RE = re.compile(r'[\s,]*')
+
+
+def iter_records(path):
+    """Stream records from a JSONL file or a JSON array file, one at a time
+
+    JSON arrays (as written by structure_builder.py) are decoded incrementally
+    from fixed-size blocks, so the whole file is never held in memory.
+
+    Args:
+        - path (str): `.jsonl` file with one record per line, a `.json` array, or a
+            `.columns` directory written by `ColumnarWriter`
+
+    Yields:
+        - record (dict)
+    """
+    if path.rstrip('/').endswith(COLUMNAR_SUFFIX):
+        yield from ColumnarScores(path).records()
+        return
+    if path.endswith('.jsonl'):
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        buffer = f.read(READ_BLOCK_SIZE)
+        pos = SEPARATOR_RE.match(buffer).end()
+        if buffer[pos:pos + 1] != '[':
+            raise ValueError(f'{path} is neither a JSON array nor a .jsonl file')
+        pos += 1
+        eof = False
+        while True:
+            # Step 1: Skip separators between records
+            pos = SEPARATOR_RE.match(buffer, pos).end()
+            if buffer.startswith(']', pos):
+                return
+            # Step 2: Decode the next record, reading more when it is cut off
+            try:
+                record, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                block = f.read(READ_BLOCK_SIZE)
+                eof = not block
+                buffer = buffer[pos:] + block
+                pos = 0
+                continue
+            yield record
+
+
+def load_records(path):
+    """Load every record of a file into memory, conversations packed by `compact_records`"""
+    return compact_records(iter_records(path))
+
+
+def iter_chunks(records, chunk_size):
+    """Group an iterable of records into lists of at most `chunk_size` records"""
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def sample_records(path, sample_size=1000, seed=0):
+    """Reservoir-sample records of a structured file, holding at most `sample_size` of them in memory
+
+    Args:
+        - path (str): any file `iter_records` reads
+        - sample_size (int): number of records to sample
+        - seed (int): seed of the sampler
+
+    Returns:
+        - sample (list(dict)): every record if there are at most `sample_size`, in no particular order otherwise
+    """
+    rng = random.Random(seed)
+    sample = []
+    for count, record in enumerate(iter_records(path)):
+        if count < sample_size:
+            sample.append(record)
+        else:
+            slot = rng.randint(0, count)
+            if slot < sample_size:
+                sample[slot] = record
+    return sample
+
+
+class JsonlWriter:
+    """Append records to a JSONL file, one line per record
+
+    Args:
+        - path (str): output file
+        - append (bool): keep existing lines instead of truncating the file
+    """
+
+    def __init__(self, path, append=False):
+        self.f = open(path, 'a' if append else 'w')
+
+    def write(self, records):
+        for record in records:
+            self.f.write(json.dumps(record, default=to_json))
+            self.f.write('\n')
+        self.f.flush()
+
+    def tell(self):
+        return self.f.tell()
+
+    def sync(self):
+        """Flush and fsync, so everything written so far survives a crash"""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+class JsonArrayWriter:
+    """Write records as a JSON array incrementally
+
+    The output is byte for byte what `json.dump(records, f, indent=4)` writes.
+
+    Args:
+        - path (str): output file
+    """
+
+    def __init__(self, path):
+        self.f = open(path, 'w')
+        self.count = 0
+
+    def write(self, records):
+        for record in records:
+            self.f.write('[\n' if not self.count else ',\n')
+            self.f.write('\n'.join(f'    {line}' for line in json.dumps(record, indent=4, default=to_json).split('\n')))
+            self.count += 1
+        self.f.flush()
+
+    def close(self):
+        self.f.write('\n]' if self.count else '[]')
+        self.f.close()
+
+
+def open_writer(path, append=False, texts=True):
+    """JSONL writer for `.jsonl` paths, columnar writer for `.columns` directories, JSON array writer otherwise
+
+    `texts` only applies to columnar output: False keeps the score columns and ids only.
+    """
+    if path.rstrip('/').endswith(COLUMNAR_SUFFIX):
+        return ColumnarWriter(path, texts=texts)
+    if path.endswith('.jsonl'):
+        return JsonlWriter(path, append=append)
+    return JsonArrayWriter(path)
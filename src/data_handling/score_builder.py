@@ -1,34 +1,61 @@
 """
 cd src/data_handling
 python score_builder.py
+python score_builder.py --input ../../data/structured_equal.json --output ../../data/scored_equal.jsonl
+python score_builder.py --input ../../data/structured_equal.json --output ../../data/scored_equal.columns --no-texts  # memory-mappable score columns
+python score_builder.py --resume  # pick up an interrupted run where its last checkpoint left off
+python score_builder.py --workers 8  # shard scoring across 8 processes, one model each
+python score_builder.py --pipeline --lexical-workers 4  # overlap reading, tokenization, inference, VADER/BLEU/ROUGE and writing
+python score_builder.py --dedup near --dedup-threshold 0.9  # score one tuple per near-duplicate cluster
+python score_builder.py --memo ../../data/metric_memo.sqlite  # re-runs only recompute metrics whose inputs changed
+python score_builder.py --input ../../data/structured_equal.json --output ../../data/lexical.jsonl --metrics responses_bleu responses_rouge  # no embedding model
+python score_builder.py --weights ../../data/best_weights.json  # final score weighted as tuned by weight_sweep.py
+python score_builder.py --max-tokens 16384  # batch texts under a padded token budget, prints padding efficiency and tokens/sec
+python score_builder.py --conversation-pooling recency  # embed long conversations as chunks pooled toward the latest turns
+python score_builder.py --profile --trace ../../data/scoring.trace.json  # per-stage latency report and a Chrome trace
+python score_builder.py --backend onnx-int8:../../models/bge-base-en-v1.5-onnx  # quantized ONNX Runtime on CPU
+python score_builder.py --embedding-storage int8:pca256 --projection ../../models/pca256.npy  # 260 bytes per cached vector instead of 3 KB
 """
 
+import re
 import sys
 import os
 import json
+import argparse
+from collections import deque
+from functools import partial
 from tqdm import tqdm
-from sentence_transformers import SentenceTransformer
-from nltk.translate.bleu_score import sentence_bleu
 
 sys.path.append(os.path.abspath('../../'))
-from src.metrics.compute_cosine import compute_similarity
-from src.metrics.compute_empathy import measure_empathy
-from src.metrics.compute_rouge import compute_rouge_scores
-from src.metrics.utils import compute_eval_score_for_response
+from src.data_handling.checkpoint import Checkpoint
+from src.data_handling.conversation_store import compact_records
+from src.data_handling.dedup import DEDUP_MODES, MAX_CLUSTERS, Deduplicator
+from src.data_handling.record_io import iter_records, iter_chunks, open_writer, JsonlWriter
+from src.evaluations.engine import ScoringEngine
+from src.evaluations.metric_graph import METRICS, MetricGraph, MetricMemo
+from src.evaluations.pipeline import ScoringPipeline
+from src.metrics.chunked_embeddings import CHUNK_POOLINGS, ConversationChunker
+from src.metrics.embedding_backends import DEFAULT_BACKEND
+from src.metrics.embedding_compression import load_codec
+from src.metrics.profiling import profiler, iter_profiled
+from src.metrics.utils import load_weights
 
 data_path = '../../data'
 
 
-# Step 1: Read data from the structured JSON files for equal data
-with open(f'{data_path}/structured_equal.json', 'r') as f:
-    equal_data = json.load(f)  # Load the data from JSON file into a Python list
+def embedding_cache_dir(backend, codec=None):
+    """On-disk embedding cache of a backend, a cache directory only holds vectors of one dimension and storage mode"""
+    names = [backend] if backend != DEFAULT_BACKEND else []
+    if codec is not None:
+        names.append(codec.key)
+    if not names:
+        return f'{data_path}/embedding_cache'
+    cache_name = re.sub(r'[^A-Za-z0-9]+', '_', '_'.join(names)).strip('_')
+    return f'{data_path}/embedding_cache_{cache_name}'
 
-# Step 2: Read data from the structured JSON files for non-equal data
-with open(f'{data_path}/structured_non_equal.json', 'r') as f:
-    non_equal_data = json.load(f)
 
-# Step 3: Load model for computing embeddings
-model = SentenceTransformer('BAAI/bge-base-en-v1.5')
+# The model is loaded and the embedding cache opened only once something is scored
+engine = ScoringEngine(DEFAULT_BACKEND, cache_dir=embedding_cache_dir(DEFAULT_BACKEND))
 
 
 """
@@ -53,86 +80,266 @@ AI-H :
 
 
 
-def compute_scores_for_bulk_data(data_obj):
-    for idx in tqdm(range(len(data_obj))):
-        scores = {}
-        # Concatenate previous context messages into a single string
-        prev = data_obj[idx]['prev_context_conversation']
-        prev_conversation_text = ''
-        for msg in prev:
-            prev_conversation_text += f' {list(msg.values())[0]}'
-
-        # Concatenate source conversation messages into a single string
-        source = data_obj[idx]['source_conversation']
-        source_conversation_text = ''
-        for msg in source:
-            source_conversation_text += f' {list(msg.values())[0]}'
-
-        # AI and human responses
-        ai_response = data_obj[idx]['ai_response']
-        human_response = data_obj[idx]['human_response']
-
-        # Compute cosine similarity between source and previous context texts
-        source_context_similarity = compute_similarity(model, source_conversation_text, prev_conversation_text)
-        scores['source_context_similarity'] = float(source_context_similarity)
-
-        # Compute empathy and similarity for AI's response with the previous context
-        ai_prev_conversation_text = prev_conversation_text + ai_response
-        ai_context_empathy = measure_empathy(ai_prev_conversation_text)
-        scores['ai_context_empathy'] = float(ai_context_empathy)
-
-        ai_context_similarity = compute_similarity(model, prev_conversation_text, ai_response)
-        scores['ai_context_similarity'] = float(ai_context_similarity)
-
-        # Compute empathy and similarity for Human's response with the previous context
-        human_prev_conversation_text = prev_conversation_text + human_response
-        human_context_empathy = measure_empathy(human_prev_conversation_text)
-        scores['human_context_empathy'] = float(human_context_empathy)
-
-        human_context_similarity = compute_similarity(model, prev_conversation_text, human_response)
-        scores['human_context_similarity'] = float(human_context_similarity)
-
-        # Compute empathy and similarity for AI's response with the source context
-        ai_source_conversation_text = source_conversation_text + ai_response
-        ai_source_empathy = measure_empathy(ai_source_conversation_text)
-        scores['ai_source_empathy'] = float(ai_source_empathy)
-
-        ai_source_similarity = compute_similarity(model, source_conversation_text, ai_response)
-        scores['ai_source_similarity'] = float(ai_source_similarity)
-
-        # Compute empathy and similarity for Human's response with the source context
-        human_source_conversation_text = source_conversation_text + human_response
-        human_source_empathy = measure_empathy(human_source_conversation_text)
-        scores['human_source_empathy'] = float(human_source_empathy)
-
-        human_source_similarity = compute_similarity(model, source_conversation_text, human_response)
-        scores['human_source_similarity'] = float(human_source_similarity)
-
-        # Compute similarity, ROUGE scores, and BLEU score between AI's and Human's responses
-        responses_similarity = compute_similarity(model, ai_response, human_response)
-        scores['responses_similarity'] = float(responses_similarity)
-
-        responses_rouge = compute_rouge_scores(ai_response, human_response)
-        scores['responses_rouge'] = {}
-        scores['responses_rouge']['rouge1'] = float(responses_rouge['rouge1'].fmeasure)
-        scores['responses_rouge']['rouge2'] = float(responses_rouge['rouge2'].fmeasure)
-        scores['responses_rouge']['rougeL'] = float(responses_rouge['rougeL'].fmeasure)
-
-        responses_bleu = sentence_bleu([ai_response], human_response, weights=(0.25,0.25,0.25,0.25))
-        scores['responses_bleu'] = float(responses_bleu)
-
-        score = compute_eval_score_for_response(**scores)
-
-        data_obj[idx]['scores'] = scores
-        data_obj[idx]['score'] = score
+def score_chunk(chunk, engine=engine, executor=None, dedup=None, graph=None, metrics=None):
+    # Score a whole chunk at once so every unique text is embedded only once
+    if graph is not None:
+        score = partial(graph.score, metrics=metrics)
+    else:
+        score = executor.score if executor is not None else engine.score
+    with profiler.span('score_chunk', len(chunk)):
+        results = dedup.score(chunk, score) if dedup is not None else score(chunk)
+    return attach_scores(chunk, results)
+
+
+def attach_scores(chunk, results):
+    for data_point, (scores, score) in zip(chunk, results):
+        data_point['scores'] = scores
+        if score is not None:
+            data_point['score'] = score
+    return chunk
+
+
+def score_chunks_in_workers(chunks, executor, dedup=None):
+    """
+    Score a stream of chunks across worker processes, the next chunk submitted before the current one is collected.
+
+    Args:
+        - chunks (iterable(list(dict))): structured records
+        - executor (ScoringExecutor)
+        - dedup (Deduplicator): only send the representatives of every chunk, assigned as it is submitted
+
+    Yields:
+        - chunk (list(dict)): every chunk with its scores, in input order
+    """
+    pending = deque()
+
+    def to_score():
+        for chunk in chunks:
+            assignment = dedup.assign(chunk) if dedup is not None else None
+            pending.append((chunk, assignment))
+            yield [chunk[position] for position in assignment[1]] if assignment is not None else chunk
+
+    for scored in executor.score_chunks(to_score()):
+        chunk, assignment = pending.popleft()
+        if assignment is not None:
+            scored = dedup.fan_out(chunk, *assignment, scored)
+        yield attach_scores(chunk, scored)
+
+
+def compute_scores_for_bulk_data(data_obj, chunk_size=1024, engine=engine, workers=None, dedup=None):
+    executor = engine.executor(workers) if workers else None
+    chunks = (data_obj[start:start + chunk_size] for start in range(0, len(data_obj), chunk_size))
+    total = -(-len(data_obj) // chunk_size)
+    try:
+        if executor is not None:
+            for _ in tqdm(score_chunks_in_workers(chunks, executor, dedup=dedup), total=total):
+                pass
+        else:
+            for chunk in tqdm(chunks, total=total):
+                score_chunk(chunk, engine=engine, dedup=dedup)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        engine.close()
 
     return data_obj
 
 
-data_obj = compute_scores_for_bulk_data(equal_data)
-with open(f'{data_path}/scored_equal.json', 'w') as f:
-    json.dump(data_obj, f, indent=4)
-
-data_obj = compute_scores_for_bulk_data(non_equal_data)
-with open(f'{data_path}/scored_non_equal.json', 'w') as f:
-    json.dump(data_obj, f, indent=4)
+def score_file(input_path, output_path, chunk_size=1024, engine=engine, checkpoint_every=10000, resume=False,
+               workers=None, texts=True, dedup=None, graph=None, metrics=None, pipeline=None):
+    """Stream records from a structured file, score them in chunks and write them as they go
+
+    Memory stays bounded by `chunk_size` whatever the corpus size. Scored records
+    are appended to a JSONL file (`output_path` itself, or `<output_path>.partial.jsonl`
+    for `.json` and `.columns` outputs, converted once the run completes) and a
+    checkpoint is committed atomically every `checkpoint_every` records, along with
+    the embedding cache so a resumed run still finds what was embedded before.
+
+    Args:
+        - input_path (str): structured `.json` array or `.jsonl` file
+        - output_path (str): scored `.jsonl` or `.json` file, or a `.columns` directory of
+            memory-mappable score columns (see `ColumnarWriter`)
+        - chunk_size (int): number of records scored together
+        - engine (ScoringEngine): model, embedding cache and batching settings to score with
+        - checkpoint_every (int): records between checkpoints
+        - resume (bool): skip the ids already committed by an interrupted run, and the whole
+            file when a completed run already wrote `output_path`
+        - workers (int): score across this many processes, each loading its own model.
+            The embedding cache is only used in-process.
+        - texts (bool): write the conversations and responses along with the columns of a `.columns` output
+        - dedup (Deduplicator): score one record per duplicate cluster and copy its scores to the others.
+            Clusters do not span a resume: records already written are not indexed again.
+        - graph (MetricGraph): score through the memoized metric graph, in-process, instead of the engine
+        - metrics (list(str)): with `graph`, the metrics to compute, all of them if not set.
+            'score' is only written when it is computed.
+        - pipeline (ScoringPipeline): score with the stages overlapped, in-process, instead of chunk by chunk
+
+    Returns:
+        - batching_stats (dict): padding efficiency and tokens/sec of the run, when the engine has `max_tokens`
+    """
+    # Step 1: Work out what an interrupted run already scored
+    stream_path = output_path if output_path.endswith('.jsonl') else f'{output_path}.partial.jsonl'
+    if resume and stream_path != output_path and os.path.exists(output_path) and not os.path.exists(stream_path):
+        # The stream is only removed once converted, so this run already completed
+        print(f'{output_path} is already complete, skipping it', file=sys.stderr)
+        return None
+    checkpoint = Checkpoint(f'{stream_path}.checkpoint')
+    if resume:
+        done_ids = checkpoint.restore(input_path, stream_path)
+    else:
+        done_ids = set()
+        checkpoint.remove()
+    rows = len(done_ids)
+    records = (record for record in iter_records(input_path) if record.get('id') not in done_ids)
+    chunks = iter_profiled('io.read', (compact_records(chunk) for chunk in iter_chunks(records, chunk_size)))
+
+    # Step 2: Score chunk by chunk, committing a checkpoint every checkpoint_every records
+    writer = JsonlWriter(stream_path, append=resume)
+    executor = engine.executor(workers) if workers else None
+    scheduler = executor.scheduler if executor is not None else engine.scheduler
+    if scheduler is not None:
+        scheduler.reset_stats()
+    if pipeline is not None:
+        scored_chunks = pipeline.run(chunks, dedup=dedup)
+    elif executor is not None and graph is None:
+        scored_chunks = score_chunks_in_workers(chunks, executor, dedup=dedup)
+    else:
+        scored_chunks = (
+            score_chunk(chunk, engine=engine, executor=executor, dedup=dedup, graph=graph, metrics=metrics)
+            for chunk in chunks
+        )
+    try:
+        since_checkpoint = 0
+        with tqdm(unit='records', initial=rows) as progress:
+            for chunk in scored_chunks:
+                with profiler.span('io.write', len(chunk)):
+                    writer.write(chunk)
+                rows += len(chunk)
+                since_checkpoint += len(chunk)
+                progress.update(len(chunk))
+                if since_checkpoint >= checkpoint_every:
+                    with profiler.span('io.checkpoint'):
+                        writer.sync()
+                        checkpoint.save(input_path, writer.tell(), rows)
+                        engine.flush()
+                    since_checkpoint = 0
+        writer.sync()
+        checkpoint.save(input_path, writer.tell(), rows)
+    finally:
+        scored_chunks.close()
+        writer.close()
+        if executor is not None:
+            executor.shutdown()
+        engine.close()
+
+    # Step 3: Convert to a JSON array or to columns once every record is scored
+    if stream_path != output_path:
+        with profiler.span('io.convert', rows):
+            output_writer = open_writer(output_path, texts=texts)
+            for chunk in iter_chunks(iter_records(stream_path), chunk_size):
+                output_writer.write(chunk)
+            output_writer.close()
+            os.remove(stream_path)
+    checkpoint.remove()
+
+    return scheduler.stats() if scheduler is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score structured conversation records')
+    parser.add_argument('--input', help='structured .json or .jsonl file, defaults to both structured datasets')
+    parser.add_argument('--output', help='scored .json or .jsonl file or .columns directory, required with --input')
+    parser.add_argument('--no-texts', action='store_true', help='with a .columns output, keep only ids and scores')
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--checkpoint-every', type=int, default=10000, help='records between checkpoints')
+    parser.add_argument('--resume', action='store_true', help='skip ids already scored by an interrupted run')
+    parser.add_argument('--workers', type=int, help='number of scoring processes, each loading its own model')
+    parser.add_argument('--max-tokens', type=int, help='padded token budget per forward pass, replaces --batch-size')
+    parser.add_argument('--dedup', choices=DEDUP_MODES,
+                        help='score one tuple per cluster of exact or near duplicates, recording duplicate_cluster_id')
+    parser.add_argument('--dedup-threshold', type=float, default=0.9,
+                        help='minimum Jaccard similarity of every text of near-duplicate tuples')
+    parser.add_argument('--dedup-window', type=int, default=MAX_CLUSTERS,
+                        help='most recently matched clusters kept in memory, older duplicates are scored again')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='run reading, tokenization, inference, lexical metrics and writing concurrently')
+    parser.add_argument('--lexical-workers', type=int, default=2,
+                        help='with --pipeline, processes computing empathy, BLEU and ROUGE')
+    parser.add_argument('--queue-depth', type=int, default=2, help='with --pipeline, chunks queued between stages')
+    parser.add_argument('--memo', help='SQLite file memoizing every metric by a hash of its inputs')
+    parser.add_argument('--metrics', nargs='+', choices=METRICS,
+                        help='only compute these metrics, the embedding model is not loaded without similarities')
+    parser.add_argument('--conversation-pooling', choices=CHUNK_POOLINGS,
+                        help='embed conversations as message chunks pooled this way instead of truncating them')
+    parser.add_argument('--recency-decay', type=float, default=0.5, help='chunk weight ratio for recency pooling')
+    parser.add_argument('--weights', help='JSON file of final score weights, defaults to the constants in utils.py')
+    parser.add_argument('--profile', action='store_true',
+                        help='time every stage, print a report and write it next to the output as .profile.json')
+    parser.add_argument('--trace', help='also write a Chrome trace of every timed span to this file')
+    parser.add_argument('--backend', default=DEFAULT_BACKEND,
+                        help='embedding backend, eg: onnx-int8:<model_dir>, defaults to PyTorch bge-base')
+    parser.add_argument('--embedding-storage',
+                        help='cache and compare embeddings as float16, int8, int8:<dims> or int8:pca<dims>')
+    parser.add_argument('--projection', help='PCA projection of pca storage modes, see embedding_compression.py fit')
+    args = parser.parse_args()
+
+    chunker = None
+    if args.conversation_pooling:
+        chunker = ConversationChunker(pooling=args.conversation_pooling, recency_decay=args.recency_decay)
+    codec = load_codec(args.embedding_storage, args.projection) if args.embedding_storage else None
+    run_engine = ScoringEngine(
+        args.backend, cache_dir=embedding_cache_dir(args.backend, codec), batch_size=args.batch_size,
+        max_tokens=args.max_tokens, chunker=chunker, weights=load_weights(args.weights) if args.weights else None,
+        codec=codec,
+    )
+    graph = None
+    if args.memo or args.metrics:
+        if args.workers:
+            parser.error('--memo and --metrics score in-process, they do not combine with --workers')
+        graph = MetricGraph(run_engine, MetricMemo(args.memo) if args.memo else None)
+    pipeline = None
+    if args.pipeline:
+        if args.workers or graph is not None:
+            parser.error('--pipeline scores in-process, it does not combine with --workers, --memo or --metrics')
+        pipeline = ScoringPipeline(run_engine, lexical_workers=args.lexical_workers, depth=args.queue_depth)
+
+    if args.profile or args.trace:
+        profiler.enable(trace=bool(args.trace))
+
+    if args.input:
+        if not args.output:
+            parser.error('--output is required with --input')
+        jobs = [(args.input, args.output)]
+    else:
+        jobs = [
+            (f'{data_path}/structured_equal.json', f'{data_path}/scored_equal.json'),
+            (f'{data_path}/structured_non_equal.json', f'{data_path}/scored_non_equal.json'),
+        ]
+
+    for input_path, output_path in jobs:
+        # Duplicates are only looked for within one file
+        dedup = Deduplicator(args.dedup, threshold=args.dedup_threshold, max_clusters=args.dedup_window) if args.dedup else None
+        batching_stats = score_file(
+            input_path, output_path, chunk_size=args.chunk_size, engine=run_engine,
+            checkpoint_every=args.checkpoint_every, resume=args.resume, workers=args.workers,
+            texts=not args.no_texts, dedup=dedup, graph=graph, metrics=args.metrics, pipeline=pipeline,
+        )
+        if batching_stats is not None:
+            print(json.dumps(batching_stats, indent=4))
+        if dedup is not None:
+            print(json.dumps(dedup.stats(), indent=4))
+    if graph is not None:
+        print(json.dumps(graph.stats(), indent=4))
+        if graph.memo is not None:
+            graph.memo.close()
+
+    if profiler.enabled:
+        print(profiler.report(), file=sys.stderr)
+        profiler.write_summary(f'{jobs[-1][1]}.profile.json')
+        if args.trace:
+            profiler.write_trace(args.trace)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,44 @@
 import re
 
-# Defining the function to process the strings
+# Role markers of the raw conversations, mapped to the role each message is stored under
+SOURCE_ROLES = {'human_message:': 'human', 'ai_message:': 'ai'}
+CONTEXT_ROLES = {"Customer's Message:": 'customer', "Agent's Message:": 'agent'}
+
+
+def compile_markers(roles):
+    """Single regex matching any of the role markers, longest first"""
+    return re.compile('|'.join(re.escape(marker) for marker in sorted(roles, key=len, reverse=True)))
+
+
+SOURCE_MARKER_RE = compile_markers(SOURCE_ROLES)
+CONTEXT_MARKER_RE = compile_markers(CONTEXT_ROLES)
+
+
+def parse_conversation(conversation_str, marker_re, roles):
+    """Split a raw conversation into messages in one pass over its role markers
+
+    Every message runs from the end of its marker to the start of the next one,
+    text before the first marker is dropped.
+
+    Args:
+        - conversation_str (str): raw conversation text
+        - marker_re (re.Pattern): regex matching the markers, see `compile_markers`
+        - roles (dict): maps every marker to its role
+
+    Returns:
+        - conversation_list list(dict): messages as single-key dicts, eg: {'human': '...'}
+    """
+    conversation_list = []
+    role, content_start = None, 0
+    for match in marker_re.finditer(conversation_str):
+        if role is not None:
+            conversation_list.append({role: conversation_str[content_start:match.start()].strip()})
+        role, content_start = roles[match.group()], match.end()
+    if role is not None:
+        conversation_list.append({role: conversation_str[content_start:].strip()})
+    return conversation_list
+
+
 def source_conversation_data(conversation_str):
     """Given a raw conversation source text - build a structured conversation data
 
@@ -10,34 +48,7 @@ def source_conversation_data(conversation_str):
     Returns:
         - conversation_list list(dict): data object with human-ai annotated text
     """
-    # Step 1: Preprocess the string to insert a separator before 'human_message:' and 'ai_message:'
-    processed_str = re.sub(r"(human_message:|ai_message:)", r"|||\1", conversation_str)
-    
-    # Step 2: Splitting the string into segments based on our custom separator
-    segments = processed_str.split("|||")
-    
-    # Step 3: Remove the first empty segment if it exists
-    if segments[0] == '':
-        segments = segments[1:]
-    
-    # Step 4: Iterate through the segments and classify each as 'human' or 'ai'
-    conversation_list = []
-    for segment in segments:
-        # Step 5: Determine the type of message and extract content
-        if 'human_message:' in segment:
-            message_type = 'human'
-            content = segment.replace('human_message:', '').strip()
-        elif 'ai_message:' in segment:
-            message_type = 'ai'
-            content = segment.replace('ai_message:', '').strip()
-        else:
-            continue  # Ignore any segment that does not match expected patterns
-        
-        # Step 6: Append the structured dictionary to the list
-        conversation_list.append({message_type: content})
-    
-    # Step 7: Return the conversation_list
-    return conversation_list
+    return parse_conversation(conversation_str, SOURCE_MARKER_RE, SOURCE_ROLES)
 
 
 def context_conversation_data(conversation_str):
@@ -47,33 +58,6 @@ def context_conversation_data(conversation_str):
         - conversation_str (str): conversation source str object from csv
 
     Returns:
-        - conversation_list list(dict): data object with human-ai annotated text
+        - conversation_list list(dict): data object with customer-agent annotated text
     """
-    # Step 1: Preprocess the string to insert a separator before 'Customer's Message:' and 'Agent's Message:'
-    processed_str = re.sub(r"(Customer's Message:|Agent's Message:)", r"|||\1", conversation_str)
-    
-    # Step 2: Splitting the string into segments based on our custom separator
-    segments = processed_str.split("|||")
-    
-    # Step 3: Remove the first empty segment if it exists
-    if segments[0] == '':
-        segments = segments[1:]
-    
-    # Step 4: Iterate through the segments and classify each as 'human' or 'ai'
-    conversation_list = []
-    for segment in segments:
-        # Step 5: Determine the type of message and extract content
-        if "Customer's Message:" in segment:
-            message_type = 'customer'
-            content = segment.replace("Customer's Message:", '').strip()
-        elif "Agent's Message:" in segment:
-            message_type = 'agent'
-            content = segment.replace("Agent's Message:", '').strip()
-        else:
-            continue  # Ignore any segment that does not match expected patterns
-        
-        # Step 6: Append the structured dictionary to the list
-        conversation_list.append({message_type: content})
-    
-    # Step 7: Return the conversation_list
-    return conversation_list
+    return parse_conversation(conversation_str, CONTEXT_MARKER_RE, CONTEXT_ROLES)
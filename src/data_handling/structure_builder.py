@@ -1,56 +1,237 @@
-import json
+"""
+cd src/data_handling
+python structure_builder.py
+python structure_builder.py --input ../../data/cleaned_equal.csv --output ../../data/structured_equal.jsonl
+python structure_builder.py --input ../../data/raw_export.csv --output ../../data/structured_export.jsonl --workers 8  # shard by byte range
+"""
+
+import io
+import os
+import sys
 import csv
+import shutil
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-# Importing custom functions for processing conversation data
-from source_cleanup import source_conversation_data, context_conversation_data
+sys.path.append(os.path.abspath('../../'))
+from src.data_handling.record_io import iter_records, iter_chunks, open_writer
+from src.data_handling.source_cleanup import source_conversation_data, context_conversation_data
 
 # Define the path where the data files are stored
 data_path = '../../data'
 
-# Step 0: Declarations 
-equal_data = []
-non_equal_data = []
-equal_data_conversations_object = []
-non_equal_data_conversations_object = []
+READ_BLOCK_SIZE = 1 << 20  # 1 MB
+WRITE_CHUNK_SIZE = 1024
+MIN_SHARD_BYTES = 64 << 20  # 64 MB, smaller files are not worth a process
 
-# Step 1: Open and read the non-equal data CSV file
-with open(f'{data_path}/cleaned_non_equal.csv', 'r') as f:
-    reader = csv.reader(f, delimiter=',', quotechar='"')
-    for line in reader:
-        non_equal_data.append(line)  # Append each row to the list
 
-# Step 2: Open and read the equal data CSV file
-with open(f'{data_path}/cleaned_equal.csv', 'r') as f:
-    reader = csv.reader(f, delimiter=',', quotechar='"')
-    for line in reader:
-        equal_data.append(line)  # Append each row to the list
+def build_record(row):
+    """Structure one row of a cleaned CSV (id, prev_context, response, agent_response, sources)"""
+    data_object = {}  # Create a dictionary for each conversation
+    data_object['id'] = row[0]  # Store the unique identifier
+    data_object['prev_context_conversation'] = context_conversation_data(row[1])  # Process and store the previous context
+    data_object['ai_response'] = row[2]  # Store the AI response
+    data_object['human_response'] = row[3]  # Store the human response
+    data_object['source_conversation'] = source_conversation_data(row[4])  # Process and store the source conversation data
+    return data_object
 
 
-# Step 3: Process each row from the equal data except the header row
-for data in equal_data[1:]:
-    data_object = {}  # Create a dictionary for each conversation
-    data_object['id'] = data[0]  # Store the unique identifier
-    data_object['prev_context_conversation'] = context_conversation_data(data[1])  # Process and store the previous context
-    data_object['ai_response'] = data[2]  # Store the AI response
-    data_object['human_response'] = data[3]  # Store the human response
-    data_object['source_conversation'] = source_conversation_data(data[4])  # Process and store the source conversation data
-    equal_data_conversations_object.append(data_object)  # Append the dictionary to the list
-
-# Step 4: Write the structured data into a JSON file for equal data
-with open(f'{data_path}/structured_equal.json', 'w') as f:
-    json.dump(equal_data_conversations_object, f, indent=4)  # Serialize the list of dictionaries to JSON
-
-
-# Step 5: Process each row from the non-equal data except the header row
-for data in non_equal_data[1:]:
-    data_object = {}
-    data_object['id'] = data[0]
-    data_object['prev_context_conversation'] = context_conversation_data(data[1])
-    data_object['ai_response'] = data[2]
-    data_object['human_response'] = data[3]
-    data_object['source_conversation'] = source_conversation_data(data[4])
-    non_equal_data_conversations_object.append(data_object)
-
-# Step 6: Write the structured data into a JSON file for non-equal data
-with open(f'{data_path}/structured_non_equal.json', 'w') as f:
-    json.dump(non_equal_data_conversations_object, f, indent=4)
+def shard_offsets(path, shards):
+    """
+    Split a CSV into byte ranges that each start at the beginning of a row.
+
+    Quoted fields may hold newlines, so a newline only ends a row when an even
+    number of quotes precedes it. One pass counting quotes block by block finds,
+    after every target offset, the first newline that does.
+
+    Args:
+        - path (str): CSV file
+        - shards (int): number of ranges wanted
+
+    Returns:
+        - offsets (list(int)): range boundaries, from 0 to the file size. Ranges
+            may be fewer than `shards` when rows are long.
+    """
+    size = os.path.getsize(path)
+    targets = [size * shard // shards for shard in range(1, shards)]
+    offsets = [0]
+    quotes = 0
+    with open(path, 'rb') as f:
+        position = 0
+        while targets:
+            block = f.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            # Step 1: Look for a row boundary past the next target in this block
+            search_from = max(targets[0] - position, 0)
+            counted_to, counted = 0, quotes
+            while search_from < len(block):
+                newline = block.find(b'\n', search_from)
+                if newline < 0:
+                    break
+                counted += block.count(b'"', counted_to, newline)
+                counted_to = newline
+                if counted % 2 == 0:
+                    offsets.append(position + newline + 1)
+                    while targets and targets[0] < offsets[-1]:
+                        targets.pop(0)
+                    if not targets:
+                        break
+                    search_from = max(targets[0] - position, newline + 1)
+                else:
+                    search_from = newline + 1
+            # Step 2: Carry the quote parity over to the next block
+            quotes += block.count(b'"')
+            position += len(block)
+    if offsets[-1] < size:
+        offsets.append(size)
+    return offsets
+
+
+class _RangeReader(io.RawIOBase):
+    """Read-only view of a binary file that stops at byte `end`"""
+
+    def __init__(self, f, end=None):
+        self.f = f
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = len(buffer)
+        if self.end is not None:
+            size = min(size, self.end - self.f.tell())
+        if size <= 0:
+            return 0
+        return self.f.readinto(memoryview(buffer)[:size])
+
+
+def iter_rows(path, start=0, end=None):
+    """
+    Stream the CSV rows that start within [start, end) bytes of a file.
+
+    `start` and `end` must be row boundaries, as returned by `shard_offsets`.
+    Newlines are translated as in text mode, so fields match what
+    `open(path, 'r')` and `csv.reader` would produce.
+
+    Yields:
+        - row (list(str))
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = io.TextIOWrapper(io.BufferedReader(_RangeReader(f, end), READ_BLOCK_SIZE), encoding='utf-8')
+        yield from csv.reader(lines, delimiter=',', quotechar='"')
+
+
+def structure_range(input_path, output_path, start=0, end=None, skip_header=True):
+    """
+    Structure the rows of one byte range of a cleaned CSV, streaming them to `output_path`.
+
+    Args:
+        - input_path (str): cleaned CSV
+        - output_path (str): `.jsonl` or `.json` file
+        - start (int): first byte of the range
+        - end (int): byte after the range, end of file if not set
+        - skip_header (bool): drop the first row of the range
+
+    Returns:
+        - rows (int): number of records written
+    """
+    rows = iter_rows(input_path, start, end)
+    if skip_header:
+        next(rows, None)
+    writer = open_writer(output_path)
+    count = 0
+    try:
+        for chunk in iter_chunks((build_record(row) for row in rows), WRITE_CHUNK_SIZE):
+            writer.write(chunk)
+            count += len(chunk)
+    finally:
+        writer.close()
+    return count
+
+
+def _structure_shard(args):
+    return structure_range(*args)
+
+
+def structure_file(input_path, output_path, workers=1):
+    """
+    Convert a cleaned CSV into structured records without holding it in memory.
+
+    With several workers the file is cut into byte ranges on row boundaries,
+    each range is structured by its own process into a JSONL part and the parts
+    are then concatenated in order (or converted, for a `.json` output).
+
+    Args:
+        - input_path (str): cleaned CSV with a header row
+        - output_path (str): `.jsonl` or `.json` file
+        - workers (int): number of processes
+
+    Returns:
+        - rows (int): number of records written
+    """
+    # Step 1: Small files and single workers stream straight to the output
+    shards = min(workers, max(os.path.getsize(input_path) // MIN_SHARD_BYTES, 1))
+    if shards <= 1:
+        return structure_range(input_path, output_path)
+
+    # Step 2: Structure every byte range in parallel, each into its own JSONL part
+    offsets = shard_offsets(input_path, shards)
+    parts = [f'{output_path}.part{shard}.jsonl' for shard in range(len(offsets) - 1)]
+    tasks = [
+        (input_path, part, start, end, shard == 0)
+        for shard, (part, start, end) in enumerate(zip(parts, offsets[:-1], offsets[1:]))
+    ]
+    try:
+        with ProcessPoolExecutor(len(tasks), mp_context=multiprocessing.get_context('spawn')) as pool:
+            rows = sum(pool.map(_structure_shard, tasks))
+
+        # Step 3: Join the parts in file order
+        if output_path.endswith('.jsonl'):
+            with open(output_path, 'wb') as out:
+                for part in parts:
+                    with open(part, 'rb') as f:
+                        shutil.copyfileobj(f, out)
+        else:
+            writer = open_writer(output_path)
+            try:
+                for part in parts:
+                    for chunk in iter_chunks(iter_records(part), WRITE_CHUNK_SIZE):
+                        writer.write(chunk)
+            finally:
+                writer.close()
+    finally:
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Structure cleaned conversation CSVs into records')
+    parser.add_argument('--input', help='cleaned CSV, defaults to both cleaned datasets')
+    parser.add_argument('--output', help='structured .json or .jsonl file, required with --input')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes to shard large files across, by byte range')
+    args = parser.parse_args()
+
+    if args.input:
+        if not args.output:
+            parser.error('--output is required with --input')
+        jobs = [(args.input, args.output)]
+    else:
+        jobs = [
+            (f'{data_path}/cleaned_non_equal.csv', f'{data_path}/structured_non_equal.json'),
+            (f'{data_path}/cleaned_equal.csv', f'{data_path}/structured_equal.json'),
+        ]
+
+    for input_path, output_path in jobs:
+        rows = structure_file(input_path, output_path, workers=args.workers)
+        print(f'{input_path}: {rows} records -> {output_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+cd src/data_handling
+python synthetic_builder.py --count 10000 --output ../../data/synthetic_10k.json
+python synthetic_builder.py --count 100000 --output ../../data/synthetic_100k.jsonl --source-turns 4 20 --message-words 20 120
+"""
+
+import os
+import sys
+import uuid
+import random
+import argparse
+
+sys.path.append(os.path.abspath('../../'))
+from src.data_handling.record_io import open_writer
+
+# Vocabulary the messages are drawn from: support vocabulary plus words VADER
+# scores, so empathy is not trivially zero
+SUPPORT_WORDS = (
+    'order refund cancel delivery package tracking number account payment invoice address product item '
+    'return exchange replacement shipping courier warehouse bank card email phone ticket request update '
+    'status confirmation details days week today tomorrow team support store size colour price discount'
+).split()
+FILLER_WORDS = (
+    'i you we my your our the a an is are was will can could please to for of in on with and or but not '
+    'have has been it this that when how what why where as soon possible still yet already again'
+).split()
+SENTIMENT_WORDS = (
+    'thanks thank happy glad sorry apologize unfortunately great good bad terrible disappointed frustrated '
+    'appreciate kindly sadly delighted annoyed helpful quickly delay problem issue'
+).split()
+WORD_POOLS = (SUPPORT_WORDS, FILLER_WORDS, SENTIMENT_WORDS)
+WORD_POOL_WEIGHTS = (0.35, 0.5, 0.15)
+
+
+def generate_message(rng, word_range):
+    """A sentence-cased message of a length drawn from `word_range`"""
+    length = rng.randint(*word_range)
+    pools = rng.choices(WORD_POOLS, weights=WORD_POOL_WEIGHTS, k=length)
+    words = [rng.choice(pool) for pool in pools]
+    text = ' '.join(words)
+    return f'{text[:1].upper()}{text[1:]}{rng.choice(".!?.")}'
+
+
+def perturb_response(rng, response, overlap):
+    """Rewrite a response keeping each word with probability `overlap`, as a human edit of an AI draft"""
+    words = []
+    for word in response.split():
+        roll = rng.random()
+        if roll < overlap:
+            words.append(word)
+        elif roll < overlap + (1 - overlap) / 2:
+            words.append(rng.choice(rng.choices(WORD_POOLS, weights=WORD_POOL_WEIGHTS)[0]))
+    return ' '.join(words) or response
+
+
+def generate_conversation(rng, roles, turn_range, word_range):
+    return [{roles[turn % 2]: generate_message(rng, word_range)} for turn in range(rng.randint(*turn_range))]
+
+
+def generate_records(count, seed=0, prev_turns=(1, 6), source_turns=(2, 10), message_words=(5, 40),
+                     response_words=(20, 80), response_overlap=0.7):
+    """
+    Generate records in the schema structure_builder.py writes to `structured_*.json`.
+
+    The same arguments always produce the same records.
+
+    Args:
+        - count (int): number of records
+        - seed (int): seed of the generator
+        - prev_turns (tuple(int)): min and max messages of `prev_context_conversation`
+        - source_turns (tuple(int)): min and max messages of `source_conversation`
+        - message_words (tuple(int)): min and max words per conversation message
+        - response_words (tuple(int)): min and max words of `ai_response`
+        - response_overlap (float): share of `ai_response` words kept in `human_response`
+
+    Yields:
+        - record (dict)
+    """
+    rng = random.Random(seed)
+    for _ in range(count):
+        # Same key order as structure_builder.py
+        data_object = {}
+        data_object['id'] = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        data_object['prev_context_conversation'] = generate_conversation(
+            rng, ('customer', 'agent'), prev_turns, message_words
+        )
+        data_object['ai_response'] = generate_message(rng, response_words)
+        data_object['human_response'] = perturb_response(rng, data_object['ai_response'], response_overlap)
+        data_object['source_conversation'] = generate_conversation(rng, ('human', 'ai'), source_turns, message_words)
+        yield data_object
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic structured conversation records')
+    parser.add_argument('--count', type=int, required=True, help='number of records')
+    parser.add_argument('--output', required=True, help='.json array or .jsonl file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--prev-turns', type=int, nargs=2, default=(1, 6), metavar=('MIN', 'MAX'))
+    parser.add_argument('--source-turns', type=int, nargs=2, default=(2, 10), metavar=('MIN', 'MAX'))
+    parser.add_argument('--message-words', type=int, nargs=2, default=(5, 40), metavar=('MIN', 'MAX'))
+    parser.add_argument('--response-words', type=int, nargs=2, default=(20, 80), metavar=('MIN', 'MAX'))
+    parser.add_argument('--response-overlap', type=float, default=0.7)
+    args = parser.parse_args()
+
+    writer = open_writer(args.output)
+    try:
+        writer.write(generate_records(
+            args.count, seed=args.seed, prev_turns=args.prev_turns, source_turns=args.source_turns,
+            message_words=args.message_words, response_words=args.response_words,
+            response_overlap=args.response_overlap,
+        ))
+    finally:
+        writer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+import time
+from contextlib import contextmanager
+
+from src.data_handling.conversation_store import Conversation
+from src.metrics.compute_bleu import compute_bleu_scores_batch
+from src.metrics.compute_cosine import plan_encoding, run_encoding, compute_similarities
+from src.metrics.compute_empathy import measure_empathy_pairs
+from src.metrics.compute_rouge import compute_rouge_scores_batch
+from src.metrics.profiling import profiler
+from src.metrics.utils import scores_to_columns, compute_eval_scores_for_responses
+
+# Cosine pairs computed for every data point, as (source text, target text)
+SIMILARITY_PAIRS = {
+    'source_context_similarity': ('source', 'prev'),
+    'ai_context_similarity': ('prev', 'ai'),
+    'human_context_similarity': ('prev', 'human'),
+    'ai_source_similarity': ('source', 'ai'),
+    'human_source_similarity': ('source', 'human'),
+    'responses_similarity': ('ai', 'human'),
+}
+
+# Empathy is scored on a conversation with a response appended, as (conversation, response)
+EMPATHY_PAIRS = {
+    'ai_context_empathy': ('prev', 'ai'),
+    'human_context_empathy': ('prev', 'human'),
+    'ai_source_empathy': ('source', 'ai'),
+    'human_source_empathy': ('source', 'human'),
+}
+
+
+# Stages of `score_data_points`, in execution order
+SCORING_STAGES = ('texts', 'embedding', 'similarity', 'empathy', 'bleu', 'rouge', 'aggregation')
+
+
+@contextmanager
+def timed(timings, stage, size=None):
+    """Add the seconds spent in the block to timings[stage] and to the profiler, when either is on"""
+    if timings is None and not profiler.enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+        if profiler.enabled:
+            profiler.record(f'stage.{stage}', start, seconds, size)
+
+
+def build_conversation_text(conversation):
+    """Join a structured conversation into the flat string the metrics work on
+
+    Args:
+        - conversation (list(dict) or Conversation): messages as single-key dicts, eg: {'customer': '...'},
+            or a view of a `ConversationStore`
+
+    Returns:
+        - conversation_text (str): every message prefixed with a space
+    """
+    if isinstance(conversation, Conversation):
+        return conversation.text()
+    return ''.join(f' {message}' for message in conversation_messages(conversation))
+
+
+def conversation_messages(conversation):
+    """Message texts of a structured conversation, in the order `build_conversation_text` joins them"""
+    if isinstance(conversation, Conversation):
+        return conversation.messages()
+    return [list(msg.values())[0] for msg in conversation]
+
+
+def build_texts(data_point):
+    """Build the four texts every score is computed from
+
+    Args:
+        - data_point (dict): structured record with conversations and responses
+
+    Returns:
+        - texts (dict): 'prev', 'source', 'ai' and 'human' texts
+    """
+    return {
+        'prev': build_conversation_text(data_point['prev_context_conversation']),
+        'source': build_conversation_text(data_point['source_conversation']),
+        'ai': data_point['ai_response'],
+        'human': data_point['human_response'],
+    }
+
+
+def plan_embeddings(model, data_points, texts, cache=None, scheduler=None, chunker=None, tokenize=False):
+    """
+    Everything step 2 of `score_data_points` does before the forward passes.
+
+    Args:
+        - model (SentenceTransformer): model the texts will be embedded with
+        - data_points (list(dict)): structured records
+        - texts (list(dict)): `build_texts` of every data point
+        - cache (EmbeddingCache): optional on-disk embedding cache
+        - scheduler (TokenBudgetScheduler): optional token budget batching
+        - chunker (ConversationChunker): embed conversations as pooled message chunks
+        - tokenize (bool): also produce the model inputs of the texts left, see `plan_encoding`
+
+    Returns:
+        - plan (EncodingPlan): unique texts left for the model, see `plan_encoding`
+        - conversation_chunks (dict): chunks of every conversation with a chunker, None otherwise
+    """
+    if chunker is None:
+        plan = plan_encoding(
+            model, (text for row in texts for text in row.values()), cache=cache, scheduler=scheduler,
+            tokenize=tokenize,
+        )
+        return plan, None
+    conversations = {}
+    for data_point, row in zip(data_points, texts):
+        conversations.setdefault(row['prev'], conversation_messages(data_point['prev_context_conversation']))
+        conversations.setdefault(row['source'], conversation_messages(data_point['source_conversation']))
+    return chunker.plan(
+        model, (text for row in texts for text in (row['ai'], row['human'])), conversations, cache=cache,
+        scheduler=scheduler, tokenize=tokenize,
+    )
+
+
+def run_embeddings(model, plan, conversation_chunks=None, batch_size=64, cache=None, scheduler=None, chunker=None,
+                   codec=None):
+    """Forward passes of a `plan_embeddings` plan, returns (index, embeddings) as `encode_texts` does"""
+    index, embeddings = run_encoding(
+        model, plan, batch_size=batch_size, cache=cache, scheduler=scheduler, codec=codec
+    )
+    if conversation_chunks is not None:
+        index, embeddings = chunker.pool(index, embeddings, conversation_chunks)
+    return index, embeddings
+
+
+def similarity_scores(texts, index, embeddings, codec=None):
+    """Every cosine pair of `SIMILARITY_PAIRS`, read off the embedding matrix, or its `codec` storage form"""
+    if codec is not None:
+        embeddings = codec.quantize(embeddings)
+    similarities = {}
+    for field, (source, target) in SIMILARITY_PAIRS.items():
+        similarities[field] = compute_similarities(
+            embeddings,
+            [index[row[source]] for row in texts],
+            [index[row[target]] for row in texts],
+        )
+    return similarities
+
+
+def lexical_scores(texts, timings=None):
+    """
+    The metrics that need no model: empathy, BLEU and ROUGE.
+
+    Args:
+        - texts (list(dict)): `build_texts` of every data point
+        - timings (dict): when given, seconds spent in each stage are added to it
+
+    Returns:
+        - empathies (dict): one list of scores per field of `EMPATHY_PAIRS`
+        - responses_bleu (list(float))
+        - responses_rouge (dict): per ROUGE type, its 'fmeasure' values
+    """
+    # Step 1: Empathy of every response appended to its conversation, scanning
+    # each conversation only once
+    with timed(timings, 'empathy', len(texts)):
+        empathies = {}
+        prefixes = {}
+        for field, (conversation, response) in EMPATHY_PAIRS.items():
+            empathies[field] = measure_empathy_pairs(
+                [row[conversation] for row in texts], [row[response] for row in texts], prefixes=prefixes
+            )
+
+    # Step 2: BLEU of the human response against the AI one, all weightings in one pass
+    with timed(timings, 'bleu', len(texts)):
+        responses_bleu = compute_bleu_scores_batch([row['ai'] for row in texts], [row['human'] for row in texts])['all']
+
+    # Step 3: ROUGE of the human response against the AI one
+    with timed(timings, 'rouge', len(texts)):
+        responses_rouge = compute_rouge_scores_batch([row['ai'] for row in texts], [row['human'] for row in texts])
+    return empathies, responses_bleu, responses_rouge
+
+
+def collect_scores(similarities, empathies, responses_bleu, responses_rouge, weights=None):
+    """
+    Join the metric values of every data point into its `scores` dict and final score.
+
+    Returns:
+        - results (list(tuple)): (scores, score) per data point, in input order
+    """
+    # Step 1: Collect the scores of every data point
+    scores_list = []
+    for idx in range(len(responses_bleu)):
+        scores = {}
+        scores['source_context_similarity'] = float(similarities['source_context_similarity'][idx])
+        scores['ai_context_empathy'] = float(empathies['ai_context_empathy'][idx])
+        scores['ai_context_similarity'] = float(similarities['ai_context_similarity'][idx])
+        scores['human_context_empathy'] = float(empathies['human_context_empathy'][idx])
+        scores['human_context_similarity'] = float(similarities['human_context_similarity'][idx])
+        scores['ai_source_empathy'] = float(empathies['ai_source_empathy'][idx])
+        scores['ai_source_similarity'] = float(similarities['ai_source_similarity'][idx])
+        scores['human_source_empathy'] = float(empathies['human_source_empathy'][idx])
+        scores['human_source_similarity'] = float(similarities['human_source_similarity'][idx])
+        scores['responses_similarity'] = float(similarities['responses_similarity'][idx])
+
+        scores['responses_rouge'] = {}
+        scores['responses_rouge']['rouge1'] = float(responses_rouge['rouge1']['fmeasure'][idx])
+        scores['responses_rouge']['rouge2'] = float(responses_rouge['rouge2']['fmeasure'][idx])
+        scores['responses_rouge']['rougeL'] = float(responses_rouge['rougeL']['fmeasure'][idx])
+
+        scores['responses_bleu'] = float(responses_bleu[idx])
+
+        scores_list.append(scores)
+
+    # Step 2: Aggregate the final scores over the whole batch
+    final_scores = compute_eval_scores_for_responses(weights, **scores_to_columns(scores_list)) if scores_list else []
+    return [(scores, float(score)) for scores, score in zip(scores_list, final_scores)]
+
+
+def score_data_points(model, data_points, batch_size=64, cache=None, scheduler=None, chunker=None, timings=None,
+                      weights=None, codec=None):
+    """
+    Given a list of data points computes all relevant scores in one batched pass
+
+    Every distinct text across the data points is embedded exactly once and all
+    cosine pairs are read off the resulting embedding matrix.
+
+    Args:
+        - model (SentenceTransformer): model used for the embeddings
+        - data_points (list(dict)): structured records
+        - batch_size (int): number of texts per forward pass
+        - cache (EmbeddingCache): optional on-disk embedding cache
+        - scheduler (TokenBudgetScheduler): optional token budget batching in place of `batch_size`
+        - chunker (ConversationChunker): embed conversations as pooled message chunks instead of
+            truncating them at the model's token limit
+        - timings (dict): when given, seconds spent in each of `SCORING_STAGES` are added to it
+        - weights (ScoringWeights): weights of the final score, the `utils` constants if not set
+        - codec (EmbeddingCodec): storage mode of the embeddings, cosines are computed on its compact form
+
+    Returns:
+        - results (list(tuple)): (scores, score) per data point, in input order
+    """
+    # Step 1: Assemble the texts for every data point
+    with timed(timings, 'texts', len(data_points)):
+        texts = [build_texts(data_point) for data_point in data_points]
+
+    # Step 2: Embed every unique text once
+    with timed(timings, 'embedding', len(data_points)):
+        plan, conversation_chunks = plan_embeddings(
+            model, data_points, texts, cache=cache, scheduler=scheduler, chunker=chunker
+        )
+        index, embeddings = run_embeddings(
+            model, plan, conversation_chunks, batch_size=batch_size, cache=cache, scheduler=scheduler, chunker=chunker,
+            codec=codec,
+        )
+
+    # Step 3: Compute all cosine pairs from the embedding matrix
+    with timed(timings, 'similarity', len(data_points)):
+        similarities = similarity_scores(texts, index, embeddings, codec=codec)
+
+    # Step 4: Empathy, BLEU and ROUGE
+    empathies, responses_bleu, responses_rouge = lexical_scores(texts, timings=timings)
+
+    # Step 5: Collect the scores of every data point and aggregate the final scores
+    with timed(timings, 'aggregation', len(data_points)):
+        return collect_scores(similarities, empathies, responses_bleu, responses_rouge, weights=weights)
@@ -0,0 +1,134 @@
+"""
+cd src/evaluations
+python benchmark.py --sizes 100 1000 10000 --output ../../data/benchmark.json
+python benchmark.py --backend onnx-int8:../../models/bge-base-en-v1.5-onnx --max-tokens 16384 --repeat 3
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import numpy as np
+
+sys.path.append(os.path.abspath('../../'))
+from src.data_handling.conversation_store import compact_records
+from src.data_handling.record_io import iter_chunks
+from src.data_handling.synthetic_builder import generate_records
+from src.evaluations.batch_scoring import SCORING_STAGES
+from src.evaluations.engine import ScoringEngine
+from src.metrics.compute_bleu import ngram_counts
+from src.metrics.compute_rouge import stem, tokenize
+from src.metrics.embedding_backends import DEFAULT_BACKEND
+
+WARMUP_RECORDS = 32
+
+
+def clear_memo_caches():
+    """Forget memoized tokenisations so every run starts cold"""
+    ngram_counts.cache_clear()
+    tokenize.cache_clear()
+    stem.cache_clear()
+
+
+def environment(engine):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'backend': engine.backend,
+        'batch_size': engine.batch_size,
+        'max_tokens': engine.max_tokens,
+    }
+
+
+def run_benchmark(engine, records, chunk_size=1024, repeat=1):
+    """
+    Time every scoring stage over a corpus, scored in chunks as compute_scores_for_bulk_data does.
+
+    Args:
+        - engine (ScoringEngine): engine to benchmark, its model is loaded before timing
+        - records (list(dict)): structured records
+        - chunk_size (int): number of records scored together
+        - repeat (int): runs over the same records, the fastest one is reported
+
+    Returns:
+        - result (dict): total and per-stage seconds of the fastest run and records/sec
+    """
+    # Step 1: Load the model and warm it up outside of the timed runs
+    engine.score(records[:WARMUP_RECORDS])
+
+    # Step 2: Time each run from cold memo caches
+    best = None
+    for _ in range(repeat):
+        clear_memo_caches()
+        if engine.scheduler is not None:
+            engine.scheduler.reset_stats()
+        timings = dict.fromkeys(SCORING_STAGES, 0.0)
+        start = time.perf_counter()
+        for chunk in iter_chunks(records, chunk_size):
+            engine.score(chunk, timings=timings)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best['seconds']:
+            best = {'seconds': seconds, 'stages': timings}
+            if engine.scheduler is not None:
+                best['batching'] = engine.scheduler.stats()
+
+    # Step 3: Derive throughput
+    return {
+        'records': len(records),
+        'records_per_second': len(records) / best['seconds'] if best['seconds'] else None,
+        **best,
+        'stage_share': {stage: seconds / best['seconds'] for stage, seconds in best['stages'].items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the scoring stages on synthetic records')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='corpus sizes to time')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per size, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic records')
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-tokens', type=int, help='padded token budget per forward pass, replaces --batch-size')
+    parser.add_argument('--backend', default=DEFAULT_BACKEND, help='embedding backend, eg: onnx-int8:<model_dir>')
+    parser.add_argument('--prev-turns', type=int, nargs=2, default=(1, 6), metavar=('MIN', 'MAX'))
+    parser.add_argument('--source-turns', type=int, nargs=2, default=(2, 10), metavar=('MIN', 'MAX'))
+    parser.add_argument('--message-words', type=int, nargs=2, default=(5, 40), metavar=('MIN', 'MAX'))
+    parser.add_argument('--output', help='JSON results file, printed when not set')
+    args = parser.parse_args()
+
+    # No embedding cache: every run has to embed every text
+    engine = ScoringEngine(args.backend, batch_size=args.batch_size, max_tokens=args.max_tokens)
+    results = {'environment': environment(engine), 'runs': []}
+    for size in args.sizes:
+        # Conversations packed the way score_builder.py loads them
+        records = compact_records(generate_records(
+            size, seed=args.seed, prev_turns=args.prev_turns, source_turns=args.source_turns,
+            message_words=args.message_words,
+        ))
+        result = run_benchmark(engine, records, chunk_size=args.chunk_size, repeat=args.repeat)
+        results['runs'].append(result)
+        print(f"{size} records: {result['seconds']:.2f}s, {result['records_per_second']:.1f} records/s", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+from src.evaluations.batch_scoring import score_data_points
+from src.evaluations.executor import ScoringExecutor
+from src.metrics.batching import TokenBudgetScheduler
+from src.metrics.embedding_backends import DEFAULT_BACKEND, load_backend
+from src.metrics.embedding_cache import EmbeddingCache
+
+
+class ScoringEngine:
+    """
+    Owns the resources scoring needs and builds each of them on first use.
+
+    Creating an engine costs nothing: the embedding model (and with it torch or
+    onnxruntime) is only loaded the first time data points are scored, and the
+    embedding cache is only opened then too. Code that only needs BLEU, ROUGE
+    or the `utils` math never pays for either.
+
+    Args:
+        - backend (str): embedding backend, see `load_backend`
+        - cache_dir (str): on-disk embedding cache directory, no cache if not set
+        - batch_size (int): number of texts per forward pass
+        - max_tokens (int): form batches under this padded token budget instead of `batch_size`
+        - chunker (ConversationChunker): embed conversations as pooled message chunks
+        - threads (int): intra-op threads of the backend
+        - weights (ScoringWeights): weights of the final score, the `utils` constants if not set
+        - codec (EmbeddingCodec): storage mode of the embeddings, in the cache and for the cosines
+    """
+
+    def __init__(self, backend=DEFAULT_BACKEND, cache_dir=None, batch_size=64, max_tokens=None, chunker=None,
+                 threads=None, weights=None, codec=None):
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.chunker = chunker
+        self.threads = threads
+        self.weights = weights
+        self.codec = codec
+        self.scheduler = TokenBudgetScheduler(max_tokens) if max_tokens else None
+        self._model = None
+        self._cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = load_backend(self.backend, threads=self.threads)
+        return self._model
+
+    @property
+    def cache(self):
+        if self._cache is None and self.cache_dir is not None:
+            self._cache = EmbeddingCache(self.cache_dir, self.backend, codec=self.codec)
+        return self._cache
+
+    def score(self, data_points, cache=None, timings=None):
+        """
+        Score data points in one batched pass.
+
+        Args:
+            - data_points (list(dict)): structured records
+            - cache (EmbeddingCache): cache to use instead of the engine's own
+            - timings (dict): when given, seconds spent in each scoring stage are added to it
+
+        Returns:
+            - results (list(tuple)): (scores, score) per data point, in input order
+        """
+        return score_data_points(
+            self.model, data_points, batch_size=self.batch_size, cache=cache if cache is not None else self.cache,
+            scheduler=self.scheduler, chunker=self.chunker, timings=timings, weights=self.weights, codec=self.codec,
+        )
+
+    def executor(self, workers):
+        """Process pool scoring with this engine's settings, each worker loading its own model"""
+        return ScoringExecutor(
+            workers, self.backend, batch_size=self.batch_size, max_tokens=self.max_tokens, chunker=self.chunker,
+            weights=self.weights, codec=self.codec,
+        )
+
+    def flush(self):
+        """Persist the embedding cache, if it was opened"""
+        if self._cache is not None:
+            self._cache.flush()
+
+    def close(self):
+        """Flush the embedding cache, the model stays loaded"""
+        self.flush()
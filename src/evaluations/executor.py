@@ -0,0 +1,157 @@
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from src.evaluations.batch_scoring import score_data_points
+from src.metrics.batching import TokenBudgetScheduler
+from src.metrics.embedding_backends import DEFAULT_BACKEND, load_backend
+
+# Model, batch scheduler, conversation chunker, score weights and embedding codec owned by a worker process,
+# set up once by `_init_worker`
+_worker_model = None
+_worker_scheduler = None
+_worker_chunker = None
+_worker_weights = None
+_worker_codec = None
+
+
+def _init_worker(backend, threads, max_tokens, chunker, weights=None, codec=None):
+    global _worker_model, _worker_scheduler, _worker_chunker, _worker_weights, _worker_codec
+    # Split the cores between workers instead of letting every thread pool grab all of them
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['MKL_NUM_THREADS'] = str(threads)
+    _worker_model = load_backend(backend, threads=threads)
+    if max_tokens:
+        _worker_scheduler = TokenBudgetScheduler(max_tokens)
+    _worker_chunker = chunker
+    _worker_weights = weights
+    _worker_codec = codec
+
+
+def _score_shard(data_points, batch_size):
+    if _worker_scheduler is None:
+        return score_data_points(
+            _worker_model, data_points, batch_size=batch_size, chunker=_worker_chunker, weights=_worker_weights,
+            codec=_worker_codec,
+        ), None
+    # Ship the batching stats of this shard back with its results
+    _worker_scheduler.reset_stats()
+    results = score_data_points(
+        _worker_model, data_points, batch_size=batch_size, scheduler=_worker_scheduler, chunker=_worker_chunker,
+        weights=_worker_weights, codec=_worker_codec,
+    )
+    return results, _worker_scheduler.stats()
+
+
+class ScoringExecutor:
+    """
+    Score data points across a pool of worker processes, each owning one model.
+
+    Data points are sharded, scored with `score_data_points` in the workers and
+    merged back in input order. Workers are started with 'spawn' so no torch
+    or onnxruntime state is inherited through fork, and each one gets an equal
+    share of the cores for its intra-op thread pool.
+
+    Args:
+        - workers (int): number of worker processes
+        - backend (str): embedding backend loaded by every worker, see `load_backend`
+        - batch_size (int): number of texts per forward pass
+        - shard_size (int): number of data points sent to a worker at a time
+        - threads_per_worker (int): intra-op threads per worker, defaults to cpu_count // workers
+        - max_tokens (int): batch under this token budget in every worker instead of by `batch_size`.
+            `scheduler` then sums the batching stats of all workers.
+        - chunker (ConversationChunker): embed conversations as pooled message chunks in every worker
+        - weights (ScoringWeights): weights of the final score, the `utils` constants if not set
+        - codec (EmbeddingCodec): storage mode of the embeddings in every worker
+    """
+
+    def __init__(self, workers, backend=DEFAULT_BACKEND, batch_size=64, shard_size=256, threads_per_worker=None,
+                 max_tokens=None, chunker=None, weights=None, codec=None):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.shard_size = shard_size
+        self.scheduler = TokenBudgetScheduler(max_tokens) if max_tokens else None
+        threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(backend, threads, max_tokens, chunker, weights, codec),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+    def submit(self, data_points):
+        """
+        Send data points to the workers without waiting for them.
+
+        Args:
+            - data_points (list(dict)): structured records
+
+        Returns:
+            - futures (list(Future)): one per shard, in input order, see `collect`
+        """
+        # Keep every worker busy even when there are fewer than workers * shard_size data points
+        shard_size = max(1, min(self.shard_size, -(-len(data_points) // self.workers)))
+        return [
+            self.pool.submit(_score_shard, data_points[start:start + shard_size], self.batch_size)
+            for start in range(0, len(data_points), shard_size)
+        ]
+
+    def collect(self, futures):
+        """Wait for the shards returned by `submit` and merge their results in input order"""
+        results = []
+        for future in futures:
+            shard_results, shard_stats = future.result()
+            results.extend(shard_results)
+            if shard_stats is not None:
+                self.scheduler.merge_stats(shard_stats)
+        return results
+
+    def score(self, data_points):
+        """
+        Score data points in parallel.
+
+        Args:
+            - data_points (list(dict)): structured records
+
+        Returns:
+            - results (list(tuple)): (scores, score) per data point, in input order
+        """
+        return self.collect(self.submit(data_points))
+
+    def score_chunks(self, chunks, ahead=1):
+        """
+        Score a stream of chunks, the shards of the next ones already queued while one is collected.
+
+        Workers then move on to the next chunk instead of idling until the
+        slowest shard of the current one is done.
+
+        Args:
+            - chunks (iterable(list(dict))): structured records, read `ahead` chunks in advance
+            - ahead (int): chunks submitted past the one being collected
+
+        Yields:
+            - results (list(tuple)): (scores, score) per data point of every chunk, in input order
+        """
+        submitted = deque()
+        try:
+            for chunk in chunks:
+                submitted.append(self.submit(chunk))
+                if len(submitted) > ahead:
+                    yield self.collect(submitted.popleft())
+            while submitted:
+                yield self.collect(submitted.popleft())
+        finally:
+            # Do not leave the workers scoring chunks nobody will collect
+            for futures in submitted:
+                for future in futures:
+                    future.cancel()
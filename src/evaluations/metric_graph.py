@@ -0,0 +1,342 @@
+import json
+import sqlite3
+import hashlib
+
+from src.evaluations.batch_scoring import (
+    SIMILARITY_PAIRS, EMPATHY_PAIRS, timed, build_texts, conversation_messages,
+)
+from src.metrics import utils
+from src.metrics.compute_bleu import compute_bleu_scores_batch
+from src.metrics.compute_cosine import encode_texts, compute_similarities
+from src.metrics.compute_empathy import measure_empathy_pairs
+from src.metrics.compute_rouge import ROUGE_TYPES, compute_rouge_scores_batch
+from src.metrics.profiling import profiler
+
+# Texts every metric is computed from, see `build_texts`
+TEXT_INPUTS = ('prev', 'source', 'ai', 'human')
+CONVERSATION_INPUTS = {'prev': 'prev_context_conversation', 'source': 'source_conversation'}
+# Fields of the `scores` dict, in the order `score_data_points` writes them
+SCORE_FIELDS = (
+    'source_context_similarity', 'ai_context_empathy', 'ai_context_similarity', 'human_context_empathy',
+    'human_context_similarity', 'ai_source_empathy', 'ai_source_similarity', 'human_source_empathy',
+    'human_source_similarity', 'responses_similarity', 'responses_rouge', 'responses_bleu',
+)
+MEMO_QUERY_SIZE = 500
+
+
+class MetricNode:
+    """
+    One metric of the scoring graph.
+
+    Args:
+        - name (str): metric name, also the key of its value in `scores`
+        - inputs (tuple(str)): texts of `TEXT_INPUTS` or names of other nodes the metric reads
+        - compute (callable): (batch, rows) -> one value per row, for the rows of a `_Batch` to compute
+        - needs_model (bool): whether computing the metric needs the embedding model
+    """
+
+    def __init__(self, name, inputs, compute, needs_model=False):
+        self.name = name
+        self.inputs = inputs
+        self.compute = compute
+        self.needs_model = needs_model
+
+    def reads_texts_only(self):
+        return all(input_ in TEXT_INPUTS for input_ in self.inputs)
+
+
+def _similarity(source, target):
+    def compute(batch, rows):
+        return compute_similarities(
+            batch.embeddings,
+            [batch.index[batch.texts[row][source]] for row in rows],
+            [batch.index[batch.texts[row][target]] for row in rows],
+        ).tolist()
+    return compute
+
+
+def _empathy(conversation, response):
+    def compute(batch, rows):
+        empathies = measure_empathy_pairs(
+            [batch.texts[row][conversation] for row in rows], [batch.texts[row][response] for row in rows],
+            prefixes=batch.prefixes,
+        )
+        return [float(empathy) for empathy in empathies]
+    return compute
+
+
+def _bleu(batch, rows):
+    return compute_bleu_scores_batch(
+        [batch.texts[row]['ai'] for row in rows], [batch.texts[row]['human'] for row in rows]
+    )['all'].tolist()
+
+
+def _rouge(batch, rows):
+    scores = compute_rouge_scores_batch(
+        [batch.texts[row]['ai'] for row in rows], [batch.texts[row]['human'] for row in rows]
+    )
+    return [
+        {rouge_type: float(scores[rouge_type]['fmeasure'][idx]) for rouge_type in ROUGE_TYPES}
+        for idx in range(len(rows))
+    ]
+
+
+def _final_score(batch, rows):
+    columns = utils.scores_to_columns([{field: batch.values[field][row] for field in SCORE_FIELDS} for row in rows])
+    return utils.compute_eval_scores_for_responses(batch.weights, **columns).tolist()
+
+
+def build_nodes():
+    """Every node of the scoring graph, in an order where inputs come first"""
+    nodes = [MetricNode(field, pair, _similarity(*pair), needs_model=True) for field, pair in SIMILARITY_PAIRS.items()]
+    nodes += [MetricNode(field, pair, _empathy(*pair)) for field, pair in EMPATHY_PAIRS.items()]
+    nodes.append(MetricNode('responses_bleu', ('ai', 'human'), _bleu))
+    nodes.append(MetricNode('responses_rouge', ('ai', 'human'), _rouge))
+    nodes.append(MetricNode('score', SCORE_FIELDS, _final_score))
+    return {node.name: node for node in nodes}
+
+
+NODES = build_nodes()
+METRICS = tuple(NODES)
+
+
+class MetricMemo:
+    """
+    SQLite store of metric values keyed by a hash of the node and its inputs.
+
+    Args:
+        - path (str): database file, created if needed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS metrics (key BLOB PRIMARY KEY, value TEXT NOT NULL)')
+        self.connection.commit()
+
+    def get_many(self, keys):
+        """
+        Args:
+            - keys (list(bytes))
+
+        Returns:
+            - found (dict): maps every stored key to its value
+        """
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        for start in range(0, len(unique), MEMO_QUERY_SIZE):
+            part = unique[start:start + MEMO_QUERY_SIZE]
+            cursor = self.connection.execute(
+                f"SELECT key, value FROM metrics WHERE key IN ({','.join('?' * len(part))})", part
+            )
+            found.update((key, json.loads(value)) for key, value in cursor)
+        return found
+
+    def put_many(self, items):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO metrics (key, value) VALUES (?, ?)',
+            ((key, json.dumps(value)) for key, value in items),
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class _Batch:
+    """Texts, input digests and metric values of the data points evaluated together"""
+
+    def __init__(self, data_points, weights):
+        self.data_points = data_points
+        self.weights = weights
+        self.texts = [build_texts(data_point) for data_point in data_points]
+        self.digests = [
+            {field: hashlib.sha1(text.encode('utf-8')).digest() for field, text in row.items()} for row in self.texts
+        ]
+        self.values = {}
+        self.index = None
+        self.embeddings = None
+        self.prefixes = {}
+
+
+class MetricGraph:
+    """
+    Scoring pipeline as a graph of metric nodes, memoized by a hash of each node's inputs.
+
+    Every metric of `scores` and the final `score` is a node that declares the
+    texts (or other metrics) it reads. A node's value is stored under a hash of
+    its name, its settings and its inputs, so re-scoring a corpus where only
+    some texts changed recomputes just the metrics that read them: a corrected
+    `human_response` leaves the context/source similarity and the AI metrics
+    untouched. Requesting a subset of metrics only evaluates the nodes they
+    need, and the embedding model is only loaded when a similarity misses the memo.
+
+    Args:
+        - engine (ScoringEngine): model, embedding cache and batching settings of the similarity nodes
+        - memo (MetricMemo): store of computed values, nothing is remembered between calls if not set
+    """
+
+    def __init__(self, engine, memo=None):
+        self.engine = engine
+        self.memo = memo
+        self.recomputed = dict.fromkeys(NODES, 0)
+        self.reused = dict.fromkeys(NODES, 0)
+
+    def weights(self):
+        """Weights of the final score, the engine's or else the `utils` constants"""
+        return self.engine.weights or utils.default_weights()
+
+    def salt(self, node):
+        """Settings a node's value depends on besides its inputs"""
+        if node.needs_model:
+            chunker = self.engine.chunker
+            pooling = (chunker.max_tokens, chunker.pooling, chunker.recency_decay) if chunker is not None else None
+            codec = self.engine.codec.key if self.engine.codec is not None else None
+            return f'{self.engine.backend}|{pooling}' if codec is None else f'{self.engine.backend}|{pooling}|{codec}'
+        if node.name == 'score':
+            return json.dumps(self.weights()._asdict())
+        return ''
+
+    def required(self, metrics):
+        """Requested metrics and everything they read, in evaluation order"""
+        unknown = [metric for metric in metrics if metric not in NODES]
+        if unknown:
+            raise ValueError(f'unknown metrics {unknown}, expected some of {METRICS}')
+        needed = set()
+        pending = list(metrics)
+        while pending:
+            name = pending.pop()
+            if name in needed:
+                continue
+            needed.add(name)
+            pending.extend(input_ for input_ in NODES[name].inputs if input_ in NODES)
+        return [name for name in NODES if name in needed]
+
+    def keys(self, batch, node):
+        salt = f'{node.name}\0{self.salt(node)}'.encode('utf-8')
+        keys = []
+        for row, digests in enumerate(batch.digests):
+            payload = hashlib.sha1(salt)
+            for input_ in node.inputs:
+                if input_ in TEXT_INPUTS:
+                    payload.update(digests[input_])
+                else:
+                    payload.update(json.dumps(batch.values[input_][row]).encode('utf-8'))
+            keys.append(payload.digest())
+        return keys
+
+    def lookup(self, batch, node):
+        """Fill in the memoized values of a node, returns its keys and the rows left to compute"""
+        keys = self.keys(batch, node)
+        found = self.memo.get_many(keys) if self.memo is not None else {}
+        batch.values[node.name] = [found.get(key) for key in keys]
+        missing = [row for row, key in enumerate(keys) if key not in found]
+        self.reused[node.name] += len(keys) - len(missing)
+        self.recomputed[node.name] += len(missing)
+        return keys, missing
+
+    def embed(self, batch, rows_by_node):
+        """Embed, in one pass, every text the similarity nodes still have to compute"""
+        fields = {}
+        for name, rows in rows_by_node.items():
+            for row in rows:
+                for input_ in NODES[name].inputs:
+                    fields.setdefault(row, set()).add(input_)
+        model, engine = self.engine.model, self.engine
+        if engine.chunker is None:
+            texts = (batch.texts[row][field] for row in sorted(fields) for field in TEXT_INPUTS if field in fields[row])
+            batch.index, embeddings = encode_texts(
+                model, texts, batch_size=engine.batch_size, cache=engine.cache, scheduler=engine.scheduler,
+                codec=engine.codec,
+            )
+        else:
+            responses, conversations = [], {}
+            for row in sorted(fields):
+                for field in TEXT_INPUTS:
+                    if field not in fields[row]:
+                        continue
+                    text = batch.texts[row][field]
+                    if field in CONVERSATION_INPUTS:
+                        conversations.setdefault(
+                            text, conversation_messages(batch.data_points[row][CONVERSATION_INPUTS[field]])
+                        )
+                    else:
+                        responses.append(text)
+            batch.index, embeddings = engine.chunker.encode(
+                model, responses, conversations, batch_size=engine.batch_size, cache=engine.cache,
+                scheduler=engine.scheduler, codec=engine.codec,
+            )
+        # Cosines are read off the storage form of the embeddings
+        batch.embeddings = engine.codec.quantize(embeddings) if engine.codec is not None else embeddings
+
+    def evaluate(self, data_points, metrics=None):
+        """
+        Evaluate metrics of data points, computing only what the memo does not hold.
+
+        Args:
+            - data_points (list(dict)): structured records
+            - metrics (list(str)): names of `METRICS` to evaluate, all of them if not set
+
+        Returns:
+            - values (list(dict)): the requested metrics of every data point, in input order
+        """
+        metrics = list(metrics) if metrics else list(METRICS)
+        names = self.required(metrics)
+        batch = _Batch(data_points, self.weights())
+        computed = []
+
+        # Step 1: Look up every metric that only reads texts
+        text_nodes = [NODES[name] for name in names if NODES[name].reads_texts_only()]
+        lookups = {node.name: self.lookup(batch, node) for node in text_nodes}
+
+        # Step 2: Embed once for all the similarities left to compute
+        model_misses = {node.name: lookups[node.name][1] for node in text_nodes if node.needs_model}
+        if any(model_misses.values()):
+            with timed(None, 'embedding', len(data_points)):
+                self.embed(batch, model_misses)
+
+        # Step 3: Compute the missing text metrics, then the metrics reading other metrics
+        for name in names:
+            node = NODES[name]
+            keys, missing = lookups[name] if name in lookups else self.lookup(batch, node)
+            if not missing:
+                continue
+            with profiler.span(f'node.{name}', len(missing)):
+                values = node.compute(batch, missing)
+            for row, value in zip(missing, values):
+                batch.values[name][row] = value
+                computed.append((keys[row], value))
+
+        # Step 4: Remember what was computed
+        if self.memo is not None and computed:
+            self.memo.put_many(computed)
+        return [{metric: batch.values[metric][row] for metric in metrics} for row in range(len(data_points))]
+
+    def score(self, data_points, metrics=None):
+        """
+        `ScoringEngine.score` through the graph.
+
+        Args:
+            - data_points (list(dict)): structured records
+            - metrics (list(str)): names of `METRICS` to compute, all of them if not set. The final
+                score is only computed when all are requested or 'score' is.
+
+        Returns:
+            - results (list(tuple)): (scores, score) per data point, score is None when not requested.
+                `scores` holds every field computed along the way, eg: all of them for ['score'].
+        """
+        # What the requested metrics read is computed anyway, write it out too
+        needed = set(self.required(metrics or METRICS))
+        metrics = [field for field in (*SCORE_FIELDS, 'score') if field in needed]
+        results = []
+        for values in self.evaluate(data_points, metrics):
+            score = values.pop('score', None)
+            results.append((values, score))
+        return results
+
+    def stats(self):
+        """Values reused from the memo and recomputed, per evaluated metric"""
+        return {
+            name: {'reused': self.reused[name], 'recomputed': self.recomputed[name]}
+            for name in NODES if self.reused[name] or self.recomputed[name]
+        }
@@ -0,0 +1,216 @@
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from src.evaluations.batch_scoring import (
+    build_texts, plan_embeddings, run_embeddings, similarity_scores, lexical_scores, collect_scores,
+)
+from src.metrics.profiling import profiler
+
+# Seconds a blocked stage waits before checking whether the pipeline was stopped
+POLL_SECONDS = 0.1
+
+_DONE = object()
+
+
+class _Stopped(Exception):
+    """Raised in a stage once the pipeline is stopped, by an error or by the consumer"""
+
+
+class _Chunk:
+    """One chunk of records on its way through the stages"""
+
+    __slots__ = ('records', 'clusters', 'representatives', 'texts', 'lexical', 'plan', 'conversation_chunks',
+                 'similarities')
+
+    def __init__(self, records, clusters=None, representatives=None):
+        self.records = records
+        self.clusters = clusters
+        self.representatives = representatives
+        self.texts = None
+        self.lexical = None
+        self.plan = None
+        self.conversation_chunks = None
+        self.similarities = None
+
+    def scored(self):
+        """Records sent through the metrics, the representatives of their clusters when deduplicating"""
+        if self.representatives is None:
+            return self.records
+        return [self.records[position] for position in self.representatives]
+
+
+class ScoringPipeline:
+    """
+    Score chunks of records with loading, tokenization, inference, lexical metrics and writing overlapped.
+
+    `score_data_points` runs every stage of a chunk in turn, so the model idles
+    while texts are assembled and VADER runs, and the CPU idles during forward
+    passes. Here each stage works on its own chunk at the same time:
+
+        - read: pulls the next chunk from the input (parsing happens here) and assembles its texts
+        - tokenize: deduplicates texts, looks them up in the embedding cache and tokenizes the
+          rest into model inputs, see `EmbeddingBackend.tokenize`
+        - infer: forward passes over those inputs and cosine similarities. torch and onnxruntime
+          release the GIL. Models that cannot tokenize ahead tokenize here instead.
+        - lexical: empathy, BLEU and ROUGE in a pool of `lexical_workers` processes, as VADER is
+          pure Python. Submitted by the reader, so it runs alongside the three threads.
+        - join: once both halves of a chunk have arrived, every row gets its `scores` and final score
+        - write: the consumer of `run`, eg: the JSONL writer of `score_file`
+
+    Stages hand chunks on through queues holding `depth` chunks. A full queue
+    blocks the stage feeding it, so a slow stage holds back the reader and at
+    most about 3 * (depth + 1) chunks are in memory, whatever the input size.
+
+    Records come out in input order and scored exactly as `score_data_points`
+    would, except that a text shared with the chunk just ahead may be embedded
+    again instead of read back from the cache.
+
+    Args:
+        - engine (ScoringEngine): model, embedding cache, batching settings, weights and codec to score with
+        - lexical_workers (int): processes computing the lexical metrics, 0 computes them in the join
+        - depth (int): chunks each queue between two stages holds
+    """
+
+    def __init__(self, engine, lexical_workers=2, depth=2):
+        self.engine = engine
+        self.lexical_workers = lexical_workers
+        self.depth = depth
+        self.stop = threading.Event()
+        self.error = None
+
+    def _put(self, q, item):
+        while True:
+            if self.stop.is_set():
+                raise _Stopped()
+            try:
+                q.put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, q):
+        while True:
+            if self.stop.is_set():
+                raise _Stopped()
+            try:
+                return q.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                pass
+
+    def _stage(self, target, *args):
+        """Run a stage thread, stopping the whole pipeline if it fails"""
+        try:
+            target(*args)
+        except _Stopped:
+            pass
+        except BaseException as error:
+            self.error = error
+            self.stop.set()
+
+    def _read(self, chunks, dedup, pool, output):
+        iterator = iter(chunks)
+        while True:
+            with profiler.span('pipeline.read'):
+                records = next(iterator, None)
+                if records is None:
+                    break
+                item = _Chunk(records, *(dedup.assign(records) if dedup is not None else ()))
+                item.texts = [build_texts(data_point) for data_point in item.scored()]
+                if pool is not None and item.texts:
+                    item.lexical = pool.submit(lexical_scores, item.texts)
+            self._put(output, item)
+        self._put(output, _DONE)
+
+    def _tokenize(self, model, source, output):
+        engine = self.engine
+        while (item := self._get(source)) is not _DONE:
+            if item.texts:
+                with profiler.span('pipeline.tokenize', len(item.texts)):
+                    item.plan, item.conversation_chunks = plan_embeddings(
+                        model, item.scored(), item.texts, cache=engine.cache, scheduler=engine.scheduler,
+                        chunker=engine.chunker, tokenize=True,
+                    )
+            self._put(output, item)
+        self._put(output, _DONE)
+
+    def _infer(self, model, source, output):
+        engine = self.engine
+        while (item := self._get(source)) is not _DONE:
+            if item.texts:
+                with profiler.span('pipeline.infer', len(item.texts)):
+                    index, embeddings = run_embeddings(
+                        model, item.plan, item.conversation_chunks, batch_size=engine.batch_size, cache=engine.cache,
+                        scheduler=engine.scheduler, chunker=engine.chunker, codec=engine.codec,
+                    )
+                    item.similarities = similarity_scores(item.texts, index, embeddings, codec=engine.codec)
+                    item.plan = item.conversation_chunks = None
+            self._put(output, item)
+        self._put(output, _DONE)
+
+    def _join(self, item, dedup):
+        """Scores of every record of a chunk, once its similarity and lexical halves are both in"""
+        scored = []
+        if item.texts:
+            with profiler.span('pipeline.lexical', len(item.texts)):
+                lexical = item.lexical.result() if item.lexical is not None else lexical_scores(item.texts)
+            with profiler.span('pipeline.join', len(item.texts)):
+                scored = collect_scores(item.similarities, *lexical, weights=self.engine.weights)
+        if dedup is not None:
+            return dedup.fan_out(item.records, item.clusters, item.representatives, scored)
+        return scored
+
+    def run(self, chunks, dedup=None):
+        """
+        Score chunks of records as they stream in.
+
+        Args:
+            - chunks (iterable(list(dict))): structured records, chunk by chunk. Iterated in a
+                background thread, so reading and parsing the input overlaps with scoring.
+            - dedup (Deduplicator): only score one record per duplicate cluster, see `Deduplicator.score`
+
+        Yields:
+            - chunk (list(dict)): the records of every chunk, in input order, with their
+                `scores` and `score` set
+        """
+        # Step 1: Load the model before starting the threads so tokenize and infer do not race to load it
+        self.stop.clear()
+        self.error = None
+        model = self.engine.model
+        pool = None
+        if self.lexical_workers:
+            pool = ProcessPoolExecutor(self.lexical_workers, mp_context=multiprocessing.get_context('spawn'))
+
+        # Step 2: Start a thread per stage, connected by bounded queues
+        to_tokenize, to_infer, to_join = (queue.Queue(maxsize=self.depth) for _ in range(3))
+        threads = [
+            threading.Thread(target=self._stage, args=(self._read, chunks, dedup, pool, to_tokenize), daemon=True),
+            threading.Thread(target=self._stage, args=(self._tokenize, model, to_tokenize, to_infer), daemon=True),
+            threading.Thread(target=self._stage, args=(self._infer, model, to_infer, to_join), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        # Step 3: Join the halves of every chunk and hand it to the consumer, in order
+        try:
+            while True:
+                try:
+                    item = self._get(to_join)
+                except _Stopped:
+                    break
+                if item is _DONE:
+                    break
+                for data_point, (scores, score) in zip(item.records, self._join(item, dedup)):
+                    data_point['scores'] = scores
+                    data_point['score'] = score
+                with profiler.span('pipeline.write', len(item.records)):
+                    yield item.records
+        finally:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        if self.error is not None:
+            raise self.error
@@ -1,18 +1,46 @@
 import os
 import sys
-from sentence_transformers import SentenceTransformer
-from nltk.translate.bleu_score import sentence_bleu
+import atexit
 
 sys.path.append(os.path.abspath('../../'))
-from src.metrics.compute_cosine import compute_similarity
-from src.metrics.compute_empathy import measure_empathy
-from src.metrics.compute_rouge import compute_rouge_scores
-from src.metrics.utils import compute_eval_score_for_response
+from src.evaluations.batch_scoring import score_data_points
+from src.evaluations.engine import ScoringEngine
+from src.evaluations.executor import ScoringExecutor
 
-model = SentenceTransformer('BAAI/bge-base-en-v1.5')
+# The model is only loaded by the first call that scores something
+engine = ScoringEngine()
+# Worker pool of the last call with `workers`, kept running for the next ones along with the settings it was built with
+_executor = None
+_executor_settings = None
 
 
-def score_data_point_for_eval(data_point):
+def get_executor(workers, batch_size=64, chunker=None):
+    """
+    Worker pool scoring with these settings, reused across calls so the workers load their models once.
+
+    A pool built with other settings is shut down and replaced.
+
+    Returns:
+        - executor (ScoringExecutor)
+    """
+    global _executor, _executor_settings
+    settings = (workers, batch_size, chunker)
+    if _executor is None or _executor_settings != settings:
+        shutdown_executor()
+        _executor = ScoringExecutor(workers, engine.backend, batch_size=batch_size, chunker=chunker)
+        _executor_settings = settings
+    return _executor
+
+
+@atexit.register
+def shutdown_executor():
+    global _executor, _executor_settings
+    if _executor is not None:
+        _executor.shutdown()
+    _executor = _executor_settings = None
+
+
+def score_data_point_for_eval(data_point, cache=None):
     """
     Given a data point computes all relevant scores
 
@@ -21,76 +49,36 @@ def score_data_point_for_eval(data_point):
         - source_conversation (list)
         - ai_response (str)
         - human_response (str)
+        - cache (EmbeddingCache): optional on-disk embedding cache
     
     Returns:
         - scores (dict): Holds all computed scores
         - score (float)
     """
-    scores = {}
-    prev = data_point['prev_context_conversation']
-    prev_conversation_text = ''
-    for msg in prev:
-        prev_conversation_text += f' {list(msg.values())[0]}'
-
-    # Concatenate source conversation messages into a single string
-    source = data_point['source_conversation']
-    source_conversation_text = ''
-    for msg in source:
-        source_conversation_text += f' {list(msg.values())[0]}'
-
-    # AI and human responses
-    ai_response = data_point['ai_response']
-    human_response = data_point['human_response']
-
-    # Compute cosine similarity between source and previous context texts
-    source_context_similarity = compute_similarity(model, source_conversation_text, prev_conversation_text)
-    scores['source_context_similarity'] = float(source_context_similarity)
-
-    # Compute empathy and similarity for AI's response with the previous context
-    ai_prev_conversation_text = prev_conversation_text + ai_response
-    ai_context_empathy = measure_empathy(ai_prev_conversation_text)
-    scores['ai_context_empathy'] = float(ai_context_empathy)
+    # Step 1: Score the data point as a batch of one
+    scores, score = score_data_points(engine.model, [data_point], cache=cache)[0]
 
-    ai_context_similarity = compute_similarity(model, prev_conversation_text, ai_response)
-    scores['ai_context_similarity'] = float(ai_context_similarity)
-
-    # Compute empathy and similarity for Human's response with the previous context
-    human_prev_conversation_text = prev_conversation_text + human_response
-    human_context_empathy = measure_empathy(human_prev_conversation_text)
-    scores['human_context_empathy'] = float(human_context_empathy)
-
-    human_context_similarity = compute_similarity(model, prev_conversation_text, human_response)
-    scores['human_context_similarity'] = float(human_context_similarity)
-
-    # Compute empathy and similarity for AI's response with the source context
-    ai_source_conversation_text = source_conversation_text + ai_response
-    ai_source_empathy = measure_empathy(ai_source_conversation_text)
-    scores['ai_source_empathy'] = float(ai_source_empathy)
-
-    ai_source_similarity = compute_similarity(model, source_conversation_text, ai_response)
-    scores['ai_source_similarity'] = float(ai_source_similarity)
-
-    # Compute empathy and similarity for Human's response with the source context
-    human_source_conversation_text = source_conversation_text + human_response
-    human_source_empathy = measure_empathy(human_source_conversation_text)
-    scores['human_source_empathy'] = float(human_source_empathy)
-
-    human_source_similarity = compute_similarity(model, source_conversation_text, human_response)
-    scores['human_source_similarity'] = float(human_source_similarity)
-
-    # Compute similarity, ROUGE scores, and BLEU score between AI's and Human's responses
-    responses_similarity = compute_similarity(model, ai_response, human_response)
-    scores['responses_similarity'] = float(responses_similarity)
+    return scores, score
 
-    responses_rouge = compute_rouge_scores(ai_response, human_response)
-    scores['responses_rouge'] = {}
-    scores['responses_rouge']['rouge1'] = float(responses_rouge['rouge1'].fmeasure)
-    scores['responses_rouge']['rouge2'] = float(responses_rouge['rouge2'].fmeasure)
-    scores['responses_rouge']['rougeL'] = float(responses_rouge['rougeL'].fmeasure)
 
-    responses_bleu = sentence_bleu([ai_response], human_response, weights=(0.25,0.25,0.25,0.25))
-    scores['responses_bleu'] = float(responses_bleu)
+def score_data_points_for_eval(data_points, batch_size=64, cache=None, workers=None, scheduler=None, chunker=None):
+    """
+    Given a list of data points computes all relevant scores in one batched pass
 
-    score = compute_eval_score_for_response(**scores)
+    Args:
+        - data_points (list(dict)): data points as accepted by `score_data_point_for_eval`
+        - batch_size (int): number of texts per forward pass
+        - cache (EmbeddingCache): optional on-disk embedding cache, used in-process only
+        - workers (int): shard the data points across this many processes, one model each.
+            The processes are kept for the next calls with the same settings, see `get_executor`.
+        - scheduler (TokenBudgetScheduler): optional token budget batching, in-process only
+        - chunker (ConversationChunker): embed conversations past the token limit as pooled message chunks
 
-    return scores, score
+    Returns:
+        - results (list(tuple)): (scores, score) per data point, in input order
+    """
+    if workers:
+        return get_executor(workers, batch_size=batch_size, chunker=chunker).score(data_points)
+    return score_data_points(
+        engine.model, data_points, batch_size=batch_size, cache=cache, scheduler=scheduler, chunker=chunker
+    )
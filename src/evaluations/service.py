@@ -0,0 +1,300 @@
+"""
+cd src/evaluations
+python service.py --port 8080 --max-wait-ms 5
+python service.py --unix-socket /tmp/scoring.sock --backend onnx-int8:../../models/bge-base-en-v1.5-onnx
+
+curl -X POST localhost:8080/score -d '{"prev_context_conversation": [...], "source_conversation": [...], "ai_response": "...", "human_response": "..."}'
+curl localhost:8080/metrics
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from collections import Counter, deque
+import numpy as np
+
+sys.path.append(os.path.abspath('../../'))
+from src.evaluations.engine import ScoringEngine
+from src.metrics.embedding_backends import DEFAULT_BACKEND
+
+CONVERSATION_FIELDS = ('prev_context_conversation', 'source_conversation')
+RESPONSE_FIELDS = ('ai_response', 'human_response')
+REQUIRED_FIELDS = CONVERSATION_FIELDS + RESPONSE_FIELDS
+MAX_BODY_BYTES = 16 << 20  # 16 MB
+LATENCY_WINDOW = 10000
+LISTEN_BACKLOG = 1024  # bursts of ticket traffic open many connections at once
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent scoring requests into batches.
+
+    The first pending data point opens a batch, which then collects whatever
+    else arrives within `max_wait` seconds (or until it holds `max_batch_size`
+    data points) and is scored with one `ScoringEngine.score` call. Scoring runs
+    in a worker thread so the event loop keeps accepting requests meanwhile.
+    Should a batch fail, its data points are scored again one by one, so a bad
+    data point only fails its own request.
+
+    Args:
+        - engine (ScoringEngine): model, embedding cache and batching settings to score with
+        - max_batch_size (int): most data points scored together
+        - max_wait (float): seconds a batch waits for more data points after its first
+    """
+
+    def __init__(self, engine, max_batch_size=64, max_wait=0.005):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = Counter()
+        self.requests = 0
+        self.errors = 0
+
+    async def score(self, data_point):
+        """
+        Score one data point as part of the next batch.
+
+        Args:
+            - data_point (dict): structured record
+
+        Returns:
+            - scores (dict): Holds all computed scores
+            - score (float)
+        """
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((data_point, future))
+        try:
+            return await future
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def run(self):
+        """Form and score batches until cancelled"""
+        loop = asyncio.get_running_loop()
+        while True:
+            # Step 1: Block for the first data point, then gather more until the window closes
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Step 2: Score the batch off the event loop
+            data_points = [data_point for data_point, _ in batch]
+            self.requests += len(batch)
+            self.batch_sizes[len(batch)] += 1
+            try:
+                results = await loop.run_in_executor(None, self.engine.score, data_points)
+            except Exception as e:
+                if len(batch) == 1:
+                    self.errors += 1
+                    if not batch[0][1].done():
+                        batch[0][1].set_exception(e)
+                    continue
+                await self.score_each(batch)
+                continue
+
+            # Step 3: Hand every caller its own result
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def score_each(self, batch):
+        """Score the data points of a failed batch one at a time, failing only those that fail alone"""
+        loop = asyncio.get_running_loop()
+        for data_point, future in batch:
+            try:
+                result = (await loop.run_in_executor(None, self.engine.score, [data_point]))[0]
+            except Exception as e:
+                self.errors += 1
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result(result)
+
+    def metrics(self):
+        """
+        Latency and batching metrics.
+
+        Returns:
+            - metrics (dict): request counts, p50/p99 latency in milliseconds over the
+                last `LATENCY_WINDOW` requests and the batch size distribution
+        """
+        latencies = np.array(self.latencies) * 1000
+        batches = sum(self.batch_sizes.values())
+        metrics = {
+            'requests': self.requests,
+            'errors': self.errors,
+            'pending': self.queue.qsize(),
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'batches': batches,
+            'mean_batch_size': self.requests / batches if batches else None,
+            'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+        }
+        if self.engine.scheduler is not None:
+            metrics['batching'] = self.engine.scheduler.stats()
+        return metrics
+
+
+def validate_data_point(data_point):
+    """Raise a ValueError unless `data_point` has the fields and types `build_texts` expects"""
+    if not isinstance(data_point, dict):
+        raise ValueError('a data point must be a JSON object')
+    missing = [field for field in REQUIRED_FIELDS if field not in data_point]
+    if missing:
+        raise ValueError(f'missing fields: {missing}')
+    for field in CONVERSATION_FIELDS:
+        conversation = data_point[field]
+        if not isinstance(conversation, list):
+            raise ValueError(f'{field} must be a list of messages')
+        for message in conversation:
+            if not (isinstance(message, dict) and len(message) == 1 and isinstance(next(iter(message.values())), str)):
+                raise ValueError(f'{field} messages must be objects with a single string value, eg: {{"customer": "..."}}')
+    for field in RESPONSE_FIELDS:
+        if not isinstance(data_point[field], str):
+            raise ValueError(f'{field} must be a string')
+
+
+class ScoringService:
+    """
+    Minimal HTTP/1.1 front end of a `MicroBatcher`, over TCP or a Unix socket.
+
+    Routes:
+        - POST /score: a data point, or a list of data points, returns {'scores', 'score'} for each
+        - GET /metrics: `MicroBatcher.metrics`
+        - GET /health
+
+    Args:
+        - batcher (MicroBatcher): batcher the requests are scored by
+    """
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def handle(self, method, path, body):
+        """Route a request, returns (status, payload)"""
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'GET' and path == '/metrics':
+            return 200, self.batcher.metrics()
+        if method != 'POST' or path != '/score':
+            return 404, {'error': f'no route for {method} {path}'}
+
+        # Step 1: Parse and validate the data points
+        try:
+            payload = json.loads(body)
+            data_points = payload if isinstance(payload, list) else [payload]
+            for data_point in data_points:
+                validate_data_point(data_point)
+        except ValueError as e:
+            return 400, {'error': str(e)}
+
+        # Step 2: Queue every data point, they may end up in different batches
+        try:
+            results = await asyncio.gather(*(self.batcher.score(data_point) for data_point in data_points))
+        except Exception as e:
+            return 500, {'error': f'{type(e).__name__}: {e}'}
+        results = [{'scores': scores, 'score': score} for scores, score in results]
+        return 200, results if isinstance(payload, list) else results[0]
+
+    async def serve_connection(self, reader, writer):
+        try:
+            while True:
+                # Step 1: Request line and headers
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                # Step 2: Body
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_BYTES:
+                    status, payload = 413, {'error': f'body over {MAX_BODY_BYTES} bytes'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, payload = await self.handle(method, path.split('?', 1)[0], body)
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+
+                # Step 3: Response
+                response = json.dumps(payload).encode()
+                writer.write(
+                    f'HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n'
+                    f'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(response)}\r\n'
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + response
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080, unix_socket=None):
+        """Run the batcher and accept connections until cancelled"""
+        batcher_task = asyncio.create_task(self.batcher.run())
+        if unix_socket:
+            server = await asyncio.start_unix_server(self.serve_connection, path=unix_socket, backlog=LISTEN_BACKLOG)
+        else:
+            server = await asyncio.start_server(self.serve_connection, host, port, backlog=LISTEN_BACKLOG)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+            self.batcher.engine.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve online scoring of data points over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix-socket', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--backend', default=DEFAULT_BACKEND, help='embedding backend, eg: onnx-int8:<model_dir>')
+    parser.add_argument('--max-batch-size', type=int, default=64, help='most data points scored together')
+    parser.add_argument('--max-wait-ms', type=float, default=5, help='how long a batch waits for more data points')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-tokens', type=int, help='padded token budget per forward pass, replaces --batch-size')
+    parser.add_argument('--cache-dir', help='on-disk embedding cache directory')
+    args = parser.parse_args()
+
+    # Step 1: Load the model once, before accepting any request
+    engine = ScoringEngine(
+        args.backend, cache_dir=args.cache_dir, batch_size=args.batch_size, max_tokens=args.max_tokens
+    )
+    engine.model
+
+    # Step 2: Serve
+    batcher = MicroBatcher(engine, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000)
+    try:
+        asyncio.run(ScoringService(batcher).serve(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
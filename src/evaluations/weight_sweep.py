@@ -0,0 +1,261 @@
+"""
+cd src/evaluations
+python weight_sweep.py --equal ../../data/scored_equal.json --non-equal ../../data/scored_non_equal.json --samples 5000
+python weight_sweep.py --equal ../../data/scored_equal.columns --non-equal ../../data/scored_non_equal.columns --grid semantic_importance=0.5:1:0.05 context_source_score_threshold=0.6,0.75,0.9
+python weight_sweep.py --samples 20000 --rank-by mean_gap --output ../../data/weight_sweep.json --best ../../data/best_weights.json  # then: score_builder.py --weights ../../data/best_weights.json
+"""
+
+import os
+import sys
+import json
+import argparse
+import itertools
+import numpy as np
+
+sys.path.append(os.path.abspath('../../'))
+from src.data_handling.columnar_store import COLUMNAR_SUFFIX, ColumnarScores
+from src.data_handling.record_io import iter_records, iter_chunks
+from src.evaluations.metric_graph import SCORE_FIELDS
+from src.metrics.utils import ScoringWeights, default_weights, scores_to_columns, compute_eval_scores_for_responses
+
+data_path = '../../data'
+
+# Weights sampled together so they sum to one, as the defaults do
+SUMMED_WEIGHTS = (
+    ('semantic_importance_for_response_comparison', 'rouge_importance_for_response_comparison',
+     'bleu_importance_for_response_comparison'),
+    ('rouge1_importance', 'rouge2_importance', 'rougeL_importance'),
+    ('ai_importance_for_eval', 'human_importance_for_eval', 'response_importance_for_eval'),
+)
+RANK_METRICS = ('auc', 'mean_gap')
+SWEEP_CELLS = 1 << 22  # configs * rows scored per broadcast, bounds the size of the intermediates
+LOAD_CHUNK_SIZE = 65536
+
+
+def load_score_columns(path):
+    """
+    Read the metric columns of a scored dataset once, as `scores_to_columns` lays them out.
+
+    Args:
+        - path (str): scored .json or .jsonl file, or .columns directory (memory-mapped)
+
+    Returns:
+        - columns (dict): one float64 array per `scores` field, `responses_rouge` a dict of arrays
+    """
+    # Step 1: Columnar datasets already hold one array per metric
+    if path.rstrip('/').endswith(COLUMNAR_SUFFIX):
+        store = ColumnarScores(path)
+        columns = {}
+        for name in store.columns:
+            field, _, key = name.partition('.')
+            if field == 'score':
+                continue
+            if key:
+                columns.setdefault(field, {})[key] = store.column(name)
+            else:
+                columns[field] = store.column(name)
+
+    # Step 2: Record files are turned into columns a chunk at a time
+    else:
+        parts = [
+            scores_to_columns([record['scores'] for record in chunk])
+            for chunk in iter_chunks(iter_records(path), LOAD_CHUNK_SIZE)
+        ]
+        columns = concatenate_columns(parts) if parts else {}
+
+    missing = [field for field in SCORE_FIELDS if field not in columns]
+    if missing:
+        raise ValueError(f'{path} lacks the metrics {missing}, sweeping needs datasets scored without --metrics')
+    return columns
+
+
+def concatenate_columns(parts):
+    """Join columns of consecutive row ranges, eg: two datasets into one"""
+    columns = {}
+    for field, value in parts[0].items():
+        if isinstance(value, dict):
+            columns[field] = {key: np.concatenate([part[field][key] for part in parts]) for key in value}
+        else:
+            columns[field] = np.concatenate([part[field] for part in parts])
+    return columns
+
+
+def parse_grid(specs):
+    """
+    Cartesian product of weight values.
+
+    Args:
+        - specs (list(str)): eg: ['semantic_importance=0.6,0.7,0.8', 'ai_importance_for_eval=0:1:0.25'],
+            `start:stop:step` ranges include `stop`
+
+    Returns:
+        - configs (list(dict)): field -> value, one per grid point
+    """
+    fields, values = [], []
+    for spec in specs:
+        field, _, value = spec.partition('=')
+        if field not in ScoringWeights._fields:
+            raise ValueError(f'unknown weight {field!r}, expected one of {list(ScoringWeights._fields)}')
+        if ':' in value:
+            start, stop, step = (float(part) for part in value.split(':'))
+            points = np.arange(start, stop + step / 2, step).round(10).tolist()
+        else:
+            points = [float(part) for part in value.split(',')]
+        fields.append(field)
+        values.append(points)
+    return [dict(zip(fields, point)) for point in itertools.product(*values)]
+
+
+def sample_configs(samples, seed=0):
+    """
+    Random weight configurations, the summed groups drawn uniformly from the simplex.
+
+    Returns:
+        - configs (dict): field -> array of `samples` values
+    """
+    rng = np.random.default_rng(seed)
+    configs = {}
+    for group in SUMMED_WEIGHTS:
+        draws = rng.dirichlet(np.ones(len(group)), size=samples)
+        configs.update({field: draws[:, idx] for idx, field in enumerate(group)})
+    configs['semantic_importance'] = rng.uniform(0, 1, samples)
+    configs['context_source_score_threshold'] = rng.uniform(0, 1, samples)
+    return configs
+
+
+def build_configs(grid=None, samples=0, seed=0):
+    """
+    Every configuration to sweep as one `ScoringWeights` of arrays, the defaults first.
+
+    Returns:
+        - configs (ScoringWeights): each field an array of one value per configuration
+    """
+    defaults = default_weights()
+    grid_configs = parse_grid(grid) if grid else []
+    sampled = sample_configs(samples, seed) if samples else {}
+    fields = []
+    for field, default in defaults._asdict().items():
+        values = [default] + [config.get(field, default) for config in grid_configs]
+        fields.append(np.concatenate([np.array(values, dtype=np.float64), sampled.get(field, np.full(samples, default))]))
+    return ScoringWeights(*fields)
+
+
+def rank_auc(scores, positives):
+    """
+    Area under the ROC curve of every row of scores, ties counting half.
+
+    Computed as the Mann-Whitney U statistic from the mid-ranks of each row.
+
+    Args:
+        - scores (np.ndarray): (configs, rows), the first `positives` rows are expected to score higher
+        - positives (int)
+
+    Returns:
+        - auc (np.ndarray): one value per configuration
+    """
+    rows = scores.shape[1]
+    order = np.argsort(scores, axis=1, kind='stable')
+    ordered = np.take_along_axis(scores, order, axis=1)
+    positions = np.arange(rows)
+
+    # Step 1: First and last sorted position of every run of equal scores
+    starts = np.ones(ordered.shape, dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    ends = np.ones(ordered.shape, dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, positions, rows - 1)[:, ::-1], axis=1)[:, ::-1]
+
+    # Step 2: Mid-ranks back in row order, U from the ranks of the positives
+    ranks = np.empty(ordered.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2 + 1, axis=1)
+    u = ranks[:, :positives].sum(axis=1) - positives * (positives + 1) / 2
+    return u / (positives * (rows - positives))
+
+
+def sweep(configs, equal, non_equal, max_cells=SWEEP_CELLS):
+    """
+    Score both datasets under every configuration and measure how far apart they end up.
+
+    Each broadcast scores a slice of configurations against every row at once,
+    sliced so that configurations * rows stays under `max_cells`.
+
+    Args:
+        - configs (ScoringWeights): fields are arrays of one value per configuration
+        - equal (dict): metric columns of the equal dataset, expected to score higher
+        - non_equal (dict): metric columns of the non-equal dataset
+
+    Returns:
+        - results (dict): 'auc' and 'mean_gap' arrays, one value per configuration
+    """
+    positives = len(equal['source_context_similarity'])
+    columns = concatenate_columns([equal, non_equal])
+    rows = len(columns['source_context_similarity'])
+    count = len(configs.semantic_importance)
+    step = max(1, max_cells // rows)
+    results = {metric: np.empty(count) for metric in RANK_METRICS}
+    for start in range(0, count, step):
+        end = min(start + step, count)
+        weights = ScoringWeights(*(field[start:end, None] for field in configs))
+        scores = compute_eval_scores_for_responses(weights, **columns)
+        results['auc'][start:end] = rank_auc(scores, positives)
+        results['mean_gap'][start:end] = scores[:, :positives].mean(axis=1) - scores[:, positives:].mean(axis=1)
+    return results
+
+
+def config_at(configs, idx):
+    return {field: float(values[idx]) for field, values in configs._asdict().items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep final score weights over already scored datasets')
+    parser.add_argument('--equal', default=f'{data_path}/scored_equal.json',
+                        help='scored dataset whose responses should score higher')
+    parser.add_argument('--non-equal', default=f'{data_path}/scored_non_equal.json')
+    parser.add_argument('--grid', nargs='+', metavar='WEIGHT=VALUES',
+                        help='weight values to combine, eg: semantic_importance=0.6,0.8 or ai_importance_for_eval=0:1:0.1')
+    parser.add_argument('--samples', type=int, default=0, help='random configurations to add to the grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rank-by', choices=RANK_METRICS, default='auc')
+    parser.add_argument('--top', type=int, default=10, help='best configurations to report')
+    parser.add_argument('--output', help='JSON report of the best configurations')
+    parser.add_argument('--best', help='write the best configuration here, for score_builder.py --weights')
+    args = parser.parse_args()
+
+    # Step 1: Load the metric columns of both datasets once
+    equal = load_score_columns(args.equal)
+    non_equal = load_score_columns(args.non_equal)
+
+    # Step 2: Score every configuration
+    configs = build_configs(args.grid, args.samples, args.seed)
+    results = sweep(configs, equal, non_equal)
+
+    # Step 3: Report the best ones next to the current defaults
+    ranking = np.argsort(-results[args.rank_by], kind='stable')[:args.top]
+    report = {
+        'rows': {'equal': len(equal['source_context_similarity']), 'non_equal': len(non_equal['source_context_similarity'])},
+        'configs': len(configs.semantic_importance),
+        'rank_by': args.rank_by,
+        'default': {'auc': float(results['auc'][0]), 'mean_gap': float(results['mean_gap'][0]), 'weights': config_at(configs, 0)},
+        'top': [
+            {'auc': float(results['auc'][idx]), 'mean_gap': float(results['mean_gap'][idx]), 'weights': config_at(configs, idx)}
+            for idx in ranking
+        ],
+    }
+    print(f"{report['configs']} configurations over {report['rows']['equal']} equal and {report['rows']['non_equal']} non-equal records")
+    print(f"{'':>8} {'auc':>7} {'gap':>7}  weights")
+    for name, entry in [('default', report['default'])] + [(f'#{rank + 1}', entry) for rank, entry in enumerate(report['top'])]:
+        weights = ' '.join(f'{value:.3g}' for value in entry['weights'].values())
+        print(f"{name:>8} {entry['auc']:7.4f} {entry['mean_gap']:7.4f}  {weights}")
+    print(f"weights: {' '.join(ScoringWeights._fields)}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    if args.best:
+        with open(args.best, 'w') as f:
+            json.dump(report['top'][0]['weights'], f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import time
+import numpy as np
+
+
+def approximate_token_lengths(texts):
+    # Rough wordpiece count for models that cannot tokenize on their own, plus [CLS] and [SEP]
+    return [len(text) // 4 + 2 for text in texts]
+
+
+def token_lengths(model, texts):
+    """Token length of every text as `model` tokenizes it, estimated when it cannot say"""
+    measure = getattr(model, 'token_lengths', None)
+    if measure is not None:
+        try:
+            return measure(texts)
+        except NotImplementedError:
+            pass
+    return approximate_token_lengths(texts)
+
+
+def pretokenize(model, texts):
+    """
+    Tokenize texts for `model.encode_tokenized`, ahead of the forward passes.
+
+    Returns:
+        - tokenized (tuple): (encodings, lengths) as `EmbeddingBackend.tokenize` returns them,
+            None when the model only embeds raw texts
+    """
+    tokenize = getattr(model, 'tokenize', None)
+    if tokenize is None or getattr(model, 'encode_tokenized', None) is None:
+        return None
+    try:
+        return tokenize(texts)
+    except NotImplementedError:
+        return None
+
+
+class TokenBudgetScheduler:
+    """
+    Forms inference batches under a token budget instead of a fixed text count.
+
+    A forward pass costs roughly (texts in batch) * (longest text in batch)
+    tokens, padding included. Pending texts are ordered by tokenized length,
+    which puts texts of equal length in the same bucket, and each batch is grown
+    until that padded cost would exceed `max_tokens`. Short responses therefore
+    go in large batches and long conversations in small ones, with little padding
+    in either.
+
+    The scheduler keeps running totals so the budget can be tuned per host.
+
+    Args:
+        - max_tokens (int): padded tokens allowed in one forward pass
+        - max_batch_size (int): texts allowed in one forward pass, whatever their length
+    """
+
+    def __init__(self, max_tokens=16384, max_batch_size=512):
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.texts = 0
+        self.batches = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.seconds = 0.0
+
+    def merge_stats(self, stats):
+        """Add the totals of another scheduler, eg: one running in a worker process"""
+        self.texts += stats['texts']
+        self.batches += stats['batches']
+        self.tokens += stats['tokens']
+        self.padded_tokens += stats['padded_tokens']
+        self.seconds += stats['seconds']
+
+    def plan(self, lengths):
+        """
+        Split texts into batches under the token budget.
+
+        Args:
+            - lengths (list(int)): token length of every text
+
+        Returns:
+            - batches (list(list(int))): indices of the texts in each batch, longest first
+        """
+        order = sorted(range(len(lengths)), key=lambda idx: lengths[idx], reverse=True)
+        batches = []
+        batch = []
+        for idx in order:
+            # The first text of a batch is its longest, so it sets the padded length
+            if batch and ((len(batch) + 1) * lengths[batch[0]] > self.max_tokens or len(batch) == self.max_batch_size):
+                batches.append(batch)
+                batch = []
+            batch.append(idx)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def encode(self, model, texts, normalize_embeddings=True, lengths=None, encodings=None):
+        """
+        Embed texts batch by batch and return them in input order.
+
+        Args:
+            - model (EmbeddingBackend): model to embed with, `token_lengths` is used when it has one
+            - texts (list(str)): texts to embed
+            - normalize_embeddings (bool): scale every embedding to unit length
+            - lengths (list(int)): token length of every text, measured here if not given
+            - encodings (list): the texts already tokenized by `pretokenize`, the batches are then
+                embedded with `model.encode_tokenized` and not tokenized again
+
+        Returns:
+            - embeddings (np.ndarray): shape (len(texts), dim)
+        """
+        # Step 1: Measure every text the way the model tokenizes it
+        if lengths is None:
+            lengths = token_lengths(model, texts)
+
+        # Step 2: Run every batch as a single forward pass and scatter back to input order
+        embeddings = None
+        for batch in self.plan(lengths):
+            start = time.perf_counter()
+            if encodings is not None:
+                batch_embeddings = model.encode_tokenized(
+                    [encodings[idx] for idx in batch], normalize_embeddings=normalize_embeddings, batch_size=len(batch)
+                )
+            else:
+                batch_embeddings = model.encode(
+                    [texts[idx] for idx in batch], normalize_embeddings=normalize_embeddings, batch_size=len(batch)
+                )
+            batch_embeddings = np.asarray(batch_embeddings, dtype=np.float32)
+            self.seconds += time.perf_counter() - start
+            if embeddings is None:
+                embeddings = np.empty((len(texts), batch_embeddings.shape[1]), dtype=np.float32)
+            embeddings[batch] = batch_embeddings
+
+            # Step 3: Account for real and padded tokens
+            self.texts += len(batch)
+            self.batches += 1
+            self.tokens += sum(lengths[idx] for idx in batch)
+            self.padded_tokens += len(batch) * lengths[batch[0]]
+
+        if embeddings is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return embeddings
+
+    def stats(self):
+        """
+        Totals since the last `reset_stats`.
+
+        Returns:
+            - stats (dict): texts, batches, tokens, padded tokens, padding efficiency
+                (real / padded tokens) and real tokens embedded per second
+        """
+        return {
+            'max_tokens': self.max_tokens,
+            'texts': self.texts,
+            'batches': self.batches,
+            'tokens': self.tokens,
+            'padded_tokens': self.padded_tokens,
+            'padding_efficiency': self.tokens / self.padded_tokens if self.padded_tokens else 1.0,
+            'seconds': self.seconds,
+            'tokens_per_second': self.tokens / self.seconds if self.seconds else 0.0,
+        }
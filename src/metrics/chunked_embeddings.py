@@ -0,0 +1,165 @@
+import numpy as np
+
+from src.metrics.batching import token_lengths
+from src.metrics.compute_cosine import plan_encoding, run_encoding
+
+CHUNK_POOLINGS = ('mean', 'recency')
+
+# [CLS] and [SEP], counted once per chunk rather than once per message
+SPECIAL_TOKENS = 2
+
+
+def chunk_messages(messages, lengths, max_tokens=512):
+    """
+    Pack consecutive messages into chunks that fit the model's input.
+
+    Chunks are filled greedily from the first message, so appending a turn to a
+    conversation only ever changes its last chunk. A message longer than
+    `max_tokens` on its own gets a chunk to itself and is truncated by the model.
+
+    Args:
+        - messages (list(str)): message texts, oldest first
+        - lengths (list(int)): token length of every message, special tokens included
+        - max_tokens (int): model input limit
+
+    Returns:
+        - chunks (list(str)): chunk texts, joined like `build_conversation_text`
+    """
+    chunks = []
+    chunk = []
+    chunk_tokens = SPECIAL_TOKENS
+    for message, length in zip(messages, lengths):
+        message_tokens = length - SPECIAL_TOKENS
+        if chunk and chunk_tokens + message_tokens > max_tokens:
+            chunks.append(''.join(chunk))
+            chunk = []
+            chunk_tokens = SPECIAL_TOKENS
+        chunk.append(f' {message}')
+        chunk_tokens += message_tokens
+    if chunk:
+        chunks.append(''.join(chunk))
+    return chunks
+
+
+def pool_chunks(chunk_embeddings, pooling='mean', recency_decay=0.5):
+    """
+    Pool the chunk embeddings of a conversation into one normalised embedding.
+
+    Args:
+        - chunk_embeddings (np.ndarray): shape (n_chunks, dim), oldest chunk first
+        - pooling (str): 'mean', or 'recency' to weight chunk i of n by recency_decay ** (n - 1 - i)
+        - recency_decay (float): weight ratio between a chunk and the one after it
+
+    Returns:
+        - embedding (np.ndarray): shape (dim,)
+    """
+    if pooling == 'mean':
+        pooled = chunk_embeddings.mean(axis=0)
+    elif pooling == 'recency':
+        weights = recency_decay ** np.arange(len(chunk_embeddings) - 1, -1, -1, dtype=np.float32)
+        pooled = weights @ chunk_embeddings
+    else:
+        raise ValueError(f'Unknown pooling: {pooling}, expected one of {CHUNK_POOLINGS}')
+    return pooled / max(np.linalg.norm(pooled), 1e-12)
+
+
+class ConversationChunker:
+    """
+    Embeds conversations past the model's token limit as pooled message-aligned chunks.
+
+    A conversation embedded whole only ever shows its first `max_tokens` to the
+    model. Here every conversation is split into chunks along its message
+    boundaries, all chunks of a batch are embedded together with the other
+    texts and each conversation gets the pooled embedding of its chunks. A
+    conversation that fits in one chunk embeds exactly as it would whole.
+
+    Chunks go through the embedding cache like any text, so when a conversation
+    grows by a turn only its last chunk is embedded again.
+
+    Args:
+        - max_tokens (int): model input limit
+        - pooling (str): 'mean' or 'recency', see `pool_chunks`
+        - recency_decay (float): weight ratio between consecutive chunks for 'recency' pooling
+    """
+
+    def __init__(self, max_tokens=512, pooling='mean', recency_decay=0.5):
+        if pooling not in CHUNK_POOLINGS:
+            raise ValueError(f'Unknown pooling: {pooling}, expected one of {CHUNK_POOLINGS}')
+        self.max_tokens = max_tokens
+        self.pooling = pooling
+        self.recency_decay = recency_decay
+
+    def plan(self, model, texts, conversations, cache=None, scheduler=None, tokenize=False):
+        """
+        Chunk the conversations and prepare plain texts and chunks for one embedding pass.
+
+        Args:
+            - model (EmbeddingBackend): model the texts will be embedded with
+            - texts (iterable(str)): texts embedded whole, eg: responses
+            - conversations (dict): conversation text -> list of its message texts
+            - cache (EmbeddingCache): optional on-disk embedding cache, looked up per chunk
+            - scheduler (TokenBudgetScheduler): optional token budget batching
+            - tokenize (bool): also produce the model inputs of the texts left, see `plan_encoding`
+
+        Returns:
+            - plan (EncodingPlan): see `plan_encoding`
+            - conversation_chunks (dict): conversation text -> texts of its chunks, for `pool`
+        """
+        # Step 1: Measure every distinct message once
+        unique_messages = list(dict.fromkeys(message for messages in conversations.values() for message in messages))
+        message_lengths = dict(zip(unique_messages, token_lengths(model, unique_messages)))
+
+        # Step 2: Split every conversation into chunks
+        conversation_chunks = {
+            conversation: chunk_messages(messages, [message_lengths[message] for message in messages], self.max_tokens)
+            or [conversation]
+            for conversation, messages in conversations.items()
+        }
+
+        # Step 3: Plan chunks and plain texts together
+        chunk_texts = (chunk for chunks in conversation_chunks.values() for chunk in chunks)
+        plan = plan_encoding(model, [*texts, *chunk_texts], cache=cache, scheduler=scheduler, tokenize=tokenize)
+        return plan, conversation_chunks
+
+    def pool(self, index, embeddings, conversation_chunks):
+        """
+        Give every conversation the pooled embedding of its chunks.
+
+        Returns:
+            - index (dict): maps every text and conversation text to its row in `embeddings`
+            - embeddings (np.ndarray): chunk embeddings with the pooled ones appended
+        """
+        index = dict(index)
+        pooled = []
+        for conversation, chunks in conversation_chunks.items():
+            if len(chunks) == 1:
+                index[conversation] = index[chunks[0]]
+                continue
+            index[conversation] = len(embeddings) + len(pooled)
+            pooled.append(pool_chunks(embeddings[[index[chunk] for chunk in chunks]], self.pooling, self.recency_decay))
+        if pooled:
+            embeddings = np.vstack([embeddings, np.asarray(pooled, dtype=np.float32)])
+        return index, embeddings
+
+    def encode(self, model, texts, conversations, batch_size=64, cache=None, scheduler=None, codec=None):
+        """
+        Embed plain texts and chunked conversations in one pass.
+
+        Args:
+            - model (EmbeddingBackend): model used for the embeddings
+            - texts (iterable(str)): texts embedded whole, eg: responses
+            - conversations (dict): conversation text -> list of its message texts
+            - batch_size (int): number of texts per forward pass
+            - cache (EmbeddingCache): optional on-disk embedding cache, filled per chunk
+            - scheduler (TokenBudgetScheduler): optional token budget batching
+            - codec (EmbeddingCodec): optional storage mode, chunks are pooled in its dimensions
+
+        Returns:
+            - index (dict): maps every text and conversation text to its row in `embeddings`
+            - embeddings (np.ndarray): normalised embeddings
+        """
+        plan, conversation_chunks = self.plan(model, texts, conversations, cache=cache, scheduler=scheduler)
+        index, embeddings = run_encoding(
+            model, plan, batch_size=batch_size, cache=cache, scheduler=scheduler, codec=codec
+        )
+        return self.pool(index, embeddings, conversation_chunks)
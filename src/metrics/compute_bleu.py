@@ -1,4 +1,11 @@
-from nltk.translate.bleu_score import sentence_bleu
+import sys
+import math
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+
+from src.metrics.profiling import profiler, profiled
 
 # def compute_bleu(data_list):
 #     """method to compute bleu scores
@@ -30,7 +37,7 @@ from nltk.translate.bleu_score import sentence_bleu
 #         trigram_scores.append(sentence_bleu([data[2]], data[3], weights=(0, 0, 1, 0)))
 #         quadgram_scores.append(sentence_bleu([data[2]], data[3], weights=(0, 0, 0, 1)))
 #         generalised_scores.append(sentence_bleu([data[2]], data[3]))
-    
+
 #     # Step 3: Compute the n-gram scores
 #     unigram_score = sum(unigram_scores) / len(unigram_scores)
 #     bigram_score = sum(bigram_scores) / len(bigram_scores)
@@ -49,24 +56,123 @@ bleu_weight_mapping = {
     'quad': (0, 0, 0, 1),
 }
 
-def compute_bleu_score(source, target, n_gram='all'):
+# Tokenisation modes:
+#   - char: every character is a token, which is what sentence_bleu does with raw strings
+#   - word: whitespace separated words
+BLEU_TOKENIZATION_MODES = ('char', 'word')
+MAX_NGRAM_ORDER = 4
+
+
+@lru_cache(maxsize=65536)
+def ngram_counts(text, mode='char'):
+    """Tokenize a text once and count its 1 to 4-grams
+
+    Args:
+        - text (str): text to count
+        - mode (str): tokenisation mode, 'char' or 'word'
+
+    Returns:
+        - length (int): number of tokens
+        - counts (tuple(Counter)): n-gram counts, counts[n - 1] holds the n-grams
+    """
+    if mode == 'char':
+        # Substrings hash faster than tuples and compare the same way
+        grams = [Counter(text[i:i + n] for i in range(len(text) - n + 1)) for n in range(1, MAX_NGRAM_ORDER + 1)]
+        return len(text), tuple(grams)
+    if mode == 'word':
+        tokens = text.split()
+        grams = [Counter(zip(*(tokens[i:] for i in range(n)))) for n in range(1, MAX_NGRAM_ORDER + 1)]
+        return len(tokens), tuple(grams)
+    raise ValueError(f'Unknown BLEU tokenisation mode: {mode}, expected one of {BLEU_TOKENIZATION_MODES}')
+
+
+profiler.watch_cache('bleu_ngram_counts', ngram_counts)
+
+
+def compute_bleu_scores(source, target, mode='char'):
+    """method to compute every bleu score variant from one pass
+
+    Matches `sentence_bleu([source], target, weights=...)` for each of the
+    `bleu_weight_mapping` weights, with `source` and `target` tokenized as per `mode`.
+
+    Args:
+        - source (str): reference string for comparison
+        - target (str): hypothesis string for comparison
+        - mode (str): tokenisation mode, 'char' or 'word'
+
+    Returns:
+        - scores (dict): score for each key of `bleu_weight_mapping`
+    """
+    # Step 1: Fetch the cached n-gram tables
+    ref_len, ref_counts = ngram_counts(source, mode)
+    hyp_len, hyp_counts = ngram_counts(target, mode)
+
+    # Step 2: Clipped n-gram precisions
+    numerators = []
+    log_precisions = []
+    for hyp, ref in zip(hyp_counts, ref_counts):
+        numerator = sum(min(count, ref[ngram]) for ngram, count in hyp.items())
+        denominator = max(1, sum(hyp.values()))
+        numerators.append(numerator)
+        # No smoothing: an order without overlap counts as the smallest float
+        log_precisions.append(math.log(numerator / denominator) if numerator else math.log(sys.float_info.min))
+
+    if numerators[0] == 0:
+        return {n_gram: 0.0 for n_gram in bleu_weight_mapping}
+
+    # Step 3: Brevity penalty
+    if hyp_len > ref_len:
+        bp = 1
+    elif hyp_len == 0:
+        bp = 0
+    else:
+        bp = math.exp(1 - ref_len / hyp_len)
+
+    # Step 4: Geometric mean for each weighting
+    return {
+        n_gram: bp * math.exp(math.fsum(w_i * log_p for w_i, log_p in zip(weights, log_precisions)))
+        for n_gram, weights in bleu_weight_mapping.items()
+    }
+
+
+def compute_bleu_scores_batch(sources, targets, mode='char'):
+    """method to compute every bleu score variant for many pairs
+
+    Args:
+        - sources (list(str)): reference strings
+        - targets (list(str)): hypothesis strings
+        - mode (str): tokenisation mode, 'char' or 'word'
+
+    Returns:
+        - scores (dict): array of scores for each key of `bleu_weight_mapping`
+    """
+    pair_scores = [compute_bleu_scores(source, target, mode) for source, target in zip(sources, targets)]
+    return {
+        n_gram: np.fromiter((scores[n_gram] for scores in pair_scores), dtype=np.float64, count=len(pair_scores))
+        for n_gram in bleu_weight_mapping
+    }
+
+
+@profiled('compute_bleu_score')
+def compute_bleu_score(source, target, n_gram='all', mode='char'):
     """method to compute bleu scores
 
     Args:
         - source (str): string for comparison
         - target (str): string for comparison
         - n_gram (str): string for generating n-gram score
-            - all 
+            - all
             - uni
             - bi
             - tri
             - quad
+        - mode (str): tokenisation mode, 'char' (as sentence_bleu on raw strings) or 'word'
 
     Returns:
         - score (float)
     """
     # Step 1: Compute bleu score based on n-grams
-    score = sentence_bleu([source], target, weights=bleu_weight_mapping[n_gram])
+    score = compute_bleu_scores(source, target, mode)[n_gram]
 
     # Step 2: Return the score
     return score
@@ -1,8 +1,13 @@
 # from sentence_transformers import SentenceTransformer
 # model = SentenceTransformer('BAAI/bge-base-en-v1.5')
+import numpy as np
 
+from src.metrics.batching import token_lengths, pretokenize
+from src.metrics.profiling import profiler, profiled
 
-def compute_similarity(model, source, target):
+
+@profiled('compute_similarity')
+def compute_similarity(model, source, target, cache=None):
     """
     Calculate the cosine similarity between embeddings of source and target strings.
 
@@ -13,6 +18,7 @@ def compute_similarity(model, source, target):
         - model (SentenceTransformer): A pre-trained SentenceTransformer model capable of encoding text into embeddings.
         - source (str): The source text string from which to generate the embedding.
         - target (str): The target text string from which to generate the embedding.
+        - cache (EmbeddingCache): Optional on-disk embedding cache consulted before the model.
 
     Returns:
         - similarity (float) : The cosine similarity score between the source and target embeddings.
@@ -21,7 +27,179 @@ def compute_similarity(model, source, target):
     The function assumes that the `model` passed has an `encode` method which supports the `normalize_embeddings` parameter.
     The cosine similarity is a value between 0 and 1, where 1 indicates perfect similarity, 0 indicates no similarity.
     """
+    if cache is not None:
+        index, embeddings = encode_texts(model, [source, target], cache=cache)
+        return embeddings[index[source]] @ embeddings[index[target]].T
     source_embeddings = model.encode(source, normalize_embeddings=True)
     target_embeddings = model.encode(target, normalize_embeddings=True)
     similarity = source_embeddings @ target_embeddings.T
     return similarity
+
+
+class EncodingPlan:
+    """
+    Work left to embed a set of texts once the per-text CPU work is done.
+
+    Built by `plan_encoding`, run by `run_encoding`. Splitting the two lets a
+    pipeline prepare the next batch of texts while the model embeds this one.
+
+    Attributes:
+        - unique_texts (list(str)): every distinct text, in first-seen order
+        - index (dict): maps each unique text to its row in the embeddings
+        - cached (dict): embeddings found in the cache
+        - order (list(int)): rows of the texts the model has to embed, longest first
+        - sorted_texts (list(str)): those texts, in that order
+        - lengths (list(int)): token length of every sorted text, measured when batching under a
+            token budget or tokenizing ahead
+        - encodings (list): model input of every sorted text when tokenized ahead, see `plan_encoding`
+    """
+
+    def __init__(self, unique_texts, index, cached, order, sorted_texts, lengths=None, encodings=None):
+        self.unique_texts = unique_texts
+        self.index = index
+        self.cached = cached
+        self.order = order
+        self.sorted_texts = sorted_texts
+        self.lengths = lengths
+        self.encodings = encodings
+
+
+def plan_encoding(model, texts, cache=None, scheduler=None, tokenize=False):
+    """
+    Deduplicate texts, look them up in the cache and, with a scheduler, tokenize the rest.
+
+    Args:
+        - model (SentenceTransformer): Model the texts will be embedded with.
+        - texts (iterable(str)): Texts to embed, duplicates allowed.
+        - cache (EmbeddingCache): Optional on-disk embedding cache.
+        - scheduler (TokenBudgetScheduler): Optional token budget batching, the token
+            lengths it plans with are measured here.
+        - tokenize (bool): Turn the texts left for the model into its inputs here, so
+            `run_encoding` only runs forward passes. Models without `tokenize` embed raw texts.
+
+    Returns:
+        - plan (EncodingPlan)
+    """
+    # Step 1: Deduplicate, keeping first-seen order for a stable index
+    unique_texts = list(dict.fromkeys(texts))
+    index = {text: row for row, text in enumerate(unique_texts)}
+
+    # Step 2: Only texts missing from the cache need the model
+    cached = cache.get_many(unique_texts) if cache is not None and unique_texts else {}
+    missing = [row for row, text in enumerate(unique_texts) if text not in cached]
+    if cache is not None and unique_texts:
+        profiler.count('embedding_cache', hits=len(cached), misses=len(missing))
+
+    # Step 3: Sort longest-first so batches hold texts of similar length
+    order = sorted(missing, key=lambda row: len(unique_texts[row]), reverse=True)
+    sorted_texts = [unique_texts[row] for row in order]
+    lengths = encodings = None
+    if tokenize and sorted_texts:
+        encodings, lengths = pretokenize(model, sorted_texts) or (None, None)
+    if lengths is None and scheduler is not None and sorted_texts:
+        lengths = token_lengths(model, sorted_texts)
+    return EncodingPlan(unique_texts, index, cached, order, sorted_texts, lengths, encodings)
+
+
+def run_encoding(model, plan, batch_size=64, cache=None, scheduler=None, codec=None):
+    """
+    Embed the texts of a plan and assemble them with its cached embeddings.
+
+    Args:
+        - model (SentenceTransformer): Model exposing `encode(list, normalize_embeddings=True, batch_size=...)`.
+        - plan (EncodingPlan): As returned by `plan_encoding`.
+        - batch_size (int): Number of texts per forward pass.
+        - cache (EmbeddingCache): Optional on-disk embedding cache the new embeddings are stored in.
+        - scheduler (TokenBudgetScheduler): Optional scheduler forming batches under a token
+            budget, `batch_size` is ignored when given.
+        - codec (EmbeddingCodec): Optional storage mode, new embeddings are cut down to its
+            dimensions before they are cached.
+
+    Returns:
+        - index (dict): Maps each unique text to its row in `embeddings`.
+        - embeddings (np.ndarray): Normalised embeddings of shape (n_unique, dim).
+    """
+    if not plan.unique_texts:
+        return plan.index, np.zeros((0, 0), dtype=np.float32)
+
+    # Step 1: Encode in large batches
+    sorted_embeddings = None
+    if plan.sorted_texts:
+        with profiler.span('model.encode', len(plan.sorted_texts)):
+            if scheduler is not None:
+                sorted_embeddings = scheduler.encode(
+                    model, plan.sorted_texts, lengths=plan.lengths, encodings=plan.encodings
+                )
+            elif plan.encodings is not None:
+                sorted_embeddings = np.asarray(
+                    model.encode_tokenized(plan.encodings, normalize_embeddings=True, batch_size=batch_size),
+                    dtype=np.float32,
+                )
+            else:
+                sorted_embeddings = np.asarray(
+                    model.encode(plan.sorted_texts, normalize_embeddings=True, batch_size=batch_size),
+                    dtype=np.float32,
+                )
+        if codec is not None:
+            sorted_embeddings = codec.reduce(sorted_embeddings)
+
+    # Step 2: Scatter them back to index order and fill in the cached embeddings
+    if sorted_embeddings is not None:
+        dim = sorted_embeddings.shape[1]
+    else:
+        dim = len(next(iter(plan.cached.values())))
+    embeddings = np.empty((len(plan.unique_texts), dim), dtype=np.float32)
+    if sorted_embeddings is not None:
+        embeddings[plan.order] = sorted_embeddings
+    for text, embedding in plan.cached.items():
+        embeddings[plan.index[text]] = embedding
+
+    # Step 3: Cache the new embeddings only now, storing them may evict entries of this plan
+    if cache is not None and sorted_embeddings is not None:
+        cache.put_many(plan.sorted_texts, sorted_embeddings)
+    return plan.index, embeddings
+
+
+def encode_texts(model, texts, batch_size=64, cache=None, scheduler=None, codec=None):
+    """
+    Encode every distinct text exactly once, in length-sorted batches.
+
+    Duplicates are collapsed before hitting the model and the unique texts are
+    sorted longest-first so that each batch pads to a similar length. With a
+    cache, only texts missing from it are sent to the model.
+
+    Args:
+        - model (SentenceTransformer): Model exposing `encode(list, normalize_embeddings=True, batch_size=...)`.
+        - texts (iterable(str)): Texts to embed, duplicates allowed.
+        - batch_size (int): Number of texts per forward pass.
+        - cache (EmbeddingCache): Optional on-disk embedding cache.
+        - scheduler (TokenBudgetScheduler): Optional scheduler forming batches under a token
+            budget, `batch_size` is ignored when given.
+        - codec (EmbeddingCodec): Optional storage mode, see `run_encoding`.
+
+    Returns:
+        - index (dict): Maps each unique text to its row in `embeddings`.
+        - embeddings (np.ndarray): Normalised embeddings of shape (n_unique, dim).
+    """
+    plan = plan_encoding(model, texts, cache=cache, scheduler=scheduler)
+    return run_encoding(model, plan, batch_size=batch_size, cache=cache, scheduler=scheduler, codec=codec)
+
+
+def compute_similarities(embeddings, source_rows, target_rows):
+    """
+    Compute cosine similarities for many (source, target) pairs of an embedding matrix.
+
+    Args:
+        - embeddings (np.ndarray or CompactEmbeddings): Normalised embeddings as returned by
+            `encode_texts`, or their storage form, in which case the cosines are computed on it.
+        - source_rows (array-like(int)): Row of the source text for every pair.
+        - target_rows (array-like(int)): Row of the target text for every pair.
+
+    Returns:
+        - similarities (np.ndarray): One cosine similarity per pair.
+    """
+    if not isinstance(embeddings, np.ndarray):
+        return embeddings.similarities(source_rows, target_rows)
+    source_embeddings = embeddings[np.asarray(source_rows, dtype=np.intp)]
+    target_embeddings = embeddings[np.asarray(target_rows, dtype=np.intp)]
+    return np.einsum('ij,ij->i', source_embeddings, target_embeddings)
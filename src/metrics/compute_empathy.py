@@ -1,7 +1,275 @@
-from nltk.sentiment import SentimentIntensityAnalyzer
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
 
-def measure_empathy(response):
-    sia = SentimentIntensityAnalyzer()
+from src.metrics.profiling import profiler, profiled
+
+# Loading the VADER lexicon dominates the cost of a single score, so one
+# analyzer is built lazily per process and reused by every call
+_analyzer = None
+
+
+def get_analyzer():
+    """Return the process-wide SentimentIntensityAnalyzer, building it on first use"""
+    global _analyzer
+    if _analyzer is None:
+        # nltk is imported here rather than at module level, it takes a good part of a second
+        from nltk.sentiment import SentimentIntensityAnalyzer
+        _analyzer = SentimentIntensityAnalyzer()
+    return _analyzer
+
+
+@profiled('measure_empathy', size=lambda response, analyzer=None: len(response))
+def measure_empathy(response, analyzer=None):
+    """Compute the VADER compound score of a text
+
+    Args:
+        - response (str): text to score
+        - analyzer (SentimentIntensityAnalyzer): optional analyzer, defaults to the shared one
+
+    Returns:
+        - empathy_score (float)
+    """
+    sia = analyzer if analyzer is not None else get_analyzer()
     scores = sia.polarity_scores(response)
     empathy_score = scores['compound']
     return empathy_score
+
+
+def measure_empathy_batch(texts, analyzer=None, processes=None, chunksize=256):
+    """Compute the VADER compound score of many texts
+
+    Args:
+        - texts (list(str)): texts to score
+        - analyzer (SentimentIntensityAnalyzer): optional analyzer for in-process scoring
+        - processes (int): fan out across this many worker processes, each loading
+            its own analyzer once. In-process when None or 1.
+        - chunksize (int): number of texts sent to a worker at a time
+
+    Returns:
+        - empathy_scores (list(float)): one score per text, in input order
+    """
+    if processes is not None and processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            return list(pool.map(measure_empathy, texts, chunksize=chunksize))
+
+    sia = analyzer if analyzer is not None else get_analyzer()
+    return [sia.polarity_scores(text)['compound'] for text in texts]
+
+
+# Tokens of the prefix kept around when extending it: three tokens of
+# look-behind plus the last two tokens, whose look-ahead crosses into the response
+_BOUNDARY_TOKENS = 5
+
+
+class _SentiWindow:
+    """Stand-in for nltk's SentiText exposing only what `sentiment_valence` reads"""
+
+    __slots__ = ('words_and_emoticons', 'is_cap_diff')
+
+    def __init__(self, words_and_emoticons, is_cap_diff):
+        self.words_and_emoticons = words_and_emoticons
+        self.is_cap_diff = is_cap_diff
+
+
+def _tokenize(sia, text):
+    # Same tokens as SentiText.words_and_emoticons. SentiText builds a lookup of every
+    # (punctuation, word) combination in the text to strip a single leading or trailing
+    # punctuation mark; that only ever depends on the token itself, so check it directly
+    remove_punctuation = sia.constants.REGEX_REMOVE_PUNCTUATION
+    punctuation = set(sia.constants.PUNC_LIST)
+    tokens = []
+    for token in text.split():
+        if len(token) < 2:
+            continue
+        word = remove_punctuation.sub('', token)
+        if len(word) > 1 and word != token and (
+            (token.endswith(word) and token[:-len(word)] in punctuation)
+            or (token.startswith(word) and token[len(word):] in punctuation)
+        ):
+            token = word
+        tokens.append(token)
+    return tokens
+
+
+def _token_valence(sia, tokens, item, i, is_cap_diff):
+    # Mirrors the body of the token loop in SentimentIntensityAnalyzer.polarity_scores
+    if (
+        i < len(tokens) - 1
+        and item.lower() == 'kind'
+        and tokens[i + 1].lower() == 'of'
+    ) or item.lower() in sia.constants.BOOSTER_DICT:
+        return 0
+    return sia.sentiment_valence(0, _SentiWindow(tokens, is_cap_diff), item, i, [])[-1]
+
+
+class EmpathyPrefix:
+    """
+    VADER state of a conversation prefix that can be extended with responses.
+
+    `polarity_scores` is a sum of per-token valences, so the prefix is tokenised and
+    scored once and only the response tokens (plus the few prefix tokens whose
+    context crosses the boundary) are scored per response. The global parts of
+    VADER are kept as accumulators: the all-caps differential, the first 'but'
+    and the '!'/'?' counts. `measure(response)` is identical to
+    `polarity_scores(prefix + response)['compound']`.
+
+    Args:
+        - prefix (str): conversation text every response is appended to
+        - analyzer (SentimentIntensityAnalyzer): optional analyzer, defaults to the shared one
+    """
+
+    def __init__(self, prefix, analyzer=None):
+        self.analyzer = analyzer if analyzer is not None else get_analyzer()
+
+        # Step 1: Split after the last whitespace, the trailing word can merge with the response
+        cut = len(prefix)
+        while cut and not prefix[cut - 1].isspace():
+            cut -= 1
+        head, self.tail = prefix[:cut], prefix[cut:]
+
+        # Step 2: Tokenise the head once and collect its global accumulators
+        self.tokens = _tokenize(self.analyzer, head)
+        self.stable_end = max(0, len(self.tokens) - 2)
+        self.allcap_words = sum(1 for token in self.tokens if token.isupper())
+        self.exclamations = head.count('!')
+        self.questions = head.count('?')
+        self.first_index = {}
+        self.first_but = None
+        for i, token in enumerate(self.tokens):
+            self.first_index.setdefault(token, i)
+            if self.first_but is None and token.lower() == 'but':
+                self.first_but = i
+
+        # Step 3: Valences of tokens unaffected by what follows, per all-caps flag, built lazily
+        self._stable = {}
+        self._stable_but = {}
+        self._stable_halved = {}
+
+    def stable(self, is_cap_diff):
+        """Valences of the prefix tokens before the boundary, as polarity_scores computes them"""
+        if is_cap_diff not in self._stable:
+            valences = []
+            for i in range(self.stable_end):
+                item = self.tokens[i]
+                first = self.first_index[item]
+                if first < i:
+                    valences.append(valences[first])
+                else:
+                    valences.append(_token_valence(self.analyzer, self.tokens, item, i, is_cap_diff))
+            self._stable[is_cap_diff] = valences
+        return self._stable[is_cap_diff]
+
+    def _stable_with_but(self, is_cap_diff):
+        # 'but' inside the stable tokens: damp what precedes it, boost what follows
+        if is_cap_diff not in self._stable_but:
+            bi = self.first_but
+            self._stable_but[is_cap_diff] = [
+                sentiment * 0.5 if sidx < bi else (sentiment * 1.5 if sidx > bi else sentiment)
+                for sidx, sentiment in enumerate(self.stable(is_cap_diff))
+            ]
+        return self._stable_but[is_cap_diff]
+
+    def _stable_before_but(self, is_cap_diff):
+        # 'but' after the stable tokens: all of them are damped
+        if is_cap_diff not in self._stable_halved:
+            self._stable_halved[is_cap_diff] = [sentiment * 0.5 for sentiment in self.stable(is_cap_diff)]
+        return self._stable_halved[is_cap_diff]
+
+    def measure(self, response):
+        """
+        Compound score of the prefix with `response` appended.
+
+        Args:
+            - response (str): text appended to the prefix
+
+        Returns:
+            - empathy_score (float)
+        """
+        sia = self.analyzer
+        rest = self.tail + response
+
+        # Step 1: Tokenise only the part after the prefix head
+        new_tokens = _tokenize(sia, rest)
+        n_head = len(self.tokens)
+        n_total = n_head + len(new_tokens)
+        if not n_total:
+            return 0.0
+        allcap_words = self.allcap_words + sum(1 for token in new_tokens if token.isupper())
+        is_cap_diff = 0 < n_total - allcap_words < n_total
+
+        # Step 2: Score the boundary and response tokens against their first occurrence
+        offset = max(0, n_head - _BOUNDARY_TOKENS)
+        window = self.tokens[offset:] + new_tokens
+        stable = self.stable(is_cap_diff)
+        new_first = {}
+        computed = {}
+        valences = []
+        first_but = self.first_but
+        for j in range(self.stable_end, n_total):
+            item = window[j - offset]
+            first = self.first_index.get(item)
+            if first is None:
+                first = new_first.setdefault(item, j)
+            if first_but is None and j >= n_head and item.lower() == 'but':
+                first_but = j
+            if first < self.stable_end:
+                valences.append(stable[first])
+            else:
+                if first not in computed:
+                    computed[first] = _token_valence(sia, window, item, first - offset, is_cap_diff)
+                valences.append(computed[first])
+
+        # Step 3: Apply the 'but' rule across prefix and response
+        if first_but is None:
+            sentiments = chain(stable, valences)
+        elif first_but < self.stable_end:
+            sentiments = chain(self._stable_with_but(is_cap_diff), (valence * 1.5 for valence in valences))
+        else:
+            sentiments = chain(
+                self._stable_before_but(is_cap_diff),
+                (
+                    valence * 0.5 if j < first_but else (valence * 1.5 if j > first_but else valence)
+                    for j, valence in enumerate(valences, start=self.stable_end)
+                ),
+            )
+
+        # Step 4: Punctuation emphasis and normalisation, as in score_valence
+        sum_s = float(sum(sentiments))
+        exclamations = min(self.exclamations + rest.count('!'), 4)
+        questions = self.questions + rest.count('?')
+        punct_emph_amplifier = exclamations * 0.292
+        if questions > 1:
+            punct_emph_amplifier += questions * 0.18 if questions <= 3 else 0.96
+        if sum_s > 0:
+            sum_s += punct_emph_amplifier
+        elif sum_s < 0:
+            sum_s -= punct_emph_amplifier
+        return round(sia.constants.normalize(sum_s), 4)
+
+
+def measure_empathy_pairs(conversations, responses, analyzer=None, prefixes=None):
+    """Compute the compound score of every conversation with its response appended
+
+    Each distinct conversation is scanned once and extended with its responses, so
+    `measure_empathy_pairs([c], [r])[0] == measure_empathy(c + r)`.
+
+    Args:
+        - conversations (list(str)): conversation texts
+        - responses (list(str)): response appended to each conversation
+        - analyzer (SentimentIntensityAnalyzer): optional analyzer, defaults to the shared one
+        - prefixes (dict): optional conversation -> EmpathyPrefix cache shared between calls
+
+    Returns:
+        - empathy_scores (list(float)): one score per pair, in input order
+    """
+    prefixes = {} if prefixes is None else prefixes
+    scanned = len(prefixes)
+    empathy_scores = []
+    for conversation, response in zip(conversations, responses):
+        prefix = prefixes.get(conversation)
+        if prefix is None:
+            prefix = prefixes[conversation] = EmpathyPrefix(conversation, analyzer=analyzer)
+        empathy_scores.append(prefix.measure(response))
+    scanned = len(prefixes) - scanned
+    profiler.count('empathy_prefix', hits=len(empathy_scores) - scanned, misses=scanned)
+    return empathy_scores
@@ -1,43 +1,158 @@
-from rouge_score import rouge_scorer
-scorer = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
+import re
+from collections import Counter, namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+from src.metrics.profiling import profiler, profiled
+
+# Same tokenisation and stemming as rouge_score.rouge_scorer.RougeScorer(use_stemmer=True)
+NON_ALPHANUM_RE = re.compile(r'[^a-z0-9]+')
+ROUGE_TYPES = ('rouge1', 'rouge2', 'rougeL')
+
+Score = namedtuple('Score', ['precision', 'recall', 'fmeasure'])
+
+# Built on first use so that importing this module does not import nltk
+_stemmer = None
+
+
+def get_stemmer():
+    """Return the process-wide PorterStemmer, building it on first use"""
+    global _stemmer
+    if _stemmer is None:
+        from nltk.stem import porter
+        _stemmer = porter.PorterStemmer()
+    return _stemmer
+
+
+@lru_cache(maxsize=None)
+def stem(token):
+    """Memoized Porter stem, customer-service replies reuse a small vocabulary"""
+    return get_stemmer().stem(token)
 
-def compute_rouge_scoress(data_list):
-    """method to compute rouge scores
+
+@lru_cache(maxsize=65536)
+def tokenize(text):
+    """Lowercase, split on non alpha-numeric characters and stem words longer than 3 characters
 
     Args:
-        data_list (list): data from csv file
+        - text (str): text to tokenize
 
     Returns:
+        - tokens (tuple(str))
+    """
+    tokens = NON_ALPHANUM_RE.sub(' ', text.lower()).split()
+    return tuple(stem(token) if len(token) > 3 else token for token in tokens)
+
+
+profiler.watch_cache('rouge_tokenize', tokenize)
+profiler.watch_cache('rouge_stem', stem)
+
+
+def lcs_length(reference, prediction):
+    """Length of the longest common subsequence of two token sequences
+
+    Bit-parallel formulation: every reference position is a bit of one integer,
+    so each prediction token costs a few big-int operations instead of a table row.
+
+    Args:
+        - reference (tuple(str))
+        - prediction (tuple(str))
+
+    Returns:
+        - length (int)
+    """
+    # Step 1: Bitmask of the positions of each reference token
+    masks = {}
+    for position, token in enumerate(reference):
+        masks[token] = masks.get(token, 0) | (1 << position)
+
+    # Step 2: Scan the prediction, zero bits in `row` mark the LCS
+    full = (1 << len(reference)) - 1
+    row = full
+    for token in prediction:
+        matches = row & masks.get(token, 0)
+        row = ((row + matches) | (row - matches)) & full
+    return len(reference) - bin(row).count('1')
+
+
+def _fmeasure(precision, recall):
+    if precision + recall > 0:
+        return 2 * precision * recall / (precision + recall)
+    return 0.0
+
+
+def _score_ngrams(reference, prediction, n):
+    if n == 1:
+        reference_ngrams, prediction_ngrams = Counter(reference), Counter(prediction)
+    else:
+        reference_ngrams = Counter(zip(*(reference[i:] for i in range(n))))
+        prediction_ngrams = Counter(zip(*(prediction[i:] for i in range(n))))
+    overlap = sum(min(count, prediction_ngrams[ngram]) for ngram, count in reference_ngrams.items())
+    precision = overlap / max(sum(prediction_ngrams.values()), 1)
+    recall = overlap / max(sum(reference_ngrams.values()), 1)
+    return precision, recall, _fmeasure(precision, recall)
+
+
+def _score_lcs(reference, prediction):
+    if not reference or not prediction:
+        return 0, 0, 0
+    length = lcs_length(reference, prediction)
+    precision = length / len(prediction)
+    recall = length / len(reference)
+    return precision, recall, _fmeasure(precision, recall)
+
+
+def compute_rouge_scores_batch(sources, targets):
+    """method to compute rouge scores for many pairs
+
+    Every distinct text is tokenized and stemmed once. Results match
+    `RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True).score(source, target)`.
+
+    Args:
+        - sources (list(str)): reference texts
+        - targets (list(str)): predicted texts
+
+    Returns:
+        - scores (dict): for each rouge type, a dict of 'precision', 'recall'
+            and 'fmeasure' arrays with one value per pair
     """
     # Step 1: Declarations
+    count = min(len(sources), len(targets))
     scores = {
-        'rouge1': {'precision': [], 'recall': [], 'fmeasure': []},
-        'rouge2': {'precision': [], 'recall': [], 'fmeasure': []},
-        'rougeL': {'precision': [], 'recall': [], 'fmeasure': []},
+        rouge_type: {metric: np.zeros(count) for metric in Score._fields}
+        for rouge_type in ROUGE_TYPES
     }
 
-    # Step 2: Iterate over data_list to compute scores
-    for data in data_list:
-        score = scorer.score(data[2], data[3])
-        for k, v in score.items():
-            scores[k]['precision'].append(v.precision)
-            scores[k]['recall'].append(v.recall)
-            scores[k]['fmeasure'].append(v.fmeasure)
-    
-    for k,v in scores.items():
-        scores[k]['precision'] = sum(scores[k]['precision']) / len(scores[k]['precision'])
-        scores[k]['recall'] = sum(scores[k]['recall']) / len(scores[k]['recall'])
-        scores[k]['fmeasure'] = sum(scores[k]['fmeasure']) / len(scores[k]['fmeasure'])
-        
+    # Step 2: Iterate over the pairs to compute scores
+    for idx, (source, target) in enumerate(zip(sources, targets)):
+        reference, prediction = tokenize(source), tokenize(target)
+        pair_scores = {
+            'rouge1': _score_ngrams(reference, prediction, 1),
+            'rouge2': _score_ngrams(reference, prediction, 2),
+            'rougeL': _score_lcs(reference, prediction),
+        }
+        for rouge_type, values in pair_scores.items():
+            for metric, value in zip(Score._fields, values):
+                scores[rouge_type][metric][idx] = value
+
     return scores
 
+
+@profiled('compute_rouge_scores')
 def compute_rouge_scores(source, target):
     """method to compute rouge scores
 
     Args:
-        data_list (list): data from csv file
+        - source (str): reference text
+        - target (str): predicted text
 
     Returns:
+        - score (dict): Score(precision, recall, fmeasure) for each rouge type
     """
-    score = scorer.score(source, target)
-    return score
\ No newline at end of file
+    reference, prediction = tokenize(source), tokenize(target)
+    return {
+        'rouge1': Score(*_score_ngrams(reference, prediction, 1)),
+        'rouge2': Score(*_score_ngrams(reference, prediction, 2)),
+        'rougeL': Score(*_score_lcs(reference, prediction)),
+    }
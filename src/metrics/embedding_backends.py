@@ -0,0 +1,405 @@
+"""
+cd src/metrics
+python embedding_backends.py export --model-dir ../../models/bge-base-en-v1.5 --output ../../models/bge-base-en-v1.5-onnx --quantize
+python embedding_backends.py parity --reference ../../models/bge-base-en-v1.5 --candidate onnx-int8:../../models/bge-base-en-v1.5-onnx --input ../../data/structured_equal.json
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+sys.path.append(os.path.abspath('../../'))
+
+DEFAULT_BACKEND = 'BAAI/bge-base-en-v1.5'
+
+ONNX_MODEL_FILE = 'model.onnx'
+ONNX_QUANTIZED_MODEL_FILE = 'model_quantized.onnx'
+TOKENIZER_FILE = 'tokenizer.json'
+
+
+class EmbeddingBackend:
+    """
+    Interface of the models `encode_texts` and `compute_similarity` embed with.
+
+    A backend is built from a name (see `load_backend`) and that name is what
+    the embedding cache keys on, so vectors of different backends never mix.
+
+    Args:
+        - name (str): backend name, reloads the same backend through `load_backend`
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def encode(self, texts, normalize_embeddings=True, batch_size=64):
+        """
+        Embed one text or a list of texts.
+
+        Args:
+            - texts (str | list(str)): text(s) to embed
+            - normalize_embeddings (bool): scale every embedding to unit length
+            - batch_size (int): number of texts per forward pass
+
+        Returns:
+            - embeddings (np.ndarray): shape (dim,) for a single text, (n, dim) otherwise
+        """
+        raise NotImplementedError
+
+    def token_lengths(self, texts):
+        """
+        Number of tokens the model sees for each text, special tokens and truncation included.
+
+        Args:
+            - texts (list(str)): texts to measure
+
+        Returns:
+            - lengths (list(int))
+        """
+        raise NotImplementedError
+
+    def tokenize(self, texts):
+        """
+        Tokenize texts ahead of `encode_tokenized`, eg: on another thread than the forward passes.
+
+        Args:
+            - texts (list(str)): texts to tokenize
+
+        Returns:
+            - encodings (list): model input of every text, unpadded
+            - lengths (list(int)): token length of every text, as `token_lengths` measures it
+        """
+        raise NotImplementedError
+
+    def encode_tokenized(self, encodings, normalize_embeddings=True, batch_size=64):
+        """
+        Embed texts already tokenized by `tokenize`, padding every batch to its longest text only.
+
+        Args:
+            - encodings (list): as returned by `tokenize`
+            - normalize_embeddings (bool): scale every embedding to unit length
+            - batch_size (int): number of texts per forward pass
+
+        Returns:
+            - embeddings (np.ndarray): shape (len(encodings), dim)
+        """
+        raise NotImplementedError
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """
+    fp32 PyTorch backend, a thin wrapper around `SentenceTransformer`.
+
+    Args:
+        - model_name_or_dir (str): hub name or local directory of the model
+        - threads (int): torch intra-op threads, torch's default if not set
+    """
+
+    def __init__(self, model_name_or_dir=DEFAULT_BACKEND, threads=None):
+        super().__init__(model_name_or_dir)
+        import torch
+        from sentence_transformers import SentenceTransformer
+        if threads:
+            torch.set_num_threads(threads)
+            if torch.get_num_interop_threads() != 1:
+                try:
+                    torch.set_num_interop_threads(1)
+                except RuntimeError:
+                    # Only settable before any inter-op work ran in this process, eg: a second backend
+                    pass
+        self.model = SentenceTransformer(model_name_or_dir, device='cpu')
+
+    def encode(self, texts, normalize_embeddings=True, batch_size=64):
+        return self.model.encode(texts, normalize_embeddings=normalize_embeddings, batch_size=batch_size)
+
+    def token_lengths(self, texts):
+        input_ids = self.model.tokenizer(
+            list(texts), truncation=True, max_length=self.model.max_seq_length
+        )['input_ids']
+        return [len(ids) for ids in input_ids]
+
+    def tokenize(self, texts):
+        # The tokenizer call `SentenceTransformer.tokenize` makes, without padding so batches can be formed later
+        features = self.model.tokenizer(list(texts), truncation=True, max_length=self.model.max_seq_length)
+        encodings = [dict(zip(features.keys(), values)) for values in zip(*features.values())]
+        return encodings, [len(encoding['input_ids']) for encoding in encodings]
+
+    def encode_tokenized(self, encodings, normalize_embeddings=True, batch_size=64):
+        import torch
+
+        order = sorted(range(len(encodings)), key=lambda row: len(encodings[row]['input_ids']), reverse=True)
+        embeddings = None
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            features = self.model.tokenizer.pad([encodings[row] for row in rows], return_tensors='pt')
+            with torch.inference_mode():
+                batch_embeddings = self.model(dict(features))['sentence_embedding'].float().numpy()
+            if embeddings is None:
+                embeddings = np.empty((len(encodings), batch_embeddings.shape[1]), dtype=np.float32)
+            embeddings[rows] = batch_embeddings
+        if embeddings is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        if normalize_embeddings:
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings
+
+
+class OnnxBackend(EmbeddingBackend):
+    """
+    ONNX Runtime backend for BERT-style models pooled on the [CLS] token, as bge is.
+
+    Reads `model.onnx` (or `model_quantized.onnx`) and `tokenizer.json` from a
+    local directory, as written by `export_onnx`, so nothing is downloaded.
+
+    Args:
+        - model_dir (str): directory holding the exported model and its tokenizer
+        - quantized (bool): use the dynamic int8 model written by `quantize_onnx`
+        - threads (int): intra-op threads, onnxruntime's default if not set
+        - max_length (int): texts are truncated to this many tokens
+    """
+
+    def __init__(self, model_dir, quantized=False, threads=None, max_length=512):
+        super().__init__(f"{'onnx-int8' if quantized else 'onnx'}:{model_dir}")
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        # Step 1: Tokenizer truncating like the model's own max_seq_length
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.no_padding()
+
+        # Step 2: CPU inference session
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        model_path = os.path.join(model_dir, ONNX_QUANTIZED_MODEL_FILE if quantized else ONNX_MODEL_FILE)
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def token_lengths(self, texts):
+        return self.tokenize(texts)[1]
+
+    def tokenize(self, texts):
+        encodings = self.tokenizer.encode_batch(list(texts))
+        return encodings, [len(encoding.ids) for encoding in encodings]
+
+    def _embed_batch(self, encodings):
+        # Pad to the longest text of the batch only
+        length = max(len(encoding.ids) for encoding in encodings)
+        input_ids = np.zeros((len(encodings), length), dtype=np.int64)
+        attention_mask = np.zeros((len(encodings), length), dtype=np.int64)
+        token_type_ids = np.zeros((len(encodings), length), dtype=np.int64)
+        for row, encoding in enumerate(encodings):
+            input_ids[row, :len(encoding.ids)] = encoding.ids
+            attention_mask[row, :len(encoding.ids)] = encoding.attention_mask
+            token_type_ids[row, :len(encoding.ids)] = encoding.type_ids
+        inputs = {'input_ids': input_ids, 'attention_mask': attention_mask, 'token_type_ids': token_type_ids}
+        last_hidden_state = self.session.run(None, {name: inputs[name] for name in self.input_names})[0]
+        return last_hidden_state[:, 0]
+
+    def encode(self, texts, normalize_embeddings=True, batch_size=64):
+        single = isinstance(texts, str)
+        embeddings = self.encode_tokenized(
+            self.tokenize([texts] if single else texts)[0], normalize_embeddings=normalize_embeddings,
+            batch_size=batch_size,
+        )
+        return embeddings[0] if single else embeddings
+
+    def encode_tokenized(self, encodings, normalize_embeddings=True, batch_size=64):
+        # Step 1: Sort longest-first so every batch pads to a similar length
+        order = sorted(range(len(encodings)), key=lambda row: len(encodings[row].ids), reverse=True)
+
+        # Step 2: Run the batches and scatter back to input order
+        embeddings = None
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            batch_embeddings = self._embed_batch([encodings[row] for row in rows])
+            if embeddings is None:
+                embeddings = np.empty((len(encodings), batch_embeddings.shape[1]), dtype=np.float32)
+            embeddings[rows] = batch_embeddings
+        if embeddings is None:
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+
+        # Step 3: Normalise so that dot products are cosine similarities
+        if normalize_embeddings and len(embeddings):
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings
+
+
+def load_backend(name=DEFAULT_BACKEND, threads=None):
+    """
+    Build a backend from its name.
+
+    Names:
+        - onnx:<model_dir> - ONNX Runtime, fp32
+        - onnx-int8:<model_dir> - ONNX Runtime, dynamic int8 quantized
+        - sentence-transformers:<model> or <model> - PyTorch SentenceTransformer, hub name or local directory
+
+    Args:
+        - name (str): backend name
+        - threads (int): intra-op threads of the backend
+
+    Returns:
+        - backend (EmbeddingBackend)
+    """
+    kind, _, target = name.partition(':')
+    if kind == 'onnx':
+        return OnnxBackend(target, threads=threads)
+    if kind == 'onnx-int8':
+        return OnnxBackend(target, quantized=True, threads=threads)
+    if kind == 'sentence-transformers':
+        return SentenceTransformerBackend(target, threads=threads)
+    return SentenceTransformerBackend(name, threads=threads)
+
+
+def export_onnx(model_dir, output_dir, opset=17):
+    """
+    Export a local transformers model to `output_dir` for `OnnxBackend`.
+
+    Args:
+        - model_dir (str): local directory of the model, eg: a SentenceTransformer save of bge-base
+        - output_dir (str): receives `model.onnx` and `tokenizer.json`
+        - opset (int): ONNX opset version
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_dir, local_files_only=True)
+    model = AutoModel.from_pretrained(model_dir, local_files_only=True).eval()
+    tokenizer.save_pretrained(output_dir)
+
+    sample = tokenizer(['export sample'], return_tensors='pt')
+    input_names = ['input_ids', 'attention_mask', 'token_type_ids']
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample['input_ids'], sample['attention_mask'], sample['token_type_ids']),
+            os.path.join(output_dir, ONNX_MODEL_FILE),
+            input_names=input_names,
+            output_names=['last_hidden_state'],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+        )
+
+
+def quantize_onnx(model_dir):
+    """
+    Write a dynamic int8 quantized copy of `model.onnx` next to it.
+
+    Weights are stored as int8 and activations quantized on the fly, which needs
+    no calibration data.
+
+    Args:
+        - model_dir (str): directory written by `export_onnx`
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(
+        os.path.join(model_dir, ONNX_MODEL_FILE),
+        os.path.join(model_dir, ONNX_QUANTIZED_MODEL_FILE),
+        weight_type=QuantType.QInt8,
+    )
+
+
+def sample_texts(path, sample_size=1000, seed=0):
+    """
+    Reservoir-sample records of a structured file and return their unique texts.
+
+    Args:
+        - path (str): structured `.json` or `.jsonl` file
+        - sample_size (int): number of records to sample
+        - seed (int): seed of the sampler
+
+    Returns:
+        - texts (list(str)): conversation and response texts of the sampled records
+    """
+    from src.data_handling.record_io import sample_records
+    from src.evaluations.batch_scoring import build_texts
+
+    sample = sample_records(path, sample_size, seed)
+    return list(dict.fromkeys(text for record in sample for text in build_texts(record).values()))
+
+
+def check_parity(reference, candidate, texts, batch_size=64, pairs=10000, seed=0):
+    """
+    Compare the embeddings of two backends over the same texts.
+
+    Drift is 1 - cosine(reference embedding, candidate embedding) of every text.
+    Since every score is a cosine between two texts, the change in those
+    similarities over random text pairs is reported as well.
+
+    Args:
+        - reference (EmbeddingBackend): backend taken as ground truth, usually PyTorch
+        - candidate (EmbeddingBackend): backend being checked
+        - texts (list(str)): texts to embed
+        - batch_size (int): number of texts per forward pass
+        - pairs (int): number of random text pairs compared
+        - seed (int): seed of the pair sampler
+
+    Returns:
+        - report (dict): drift statistics
+    """
+    # Step 1: Embed with both backends
+    reference_embeddings = np.asarray(reference.encode(texts, normalize_embeddings=True, batch_size=batch_size), dtype=np.float64)
+    candidate_embeddings = np.asarray(candidate.encode(texts, normalize_embeddings=True, batch_size=batch_size), dtype=np.float64)
+
+    # Step 2: Drift of every embedding
+    drift = 1 - np.einsum('ij,ij->i', reference_embeddings, candidate_embeddings)
+
+    # Step 3: Change in the cosine similarity of random pairs
+    rng = np.random.default_rng(seed)
+    sources = rng.integers(0, len(texts), pairs)
+    targets = rng.integers(0, len(texts), pairs)
+    similarity_error = np.abs(
+        np.einsum('ij,ij->i', reference_embeddings[sources], reference_embeddings[targets])
+        - np.einsum('ij,ij->i', candidate_embeddings[sources], candidate_embeddings[targets])
+    )
+
+    return {
+        'reference': reference.name,
+        'candidate': candidate.name,
+        'texts': len(texts),
+        'max_cosine_drift': float(drift.max()),
+        'mean_cosine_drift': float(drift.mean()),
+        'p99_cosine_drift': float(np.percentile(drift, 99)),
+        'pairs': pairs,
+        'max_similarity_error': float(similarity_error.max()),
+        'mean_similarity_error': float(similarity_error.mean()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export ONNX embedding models and check them against PyTorch')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='export a local model to ONNX')
+    export_parser.add_argument('--model-dir', required=True, help='local directory of the PyTorch model')
+    export_parser.add_argument('--output', required=True, help='directory receiving the ONNX model')
+    export_parser.add_argument('--quantize', action='store_true', help='also write the dynamic int8 model')
+
+    parity_parser = subparsers.add_parser('parity', help='report the embedding drift of a backend')
+    parity_parser.add_argument('--reference', default=DEFAULT_BACKEND, help='backend taken as ground truth')
+    parity_parser.add_argument('--candidate', required=True, help='backend being checked, eg: onnx-int8:<model_dir>')
+    parity_parser.add_argument('--input', required=True, help='structured .json or .jsonl file to sample texts from')
+    parity_parser.add_argument('--sample', type=int, default=1000, help='number of records sampled')
+    parity_parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_onnx(args.model_dir, args.output)
+        if args.quantize:
+            quantize_onnx(args.output)
+    else:
+        texts = sample_texts(args.input, args.sample)
+        report = check_parity(load_backend(args.reference), load_backend(args.candidate), texts, batch_size=args.batch_size)
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import os
+import json
+import heapq
+import threading
+import hashlib
+import numpy as np
+
+INITIAL_ROWS = 4096  # rows of a new embedding matrix, doubled whenever it fills up
+EVICTION_FRACTION = 64  # a full cache evicts at least 1/64 of its entries at once, each eviction rewrites index.json
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding store backed by a memory-mapped matrix on disk.
+
+    Every text is keyed by a hash of (model name, normalisation flag, text), so the
+    same cache directory can safely be shared between models. Vectors live in
+    `embeddings.npy`, memory-mapped rather than read, which starts at
+    `INITIAL_ROWS` rows and doubles as it fills up, and `index.json` maps each key
+    to its row along with a last-used tick. Once `max_entries` rows are taken the
+    least recently used entries are evicted.
+    Lookups, writes and flushes hold a lock, so threads can share one cache.
+
+    The index on disk never points a key at a row holding another text: evicted
+    rows are only reused once an index without their keys is written, so a run
+    killed between two flushes only loses the entries added since the last one.
+
+    With a codec the vectors are stored in its form, eg: int8 with their scales
+    in `scales.npy`, and handed back decoded. A directory only ever holds one codec.
+
+    Args:
+        - cache_dir (str): directory holding `embeddings.npy` and `index.json`
+        - model_name (str): name of the embedding model, part of every key
+        - normalize (bool): whether the stored embeddings are normalised
+        - dtype (str): storage precision, 'float32' or 'float16'
+        - max_entries (int): maximum number of embeddings kept on disk
+        - codec (EmbeddingCodec): storage mode of the vectors, overrides `dtype`. Vectors are
+            expected already cut down to its dimensions, see `run_encoding`.
+    """
+
+    def __init__(self, cache_dir, model_name, normalize=True, dtype='float32', max_entries=1_000_000, codec=None):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.normalize = normalize
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.matrix_path = os.path.join(cache_dir, 'embeddings.npy')
+        self.scales_path = os.path.join(cache_dir, 'scales.npy')
+        self.codec = codec
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+        # Step 1: Reuse the layout of an existing cache, if any
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            self.dtype = index['dtype']
+            stored_codec = index.get('codec')
+            if stored_codec != (codec.key if codec is not None else None):
+                raise ValueError(f'{cache_dir} holds {stored_codec or self.dtype} embeddings, not {codec.key if codec else dtype}')
+            self.max_entries = index['max_entries']
+            self.dim = index['dim']
+            self.clock = index['clock']
+            self.entries = index['entries']
+        else:
+            self.dtype = codec.storage if codec is not None else dtype
+            self.max_entries = max_entries
+            self.dim = None
+            self.clock = 0
+            self.entries = {}
+
+        # Step 2: Map the embedding matrix without reading it into memory
+        self.matrix = None
+        self.scales = None
+        if self.dim is not None and os.path.exists(self.matrix_path):
+            self.matrix = np.load(self.matrix_path, mmap_mode='r+')
+            if os.path.exists(self.scales_path):
+                self.scales = np.load(self.scales_path, mmap_mode='r+')
+
+        # Step 3: Rows past the high-water mark were never used, below it only evicted rows are free
+        used_slots = {slot for slot, _ in self.entries.values()}
+        self.next_slot = max(used_slots) + 1 if used_slots else 0
+        self.free_slots = [slot for slot in range(self.next_slot) if slot not in used_slots]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, text):
+        """Hash identifying `text` for this model and normalisation flag"""
+        payload = f'{self.model_name}\0{int(self.normalize)}\0{text}'
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def get_many(self, texts):
+        """
+        Look up the cached embeddings of `texts`.
+
+        Args:
+            - texts (list(str)): texts to look up
+
+        Returns:
+            - found (dict): maps every cached text to its float32 embedding
+        """
+        with self.lock:
+            self.clock += 1
+            found = {}
+            for text in texts:
+                entry = self.entries.get(self.key(text))
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                entry[1] = self.clock
+                found[text] = self._decode(entry[0])
+            return found
+
+    def _decode(self, slot):
+        if self.scales is None:
+            return np.array(self.matrix[slot], dtype=np.float32)  # a copy, the slot may be evicted and rewritten
+        return self.matrix[slot].astype(np.float32) * self.scales[slot]
+
+    def put_many(self, texts, embeddings):
+        """
+        Store embeddings, evicting the least recently used entries when full.
+
+        Args:
+            - texts (list(str)): texts that were embedded
+            - embeddings (np.ndarray): their embeddings, shape (len(texts), dim)
+        """
+        if not len(texts):
+            return
+        with self.lock:
+            self._put_many(texts, np.asarray(embeddings))
+
+    def _grow(self, rows):
+        """Make room for at least `rows` rows, copying the matrix into a file twice its size if needed"""
+        capacity = len(self.matrix) if self.matrix is not None else 0
+        if rows <= capacity:
+            return
+        capacity = min(self.max_entries, max(rows, 2 * capacity, INITIAL_ROWS))
+        matrix = self._resized(self.matrix_path, self.matrix, (capacity, self.dim), self.dtype)
+        if self.dtype == 'int8':
+            self.scales = self._resized(self.scales_path, self.scales, (capacity,), np.float32)
+        self.matrix = matrix
+
+    @staticmethod
+    def _resized(path, array, shape, dtype):
+        tmp_path = f'{path}.tmp'
+        resized = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+        if array is not None:
+            resized[:len(array)] = array
+        os.replace(tmp_path, path)
+        return resized
+
+    def _put_many(self, texts, embeddings):
+        # Step 1: Fix the dimension on first write
+        if self.dim is None:
+            self.dim = int(embeddings.shape[1])
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f'Expected embeddings of dim {self.dim}, got {embeddings.shape[1]}')
+
+        # Step 2: Keep at most max_entries of the new texts, evict to make room
+        self.clock += 1
+        keys = [self.key(text) for text in texts][-self.max_entries:]
+        embeddings = embeddings[-len(keys):]
+        scales = None
+        if self.codec is not None:
+            compact = self.codec.quantize(embeddings)
+            embeddings, scales = compact.values, compact.scales
+        new_keys = set()
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry is None:
+                new_keys.add(key)
+            else:
+                entry[1] = self.clock  # never evict a text that is being rewritten
+        fresh = min(max(len(new_keys) - len(self.free_slots), 0), self.max_entries - self.next_slot)
+        self.free_slots.extend(range(self.next_slot + fresh - 1, self.next_slot - 1, -1))
+        self.next_slot += fresh
+        self._grow(self.next_slot)
+        shortfall = len(new_keys) - len(self.free_slots)
+        if shortfall > 0:
+            stale = len(self.entries) - (len(keys) - len(new_keys))
+            self._evict(min(max(shortfall, self.max_entries // EVICTION_FRACTION), stale))
+
+        # Step 3: Write the vectors into their slots
+        for row, (key, embedding) in enumerate(zip(keys, embeddings)):
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = [self.free_slots.pop(), self.clock]
+            entry[1] = self.clock
+            self.matrix[entry[0]] = embedding
+            if scales is not None:
+                self.scales[entry[0]] = scales[row]
+
+    def _evict(self, count):
+        """Drop the `count` least recently used entries and persist the index before their rows can be reused"""
+        evicted = heapq.nsmallest(count, self.entries.items(), key=lambda item: item[1][1])
+        for key, (slot, _) in evicted:
+            del self.entries[key]
+            self.free_slots.append(slot)
+        self._flush()
+
+    def flush(self):
+        """Persist the matrix and atomically rewrite the index file"""
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.matrix is not None:
+            self.matrix.flush()
+        if self.scales is not None:
+            self.scales.flush()
+        index = {
+            'model_name': self.model_name,
+            'normalize': self.normalize,
+            'dtype': self.dtype,
+            'codec': self.codec.key if self.codec is not None else None,
+            'max_entries': self.max_entries,
+            'dim': self.dim,
+            'clock': self.clock,
+            'entries': self.entries,
+        }
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
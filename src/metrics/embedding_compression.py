@@ -0,0 +1,326 @@
+"""
+cd src/metrics
+python embedding_compression.py fit --input ../../data/structured_equal.json --dim 256 --output ../../models/pca256.npy
+python embedding_compression.py report --input ../../data/structured_equal.json --sample 1000 --modes float16 int8 int8:384 int8:pca256
+python embedding_compression.py report --input ../../data/structured_equal.json --modes int8:pca256 --projection ../../models/pca256.npy --output ../../data/compression_report.json
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+
+sys.path.append(os.path.abspath('../../'))
+
+STORAGE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}
+INT8_LEVELS = 127
+PCA_PREFIX = 'pca'
+
+
+class CompactEmbeddings:
+    """
+    Embeddings in their storage form, rows of a `EmbeddingCodec`.
+
+    int8 rows are kept with one float32 scale each, a row decodes to
+    `values * scale`. Cosines are computed on the stored values themselves:
+    int8 dot products are summed in int32 and divided by the norms of the
+    quantized rows, in which the scales cancel out.
+
+    Args:
+        - values (np.ndarray): (n, dim) float32, float16 or int8 values
+        - scales (np.ndarray): (n,) float32 scales of int8 values, None otherwise
+    """
+
+    def __init__(self, values, scales=None):
+        self.values = values
+        self.scales = scales
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def decode(self):
+        """float32 embeddings, eg: to pool them"""
+        if self.scales is None:
+            return np.asarray(self.values, dtype=np.float32)
+        return self.values.astype(np.float32) * self.scales[:, None]
+
+    def similarities(self, source_rows, target_rows):
+        """
+        Cosine similarities of many (source, target) row pairs, see `compute_similarities`.
+
+        Returns:
+            - similarities (np.ndarray): float32, one cosine similarity per pair
+        """
+        source_rows = np.asarray(source_rows, dtype=np.intp)
+        target_rows = np.asarray(target_rows, dtype=np.intp)
+        if self.values.dtype == np.int8:
+            values = self.values.astype(np.int32)
+            norms = np.sqrt(np.einsum('ij,ij->i', values, values).astype(np.float32))
+            dots = np.einsum('ij,ij->i', values[source_rows], values[target_rows]).astype(np.float32)
+            return dots / np.maximum(norms[source_rows] * norms[target_rows], 1e-12)
+        if self.values.dtype == np.float16:
+            return np.einsum('ij,ij->i', self.values[source_rows], self.values[target_rows], dtype=np.float32)
+        return np.einsum('ij,ij->i', self.values[source_rows], self.values[target_rows])
+
+
+class EmbeddingCodec:
+    """
+    Storage form of embeddings: their precision and, optionally, fewer dimensions.
+
+    A 768-dim float32 bge vector takes 3 KB. Storage modes:
+        - 'float16': half the bytes, cosines move in the fourth decimal
+        - 'int8': a quarter of the bytes plus a 4-byte scale per vector
+    and either mode can first cut the dimensions down:
+        - '<storage>:<k>' keeps the first k dimensions
+        - '<storage>:pca<k>' projects onto the top k principal directions of our
+          own corpus, see `fit_projection`, which loses far less than truncating
+          a model that was not trained for it, as bge was not
+
+    Reduced vectors are normalised again, so their dot products stay cosines.
+    `reduce` runs where the model hands embeddings over, before they are
+    cached or pooled, and `quantize` where cosines are computed.
+
+    Args:
+        - storage (str): 'float32', 'float16' or 'int8'
+        - dim (int): dimensions kept, all of them if not set
+        - projection (np.ndarray): (model dim, dim) PCA projection, in place of truncation
+    """
+
+    def __init__(self, storage='float32', dim=None, projection=None):
+        if storage not in STORAGE_DTYPES:
+            raise ValueError(f'Unknown storage: {storage}, expected one of {list(STORAGE_DTYPES)}')
+        if projection is not None and dim is not None and projection.shape[1] != dim:
+            raise ValueError(f'projection has {projection.shape[1]} dimensions, expected {dim}')
+        self.storage = storage
+        self.dtype = np.dtype(STORAGE_DTYPES[storage])
+        self.projection = np.asarray(projection, dtype=np.float32) if projection is not None else None
+        self.dim = self.projection.shape[1] if self.projection is not None else dim
+
+    @property
+    def name(self):
+        """Spec the codec is loaded from with `load_codec`"""
+        if self.dim is None:
+            return self.storage
+        return f'{self.storage}:{PCA_PREFIX if self.projection is not None else ""}{self.dim}'
+
+    @property
+    def key(self):
+        """Name that also tells projections apart, what caches and memos key on"""
+        if self.projection is None:
+            return self.name
+        return f'{self.name}:{hashlib.sha1(self.projection.tobytes()).hexdigest()[:12]}'
+
+    def bytes_per_vector(self, model_dim):
+        dim = self.dim or model_dim
+        return dim * self.dtype.itemsize + (4 if self.storage == 'int8' else 0)
+
+    def reduce(self, embeddings):
+        """
+        Cut normalised embeddings down to the codec's dimensions.
+
+        Args:
+            - embeddings (np.ndarray): (n, model dim) normalised embeddings
+
+        Returns:
+            - embeddings (np.ndarray): (n, dim) float32, normalised
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.projection is not None:
+            embeddings = embeddings @ self.projection
+        elif self.dim is not None:
+            embeddings = embeddings[:, :self.dim]
+        else:
+            return embeddings
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    def quantize(self, embeddings):
+        """
+        Store reduced embeddings at the codec's precision.
+
+        Quantizing decoded rows again gives back the same values, so a cache can
+        hand out decoded rows and the cosines still run on the stored form.
+
+        Args:
+            - embeddings (np.ndarray): (n, dim) reduced embeddings
+
+        Returns:
+            - compact (CompactEmbeddings)
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.storage != 'int8':
+            return CompactEmbeddings(embeddings.astype(self.dtype, copy=False))
+        # One scale per vector maps its largest component to +-127
+        peaks = np.abs(embeddings).max(axis=1) if embeddings.size else np.zeros(len(embeddings), dtype=np.float32)
+        scales = np.where(peaks > 0, peaks / INT8_LEVELS, 1.0).astype(np.float32)
+        values = np.rint(embeddings / scales[:, None]).clip(-INT8_LEVELS, INT8_LEVELS).astype(np.int8)
+        return CompactEmbeddings(values, scales)
+
+    def encode(self, embeddings):
+        """Storage form of model embeddings, `reduce` then `quantize`"""
+        return self.quantize(self.reduce(embeddings))
+
+
+def fit_projection(embeddings, dim):
+    """
+    PCA projection of embeddings onto their top `dim` directions.
+
+    The directions are not centred on the mean: cosine similarities are dot
+    products around the origin, and these are the directions that keep dot
+    products best.
+
+    Args:
+        - embeddings (np.ndarray): (n, model dim) normalised embeddings of our corpus
+        - dim (int): dimensions kept
+
+    Returns:
+        - projection (np.ndarray): (model dim, dim) float32, orthonormal columns
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    if dim > min(embeddings.shape):
+        raise ValueError(f'cannot fit {dim} dimensions on {embeddings.shape[0]} embeddings of {embeddings.shape[1]}')
+    _, _, components = np.linalg.svd(embeddings, full_matrices=False)
+    return components[:dim].T.astype(np.float32)
+
+
+def load_codec(spec, projection_path=None):
+    """
+    Build a codec from its name.
+
+    Args:
+        - spec (str): '<storage>[:<k>|:pca<k>]', eg: 'float16', 'int8:384' or 'int8:pca256'
+        - projection_path (str): `.npy` projection written by `fit`, required by 'pca' specs
+
+    Returns:
+        - codec (EmbeddingCodec)
+    """
+    storage, _, dims = spec.partition(':')
+    if not dims:
+        return EmbeddingCodec(storage)
+    if not dims.startswith(PCA_PREFIX):
+        return EmbeddingCodec(storage, dim=int(dims))
+    if projection_path is None:
+        raise ValueError(f'{spec} needs a projection, fit one with `embedding_compression.py fit`')
+    return EmbeddingCodec(storage, dim=int(dims[len(PCA_PREFIX):]), projection=np.load(projection_path))
+
+
+def embed_sample(engine, records):
+    """
+    Full-precision embeddings and lexical metrics of sampled records, computed once for every mode.
+
+    Returns:
+        - texts (list(dict)): `build_texts` of every record
+        - index (dict), embeddings (np.ndarray): as returned by `encode_texts`
+        - lexical (tuple): as returned by `lexical_scores`
+    """
+    from src.evaluations.batch_scoring import build_texts, plan_embeddings, run_embeddings, lexical_scores
+
+    texts = [build_texts(record) for record in records]
+    plan, conversation_chunks = plan_embeddings(
+        engine.model, records, texts, scheduler=engine.scheduler, chunker=engine.chunker
+    )
+    index, embeddings = run_embeddings(
+        engine.model, plan, conversation_chunks, batch_size=engine.batch_size, scheduler=engine.scheduler,
+        chunker=engine.chunker,
+    )
+    return texts, index, embeddings, lexical_scores(texts)
+
+
+def drift_report(texts, index, embeddings, lexical, codecs, weights=None):
+    """
+    How far each storage mode moves `source_context_similarity` and the final score from full precision.
+
+    Args:
+        - texts, index, embeddings, lexical: as returned by `embed_sample`
+        - codecs (list(EmbeddingCodec)): storage modes to compare
+        - weights (ScoringWeights): weights of the final score, the `utils` constants if not set
+
+    Returns:
+        - report (dict): per mode, bytes per vector and absolute drift statistics
+    """
+    from src.evaluations.batch_scoring import similarity_scores, collect_scores
+
+    def drift(reference, values):
+        error = np.abs(np.asarray(values, dtype=np.float64) - np.asarray(reference, dtype=np.float64))
+        return {'mean': float(error.mean()), 'p99': float(np.percentile(error, 99)), 'max': float(error.max())}
+
+    # Step 1: Full precision reference
+    reference = collect_scores(similarity_scores(texts, index, embeddings), *lexical, weights=weights)
+    reference_similarity = [scores['source_context_similarity'] for scores, _ in reference]
+    reference_score = [score for _, score in reference]
+    model_dim = embeddings.shape[1]
+
+    # Step 2: The same scores from every storage mode
+    modes = {}
+    for codec in codecs:
+        compact = codec.encode(embeddings)
+        results = collect_scores(similarity_scores(texts, index, compact), *lexical, weights=weights)
+        modes[codec.name] = {
+            'bytes_per_vector': codec.bytes_per_vector(model_dim),
+            'compression': model_dim * 4 / codec.bytes_per_vector(model_dim),
+            'source_context_similarity': drift(reference_similarity, [scores['source_context_similarity'] for scores, _ in results]),
+            'score': drift(reference_score, [score for _, score in results]),
+        }
+    return {'records': len(texts), 'texts': len(index), 'model_dim': model_dim, 'modes': modes}
+
+
+def main():
+    from src.data_handling.record_io import sample_records
+    from src.evaluations.engine import ScoringEngine
+    from src.metrics.embedding_backends import DEFAULT_BACKEND
+
+    parser = argparse.ArgumentParser(description='Fit PCA projections and report the drift of embedding storage modes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fit_parser = subparsers.add_parser('fit', help='fit a PCA projection on the embeddings of a sample of our corpus')
+    fit_parser.add_argument('--dim', type=int, required=True, help='dimensions kept')
+    fit_parser.add_argument('--output', required=True, help='.npy file receiving the projection')
+
+    report_parser = subparsers.add_parser('report', help='compare storage modes against full precision')
+    report_parser.add_argument('--modes', nargs='+', default=['float16', 'int8'],
+                               help="storage modes, eg: float16 int8 int8:384 int8:pca256")
+    report_parser.add_argument('--projection', help='projection written by fit, pca modes without one are fitted on the sample')
+    report_parser.add_argument('--output', help='JSON report file, printed when not set')
+
+    for subparser in (fit_parser, report_parser):
+        subparser.add_argument('--input', required=True, help='structured .json or .jsonl file to sample records from')
+        subparser.add_argument('--sample', type=int, default=1000, help='number of records sampled')
+        subparser.add_argument('--seed', type=int, default=0)
+        subparser.add_argument('--backend', default=DEFAULT_BACKEND)
+        subparser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    # Step 1: Embed a sample once, at full precision
+    engine = ScoringEngine(args.backend, batch_size=args.batch_size)
+    records = sample_records(args.input, args.sample, args.seed)
+    texts, index, embeddings, lexical = embed_sample(engine, records)
+
+    if args.command == 'fit':
+        np.save(args.output, fit_projection(embeddings, args.dim))
+        print(f'{args.dim} of {embeddings.shape[1]} dimensions fitted on {len(embeddings)} texts -> {args.output}')
+        return
+
+    # Step 2: Codecs of every mode, pca modes without a projection are fitted on the sample itself
+    codecs = []
+    for spec in args.modes:
+        storage, _, dims = spec.partition(':')
+        if dims.startswith(PCA_PREFIX) and not args.projection:
+            codecs.append(EmbeddingCodec(storage, projection=fit_projection(embeddings, int(dims[len(PCA_PREFIX):]))))
+        else:
+            codecs.append(load_codec(spec, args.projection))
+
+    report = drift_report(texts, index, embeddings, lexical, codecs)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import random
+import threading
+from functools import wraps
+import numpy as np
+
+# Latency samples kept per span name for percentiles, reservoir-sampled past this
+MAX_SAMPLES = 100_000
+# Timeline events kept for the Chrome trace, later ones are dropped
+MAX_TRACE_EVENTS = 1_000_000
+
+
+class _NullSpan:
+    """Shared no-op span handed out while profiling is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('profiler', 'name', 'size', 'start')
+
+    def __init__(self, profiler, name, size):
+        self.profiler = profiler
+        self.name = name
+        self.size = size
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start, self.size)
+        return False
+
+
+class _SpanStats:
+    __slots__ = ('calls', 'seconds', 'size', 'samples')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.size = 0
+        self.samples = []
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of the scoring hot path.
+
+    Instrumented code opens spans with `profiler.span(name, size)`. While the
+    profiler is disabled this returns a shared no-op object, so the cost is one
+    attribute check per call. Once enabled every span records its latency and
+    input size, hit and miss counters track the caches, and with `trace` every
+    span is also kept as an event of a Chrome trace (chrome://tracing, Perfetto).
+
+    Spans recorded in worker processes stay in those processes.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace = False
+        self.lock = threading.Lock()
+        self.rng = random.Random(0)
+        self.memo_caches = {}
+        self.reset()
+
+    def reset(self):
+        self.spans = {}
+        self.counters = {}
+        self.events = []
+        # lru_cache statistics count from process start, so they are reported relative to this point
+        self.memo_baselines = {name: cached_function.cache_info() for name, cached_function in self.memo_caches.items()}
+        self.origin = time.perf_counter()
+
+    def enable(self, trace=False):
+        self.reset()
+        self.enabled = True
+        self.trace = trace
+
+    def disable(self):
+        self.enabled = False
+
+    def span(self, name, size=None):
+        """
+        Time a block.
+
+        Args:
+            - name (str): span name, eg: 'bleu' or 'io.write'
+            - size (int): input size of the block, eg: number of texts
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, size)
+
+    def record(self, name, start, seconds, size=None):
+        with self.lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = _SpanStats()
+            stats.calls += 1
+            stats.seconds += seconds
+            if size is not None:
+                stats.size += size
+            if len(stats.samples) < MAX_SAMPLES:
+                stats.samples.append(seconds)
+            else:
+                slot = self.rng.randrange(stats.calls)
+                if slot < MAX_SAMPLES:
+                    stats.samples[slot] = seconds
+            if self.trace and len(self.events) < MAX_TRACE_EVENTS:
+                event = {
+                    'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                    'ts': (start - self.origin) * 1e6, 'dur': seconds * 1e6,
+                }
+                if size is not None:
+                    event['args'] = {'size': size}
+                self.events.append(event)
+
+    def count(self, name, hits=0, misses=0):
+        """Add cache hits and misses to the counter `name`"""
+        if not self.enabled:
+            return
+        with self.lock:
+            counter = self.counters.setdefault(name, {'hits': 0, 'misses': 0})
+            counter['hits'] += hits
+            counter['misses'] += misses
+
+    def watch_cache(self, name, cached_function):
+        """Report the hit rate of an `lru_cache` function in the summary"""
+        self.memo_caches[name] = cached_function
+        self.memo_baselines[name] = cached_function.cache_info()
+
+    def summary(self):
+        """
+        Per-span and per-cache statistics since the profiler was enabled.
+
+        Returns:
+            - summary (dict): for every span its calls, cumulative seconds, latency
+                percentiles in milliseconds and input sizes, and the hit rate of every cache
+        """
+        spans = {}
+        for name, stats in sorted(self.spans.items(), key=lambda item: -item[1].seconds):
+            samples = np.array(stats.samples) * 1000
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+            spans[name] = {
+                'calls': stats.calls,
+                'seconds': stats.seconds,
+                'mean_ms': stats.seconds * 1000 / stats.calls,
+                'p50_ms': float(p50),
+                'p95_ms': float(p95),
+                'p99_ms': float(p99),
+                'max_ms': float(samples.max()),
+                'size': stats.size,
+                'mean_size': stats.size / stats.calls,
+            }
+
+        caches = {}
+        counters = dict(self.counters)
+        for name, cached_function in self.memo_caches.items():
+            info, baseline = cached_function.cache_info(), self.memo_baselines[name]
+            if info.hits + info.misses < baseline.hits + baseline.misses:
+                # Cleared since the baseline was taken
+                baseline = info._replace(hits=0, misses=0)
+            counters[name] = {'hits': info.hits - baseline.hits, 'misses': info.misses - baseline.misses}
+        for name, counter in counters.items():
+            lookups = counter['hits'] + counter['misses']
+            caches[name] = {**counter, 'hit_rate': counter['hits'] / lookups if lookups else None}
+        return {'spans': spans, 'caches': caches}
+
+    def report(self):
+        """Summary as a fixed-width table"""
+        summary = self.summary()
+        lines = [f"{'span':<28}{'calls':>10}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'mean size':>11}"]
+        for name, stats in summary['spans'].items():
+            lines.append(
+                f"{name:<28}{stats['calls']:>10}{stats['seconds']:>10.2f}{stats['mean_ms']:>10.3f}"
+                f"{stats['p50_ms']:>10.3f}{stats['p99_ms']:>10.3f}{stats['mean_size']:>11.1f}"
+            )
+        if summary['caches']:
+            lines.append('')
+            lines.append(f"{'cache':<28}{'hits':>10}{'misses':>10}{'hit rate':>10}")
+            for name, counter in summary['caches'].items():
+                hit_rate = f"{counter['hit_rate']:.3f}" if counter['hit_rate'] is not None else '-'
+                lines.append(f"{name:<28}{counter['hits']:>10}{counter['misses']:>10}{hit_rate:>10}")
+        return '\n'.join(lines)
+
+    def write_summary(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=4)
+
+    def write_trace(self, path):
+        """Write the recorded spans as a Chrome trace"""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+# Process-wide profiler, disabled unless a run asks for it
+profiler = Profiler()
+
+
+def profiled(name, size=None):
+    """
+    Decorator recording every call of a function as a span of the shared profiler.
+
+    Args:
+        - name (str): span name
+        - size (callable): optional, maps the call's arguments to its input size
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with profiler.span(name, size(*args, **kwargs) if size is not None else None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def iter_profiled(name, iterable):
+    """Time every item pulled from `iterable` as a span, eg: records read from disk"""
+    if not profiler.enabled:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        with profiler.span(name):
+            item = next(iterator, _NULL_SPAN)
+        if item is _NULL_SPAN:
+            return
+        yield item
@@ -1,3 +1,10 @@
+import json
+from collections import namedtuple
+
+import numpy as np
+
+from src.metrics.profiling import profiled
+
 SEMANTIC_IMPORTANCE = 0.8  # Value 0-1
 # Tweak the above variable to toggle between semantic importance and empathy
 
@@ -5,12 +12,70 @@ SEMANTIC_IMPORTANCE_FOR_RESPONSE_COMPARISON = 0.7  # Value 0-1
 ROUGE_IMPORTANCE_FOR_RESPONSE_COMPARISON = 0.2  # Value 0-1
 BLEU_IMPORTANCE_FOR_RESPONSE_COMPARISON = 0.1  # Value 0-1
 
+# Blend of the three ROUGE variants into one ROUGE score
+ROUGE1_IMPORTANCE = 0.2
+ROUGE2_IMPORTANCE = 0.2
+ROUGEL_IMPORTANCE = 0.6
+
 CONTEXT_SOURCE_SCORE_THRESHOLD = 0.75
 
 AI_IMPORTANCE_FOR_EVAL = 0.5
 HUMAN_IMPORTANCE_FOR_EVAL = 0.1
 RESPONSE_IMPORTANCE_FOR_EVAL = 0.4
 
+# Every weight of the final score, named after the module constants above in lower case.
+# Scoring functions take one as `weights`; each field may also be an array of
+# shape (configs, 1) to score many weightings at once with the columnar functions.
+ScoringWeights = namedtuple('ScoringWeights', [
+    'semantic_importance',
+    'semantic_importance_for_response_comparison',
+    'rouge_importance_for_response_comparison',
+    'bleu_importance_for_response_comparison',
+    'rouge1_importance',
+    'rouge2_importance',
+    'rougeL_importance',
+    'context_source_score_threshold',
+    'ai_importance_for_eval',
+    'human_importance_for_eval',
+    'response_importance_for_eval',
+])
+
+
+def default_weights():
+    """`ScoringWeights` holding the module constants, as they are at call time"""
+    return ScoringWeights(
+        semantic_importance=SEMANTIC_IMPORTANCE,
+        semantic_importance_for_response_comparison=SEMANTIC_IMPORTANCE_FOR_RESPONSE_COMPARISON,
+        rouge_importance_for_response_comparison=ROUGE_IMPORTANCE_FOR_RESPONSE_COMPARISON,
+        bleu_importance_for_response_comparison=BLEU_IMPORTANCE_FOR_RESPONSE_COMPARISON,
+        rouge1_importance=ROUGE1_IMPORTANCE,
+        rouge2_importance=ROUGE2_IMPORTANCE,
+        rougeL_importance=ROUGEL_IMPORTANCE,
+        context_source_score_threshold=CONTEXT_SOURCE_SCORE_THRESHOLD,
+        ai_importance_for_eval=AI_IMPORTANCE_FOR_EVAL,
+        human_importance_for_eval=HUMAN_IMPORTANCE_FOR_EVAL,
+        response_importance_for_eval=RESPONSE_IMPORTANCE_FOR_EVAL,
+    )
+
+
+def load_weights(path):
+    """
+    Read a `ScoringWeights` from a JSON object, eg: the best configuration written by `weight_sweep.py`.
+
+    Args:
+        - path (str): JSON file mapping field names to values, fields it leaves out keep their default
+
+    Returns:
+        - weights (ScoringWeights)
+    """
+    with open(path, 'r') as f:
+        values = json.load(f)
+    unknown = sorted(set(values) - set(ScoringWeights._fields))
+    if unknown:
+        raise ValueError(f'{path}: unknown weights {unknown}, expected some of {list(ScoringWeights._fields)}')
+    return default_weights()._replace(**{field: float(value) for field, value in values.items()})
+
+
 def compute_ai_response_score(**kwargs):
     """
     Calculate a normalized score for an AI's response based on its empathy and similarity.
@@ -49,7 +114,8 @@ def compute_ai_response_score(**kwargs):
         similarity = kwargs.get('ai_source_similarity')
     
     # Step 2: Return a normalised score
-    score = SEMANTIC_IMPORTANCE * similarity + (1 - SEMANTIC_IMPORTANCE) * empathy
+    weights = kwargs.get('weights') or default_weights()
+    score = weights.semantic_importance * similarity + (1 - weights.semantic_importance) * empathy
 
     # Step 3: Return the score
     return score
@@ -97,7 +163,8 @@ def compute_human_response_score(**kwargs):
         similarity = kwargs.get('human_source_similarity')
     
     # Step 2: Return a normalised score
-    score = SEMANTIC_IMPORTANCE * similarity + (1 - SEMANTIC_IMPORTANCE) * empathy
+    weights = kwargs.get('weights') or default_weights()
+    score = weights.semantic_importance * similarity + (1 - weights.semantic_importance) * empathy
 
     # Step 3: Return the score
     return score
@@ -123,14 +190,16 @@ def compute_response_comparison_score(**kwargs):
     similarity = kwargs.get('responses_similarity')
 
     # Step 2: Processing
+    weights = kwargs.get('weights') or default_weights()
     rouge_values = list(rouge.values())
-    rouge = (0.2 * rouge_values[0]) + (0.2 * rouge_values[1]) + (0.6 * rouge_values[2])
+    rouge = (weights.rouge1_importance * rouge_values[0]) + (weights.rouge2_importance * rouge_values[1]) + (weights.rougeL_importance * rouge_values[2])
 
-    score = (SEMANTIC_IMPORTANCE_FOR_RESPONSE_COMPARISON * similarity) + (ROUGE_IMPORTANCE_FOR_RESPONSE_COMPARISON * rouge) + (BLEU_IMPORTANCE_FOR_RESPONSE_COMPARISON * bleu)
+    score = (weights.semantic_importance_for_response_comparison * similarity) + (weights.rouge_importance_for_response_comparison * rouge) + (weights.bleu_importance_for_response_comparison * bleu)
 
     # Return the score
     return score
 
+@profiled('compute_eval_score_for_response')
 def compute_eval_score_for_response(**kwargs):
     """
     Calculates an overall evaluation score for AI and human responses based on multiple criteria.
@@ -153,6 +222,7 @@ def compute_eval_score_for_response(**kwargs):
             - human_context_similarity (float)
             - responses_comparison_score (float)
             - source_context_similarity (float)
+            - weights (ScoringWeights): optional, defaults to the module constants
 
     Returns:
         The final evaluation score as a float.
@@ -179,7 +249,8 @@ def compute_eval_score_for_response(**kwargs):
     context_source_score = kwargs.get('source_context_similarity')
 
     # incase conversations are similar > 0.75 use the source scores as well
-    if context_source_score > CONTEXT_SOURCE_SCORE_THRESHOLD:
+    weights = kwargs.get('weights') or default_weights()
+    if context_source_score > weights.context_source_score_threshold:
         normalizer = 1 + context_source_score
         ai_score = (ai_context_score + (context_source_score * ai_source_score)) / normalizer
         human_score = (human_context_score + (context_source_score * human_source_score)) / normalizer
@@ -188,12 +259,12 @@ def compute_eval_score_for_response(**kwargs):
         human_score = human_context_score
     
     # Step 3:
-    score = (AI_IMPORTANCE_FOR_EVAL * ai_score) + (HUMAN_IMPORTANCE_FOR_EVAL * human_score) + (RESPONSE_IMPORTANCE_FOR_EVAL * response_comparison_score)
+    score = (weights.ai_importance_for_eval * ai_score) + (weights.human_importance_for_eval * human_score) + (weights.response_importance_for_eval * response_comparison_score)
 
     # Step 4: Return score
     return score
     
-def compute_ai_response_score(**kwargs):
+def compute_ai_eval_score(**kwargs):
     """
     Calculates the evaluation score for an AI response considering its relevance to both the
     source material and the context of the conversation.
@@ -227,7 +298,8 @@ def compute_ai_response_score(**kwargs):
     context_source_score = kwargs.get('source_context_similarity')
 
     # incase conversations are similar > 0.75 use the source scores as well
-    if context_source_score > CONTEXT_SOURCE_SCORE_THRESHOLD:
+    weights = kwargs.get('weights') or default_weights()
+    if context_source_score > weights.context_source_score_threshold:
         normalizer = 1 + context_source_score
         ai_score = (ai_context_score + (context_source_score * ai_source_score)) / normalizer
     else:
@@ -239,7 +311,7 @@ def compute_ai_response_score(**kwargs):
     # Step 4: Return score
     return score
 
-def compute_human_response_score(**kwargs):
+def compute_human_eval_score(**kwargs):
     """
     Calculates a score for a human response based on its relevance to both source material and the context.
 
@@ -271,7 +343,8 @@ def compute_human_response_score(**kwargs):
     context_source_score = kwargs.get('source_context_similarity')
 
     # incase conversations are similar > 0.75 use the source scores as well
-    if context_source_score > CONTEXT_SOURCE_SCORE_THRESHOLD:
+    weights = kwargs.get('weights') or default_weights()
+    if context_source_score > weights.context_source_score_threshold:
         normalizer = 1 + context_source_score
         human_score = (human_context_score + (context_source_score * human_source_score)) / normalizer
     else:
@@ -281,4 +354,91 @@ def compute_human_response_score(**kwargs):
     score = human_score
 
     # Step 4: Return score
-    return score
\ No newline at end of file
+    return score
+
+def scores_to_columns(scores_list):
+    """
+    Convert a list of per-row `scores` dicts into one NumPy array per field.
+
+    Args:
+        - scores_list (list(dict)): `scores` dicts as produced by the scorers.
+
+    Returns:
+        - columns (dict): Maps every score field to a float64 array. `responses_rouge`
+            maps to a dict of arrays keyed by 'rouge1', 'rouge2' and 'rougeL'.
+    """
+    columns = {}
+    if not scores_list:
+        return columns
+    for field, value in scores_list[0].items():
+        if isinstance(value, dict):
+            columns[field] = {
+                key: np.fromiter((row[field][key] for row in scores_list), dtype=np.float64, count=len(scores_list))
+                for key in value
+            }
+        else:
+            columns[field] = np.fromiter((row[field] for row in scores_list), dtype=np.float64, count=len(scores_list))
+    return columns
+
+
+def compute_eval_scores_for_responses(weights=None, **columns):
+    """
+    Columnar version of `compute_eval_score_for_response` over many rows at once.
+
+    Every keyword is an array holding one value per row, so re-weighting a scored
+    dataset only takes a handful of NumPy expressions. Fields of `weights` may be
+    arrays of shape (configs, 1), the scores of every configuration are then
+    computed at once by broadcasting against the (rows,) columns.
+
+    Args:
+        - weights (ScoringWeights): defaults to the module constants at call time
+        **columns: One array per field of the `scores` dict. Expected keys are:
+            - ai_source_empathy, ai_source_similarity (np.ndarray)
+            - human_source_empathy, human_source_similarity (np.ndarray)
+            - ai_context_empathy, ai_context_similarity (np.ndarray)
+            - human_context_empathy, human_context_similarity (np.ndarray)
+            - responses_similarity, responses_bleu (np.ndarray)
+            - responses_rouge (dict): arrays keyed by 'rouge1', 'rouge2' and 'rougeL'
+            - source_context_similarity (np.ndarray)
+
+    Returns:
+        - np.ndarray : The final evaluation score of every row, shape (configs, rows)
+            when the weights are arrays.
+    """
+    weights = weights or default_weights()
+
+    # Step 1: Response scores w.r.t source and context conversations
+    def blend(similarity, empathy):
+        return weights.semantic_importance * np.asarray(similarity) + (1 - weights.semantic_importance) * np.asarray(empathy)
+
+    ai_source_score = blend(columns['ai_source_similarity'], columns['ai_source_empathy'])
+    human_source_score = blend(columns['human_source_similarity'], columns['human_source_empathy'])
+    ai_context_score = blend(columns['ai_context_similarity'], columns['ai_context_empathy'])
+    human_context_score = blend(columns['human_context_similarity'], columns['human_context_empathy'])
+
+    # Step 2: AI-human response comparison score
+    rouge = columns['responses_rouge']
+    rouge = (
+        (weights.rouge1_importance * np.asarray(rouge['rouge1']))
+        + (weights.rouge2_importance * np.asarray(rouge['rouge2']))
+        + (weights.rougeL_importance * np.asarray(rouge['rougeL']))
+    )
+    response_comparison_score = (
+        (weights.semantic_importance_for_response_comparison * np.asarray(columns['responses_similarity']))
+        + (weights.rouge_importance_for_response_comparison * rouge)
+        + (weights.bleu_importance_for_response_comparison * np.asarray(columns['responses_bleu']))
+    )
+
+    # Step 3: Fold in the source scores where conversations are similar
+    context_source_score = np.asarray(columns['source_context_similarity'])
+    use_source = context_source_score > weights.context_source_score_threshold
+    normalizer = 1 + context_source_score
+    ai_score = np.where(use_source, (ai_context_score + (context_source_score * ai_source_score)) / normalizer, ai_context_score)
+    human_score = np.where(use_source, (human_context_score + (context_source_score * human_source_score)) / normalizer, human_context_score)
+
+    # Step 4: Weighted final score
+    return (
+        (weights.ai_importance_for_eval * ai_score)
+        + (weights.human_importance_for_eval * human_score)
+        + (weights.response_importance_for_eval * response_comparison_score)
+    )
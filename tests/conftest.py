@@ -0,0 +1,19 @@
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.evaluations.batch_scoring import build_texts
+
+data_path = os.path.join(os.path.dirname(__file__), '..', 'data')
+REAL_RECORDS = 200
+
+
+@pytest.fixture(scope='session')
+def real_texts():
+    """`build_texts` of the first records of the structured equal dataset"""
+    with open(os.path.join(data_path, 'structured_equal.json'), 'r') as f:
+        records = json.load(f)[:REAL_RECORDS]
+    return [build_texts(record) for record in records]
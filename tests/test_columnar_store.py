@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from src.data_handling.columnar_store import ColumnarScores, ColumnarWriter
+
+
+def scored_records(count, dedup=True):
+    records = []
+    for row in range(count):
+        record = {'id': f'id-{row}', 'ai_response': f'reply {row}', 'human_response': f'answer {row}'}
+        if dedup:
+            record['duplicate_cluster_id'] = f'id-{row - row % 3}'
+        record['scores'] = {'responses_bleu': row / 10, 'responses_rouge': {'rouge1': row / 20, 'rougeL': row / 30}}
+        record['score'] = row / 40
+        records.append(record)
+    return records
+
+
+@pytest.mark.parametrize('texts', [True, False])
+def test_duplicate_cluster_id_is_a_column(tmp_path, texts):
+    records = scored_records(10)
+    writer = ColumnarWriter(str(tmp_path / 'out.columns'), texts=texts)
+    writer.write(records[:4])
+    writer.write(records[4:])
+    writer.close()
+
+    store = ColumnarScores(str(tmp_path / 'out.columns'))
+    assert store.string_columns == ['duplicate_cluster_id']
+    assert store.strings('duplicate_cluster_id') == [record['duplicate_cluster_id'] for record in records]
+    assert 'duplicate_cluster_id' not in store.columns
+    if texts:
+        with open(tmp_path / 'out.columns' / 'texts.jsonl') as f:
+            assert all('duplicate_cluster_id' not in json.loads(line) for line in f)
+        assert list(store.records()) == records
+    else:
+        expected = [{key: record[key] for key in ('id', 'duplicate_cluster_id', 'scores', 'score')} for record in records]
+        assert list(store.records()) == expected
+
+
+def test_without_dedup_no_string_column(tmp_path):
+    records = scored_records(3, dedup=False)
+    writer = ColumnarWriter(str(tmp_path / 'out.columns'))
+    writer.write(records)
+    writer.close()
+
+    store = ColumnarScores(str(tmp_path / 'out.columns'))
+    assert store.string_columns == []
+    assert list(store.records()) == records
+    with pytest.raises(KeyError):
+        store.strings('duplicate_cluster_id')
@@ -0,0 +1,57 @@
+import random
+import warnings
+
+import pytest
+from nltk.translate.bleu_score import sentence_bleu
+
+from src.metrics.compute_bleu import bleu_weight_mapping, compute_bleu_scores, compute_bleu_scores_batch
+
+# Pairs whose higher orders have no overlap, are too short to have any, or are empty
+EDGE_PAIRS = [
+    ('', ''), ('hello', ''), ('', 'hello'), ('a', 'a'), ('ab', 'ab'), ('abc', 'cba'), ('abcd', 'dcba'),
+    ('refund', 'fund'), ('thank you', 'thank you'), ('thank you', 'you thank'), ('a b c d e', 'e d c b a'),
+    ('a b', 'a b c d e f'), ('order shipped today', 'order'), ('xyz', 'abc'), ('yes yes yes yes', 'yes'),
+]
+
+
+def reference_scores(source, target, mode):
+    reference, hypothesis = (source, target) if mode == 'char' else (source.split(), target.split())
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # sentence_bleu warns about orders without overlap
+        return {n_gram: sentence_bleu([reference], hypothesis, weights=weights) for n_gram, weights in bleu_weight_mapping.items()}
+
+
+def assert_parity(source, target, mode):
+    expected = reference_scores(source, target, mode)
+    scores = compute_bleu_scores(source, target, mode)
+    for n_gram in bleu_weight_mapping:
+        assert scores[n_gram] == expected[n_gram], (source, target, n_gram)
+
+
+@pytest.mark.parametrize('mode', ['char', 'word'])
+def test_real_texts(real_texts, mode):
+    for row in real_texts:
+        assert_parity(row['ai'], row['human'], mode)
+
+
+@pytest.mark.parametrize('mode', ['char', 'word'])
+@pytest.mark.parametrize('source,target', EDGE_PAIRS)
+def test_edge_cases(source, target, mode):
+    assert_parity(source, target, mode)
+
+
+@pytest.mark.parametrize('mode', ['char', 'word'])
+def test_fuzzed_pairs(mode):
+    rng = random.Random(0)
+    words = ['order', 'refund', 'thanks', 'sorry', 'the', 'a', 'your', 'is', 'shipped', 'today']
+    for _ in range(500):
+        source = ' '.join(rng.choices(words, k=rng.randint(0, 12)))
+        target = ' '.join(rng.choices(words, k=rng.randint(0, 12)))
+        assert_parity(source, target, mode)
+
+
+def test_batch_matches_pairs(real_texts):
+    sources, targets = [row['ai'] for row in real_texts], [row['human'] for row in real_texts]
+    batch = compute_bleu_scores_batch(sources, targets)
+    for idx, (source, target) in enumerate(zip(sources, targets)):
+        assert batch['all'][idx] == compute_bleu_scores(source, target)['all']
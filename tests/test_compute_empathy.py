@@ -0,0 +1,51 @@
+import random
+from itertools import product
+
+import pytest
+
+from src.metrics.compute_empathy import EmpathyPrefix, get_analyzer, measure_empathy_pairs
+
+# Fragments exercising the parts of VADER `EmpathyPrefix` reimplements: 'but', negations,
+# boosters, "kind of", punctuation emphasis, all-caps words and emoticons
+EDGE_FRAGMENTS = [
+    '', ' ', 'Thanks', 'thanks!', 'I am happy', 'but', ' but I am sad', 'BUT it is GREAT', 'not good',
+    "isn't bad", 'never so happy', 'without doubt', 'very good', 'kind of bad', 'the least helpful', 'no',
+    'GOOD', 'HELP ME NOW', 'great!!!', 'really?', 'why??', 'what???', 'ok?????', ':)', ':( not fun',
+    'sort of okay', 'extremely sorry', 'at least', 'too', 'sorry, but no refund', 'Bad', 'love', 'hate it',
+]
+
+
+def assert_parity(conversations, responses):
+    sia = get_analyzer()
+    expected = [sia.polarity_scores(conversation + response)['compound'] for conversation, response in zip(conversations, responses)]
+    assert measure_empathy_pairs(conversations, responses) == expected
+
+
+def test_real_texts(real_texts):
+    for conversation, response in product(('prev', 'source'), ('ai', 'human')):
+        assert_parity([row[conversation] for row in real_texts], [row[response] for row in real_texts])
+
+
+@pytest.mark.parametrize('prefix', EDGE_FRAGMENTS)
+def test_edge_cases(prefix):
+    assert_parity([prefix] * len(EDGE_FRAGMENTS), EDGE_FRAGMENTS)
+    # Prefixes long enough that the boundary window does not reach their start
+    long_prefix = f'Hello there, I NEED help with my order. {prefix}'
+    assert_parity([long_prefix] * len(EDGE_FRAGMENTS), EDGE_FRAGMENTS)
+
+
+def test_fuzzed_concatenations():
+    rng = random.Random(0)
+    conversations, responses = [], []
+    for _ in range(2000):
+        conversations.append(' '.join(rng.choices(EDGE_FRAGMENTS, k=rng.randint(0, 8))))
+        responses.append(rng.choice(('', ' ', '')) + ' '.join(rng.choices(EDGE_FRAGMENTS, k=rng.randint(0, 6))))
+    assert_parity(conversations, responses)
+
+
+def test_prefix_reused_across_responses():
+    conversation = ' customer: my refund is late but thanks agent: SORRY about that'
+    prefix = EmpathyPrefix(conversation)
+    sia = get_analyzer()
+    for response in EDGE_FRAGMENTS:
+        assert prefix.measure(response) == sia.polarity_scores(conversation + response)['compound']
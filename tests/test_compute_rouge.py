@@ -0,0 +1,67 @@
+import random
+
+import pytest
+from rouge_score import rouge_scorer
+
+from src.metrics.compute_rouge import ROUGE_TYPES, compute_rouge_scores, compute_rouge_scores_batch, lcs_length
+
+EDGE_PAIRS = [
+    ('', ''), ('hello', ''), ('', 'hello'), ('!!!', '???'), ('Refunds REFUNDED refunding', 'refund'),
+    ('The order was shipped', 'the ORDER was shipped.'), ('a b c d', 'd c b a'), ('a a a a', 'a'),
+    ("I can't help, sorry", 'sorry I cant help'), ('running runs ran', 'run running'),
+]
+# Vocabulary small enough for long texts to share many tokens, words of 3 characters or less are not stemmed
+WORDS = ['order', 'orders', 'refund', 'refunded', 'thanks', 'sorry', 'the', 'a', 'your', 'is', 'shipped', 'shipping', 'today']
+
+
+@pytest.fixture(scope='module')
+def scorer():
+    return rouge_scorer.RougeScorer(list(ROUGE_TYPES), use_stemmer=True)
+
+
+def assert_parity(scorer, source, target):
+    expected = scorer.score(source, target)
+    scores = compute_rouge_scores(source, target)
+    for rouge_type in ROUGE_TYPES:
+        assert tuple(scores[rouge_type]) == tuple(expected[rouge_type]), (source, target, rouge_type)
+
+
+def test_real_texts(scorer, real_texts):
+    for row in real_texts:
+        assert_parity(scorer, row['ai'], row['human'])
+
+
+@pytest.mark.parametrize('source,target', EDGE_PAIRS)
+def test_edge_cases(scorer, source, target):
+    assert_parity(scorer, source, target)
+
+
+@pytest.mark.parametrize('length', [1, 63, 64, 65, 200, 1000])
+def test_long_texts(scorer, length):
+    # Past 64 tokens the LCS bitmask spans more than one machine word
+    rng = random.Random(length)
+    for _ in range(5):
+        source = ' '.join(rng.choices(WORDS, k=length))
+        target = ' '.join(rng.choices(WORDS, k=rng.randint(1, 2 * length)))
+        assert_parity(scorer, source, target)
+
+
+def test_lcs_length_matches_dynamic_programming():
+    rng = random.Random(0)
+    for _ in range(300):
+        reference = tuple(rng.choices('abcde', k=rng.randint(0, 150)))
+        prediction = tuple(rng.choices('abcde', k=rng.randint(0, 150)))
+        table = [[0] * (len(prediction) + 1) for _ in range(len(reference) + 1)]
+        for i, x in enumerate(reference):
+            for j, y in enumerate(prediction):
+                table[i + 1][j + 1] = table[i][j] + 1 if x == y else max(table[i][j + 1], table[i + 1][j])
+        assert lcs_length(reference, prediction) == table[-1][-1]
+
+
+def test_batch_matches_pairs(real_texts):
+    sources, targets = [row['ai'] for row in real_texts], [row['human'] for row in real_texts]
+    batch = compute_rouge_scores_batch(sources, targets)
+    for idx, (source, target) in enumerate(zip(sources, targets)):
+        scores = compute_rouge_scores(source, target)
+        for rouge_type in ROUGE_TYPES:
+            assert batch[rouge_type]['fmeasure'][idx] == scores[rouge_type].fmeasure
@@ -0,0 +1,81 @@
+import copy
+import json
+import os
+
+import pytest
+
+from src.data_handling.dedup import Deduplicator
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'structured_equal.json')
+
+
+@pytest.fixture(scope='module')
+def records():
+    """Real records, each repeated further down the stream as an exact and a near duplicate"""
+    with open(DATA_PATH) as f:
+        base = json.load(f)[:60]
+    near = []
+    for record in base:
+        record = copy.deepcopy(record)
+        record['id'] = f"{record.get('id')}-near"
+        record['ai_response'] = record['ai_response'] + ' '
+        near.append(record)
+    return base + [copy.deepcopy(record) for record in base] + near
+
+
+def fake_score(records):
+    return [({'id': record.get('id')}, len(record['ai_response'])) for record in records]
+
+
+def run(dedup, records, chunk_size=16):
+    results = []
+    for start in range(0, len(records), chunk_size):
+        results.extend(dedup.score(copy.deepcopy(records[start:start + chunk_size]), fake_score))
+    return results
+
+
+@pytest.mark.parametrize('mode', ['exact', 'near'])
+def test_large_window_matches_unbounded(records, mode):
+    bounded = Deduplicator(mode, max_clusters=len(records))
+    unbounded = Deduplicator(mode, max_clusters=float('inf'))
+    assert run(bounded, records) == run(unbounded, records)
+    assert bounded.stats()['evicted_clusters'] == 0
+    assert bounded.stats()['duplicates'] > 0
+
+
+@pytest.mark.parametrize('mode', ['exact', 'near'])
+def test_index_stays_within_window(records, mode):
+    dedup = Deduplicator(mode, max_clusters=8)
+    results = run(dedup, records)
+    assert len(results) == len(records)
+    assert len(dedup.window) <= 8
+    assert len(dedup.cluster_ids) <= 8 and len(dedup.results) <= 8
+    assert len(set(dedup.exact_clusters.values())) <= 8
+    assert set(dedup.signatures) <= set(dedup.window)
+    assert all(cluster in dedup.window for bucket in dedup.buckets.values() for cluster in bucket)
+    assert dedup.stats()['evicted_clusters'] > 0
+
+
+def test_evicted_cluster_is_scored_again(records):
+    stream = [records[0], records[1], records[2], copy.deepcopy(records[0])]
+    dedup = Deduplicator('exact', max_clusters=2)
+    clusters, representatives = dedup.assign(copy.deepcopy(stream))
+    assert representatives == [0, 1, 2, 3]
+    assert clusters[3] != clusters[0]
+
+
+def test_results_survive_until_fanned_out(records):
+    """A cluster evicted while its records wait, as when the pipeline assigns ahead of fan-out, keeps its results"""
+    dedup = Deduplicator('exact', max_clusters=1)
+    first = copy.deepcopy(records[:2])
+    second = copy.deepcopy([records[1], records[2]])
+    first_assignment = dedup.assign(first)
+    second_assignment = dedup.assign(second)
+    assert len(dedup.window) == 1
+    first_results = dedup.fan_out(first, *first_assignment, fake_score([first[0], first[1]]))
+    second_results = dedup.fan_out(second, *second_assignment, fake_score([second[position] for position in second_assignment[1]]))
+    assert first_results == fake_score(first)
+    assert second_results == fake_score(second)
+    assert first[1]['duplicate_cluster_id'] == second[0]['duplicate_cluster_id']
+    assert len(dedup.results) <= 1 and len(dedup.cluster_ids) <= 1
+    assert not +dedup.pending